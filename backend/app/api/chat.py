@@ -1,85 +1,73 @@
 from fastapi import APIRouter, HTTPException
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel
 from typing import List, Optional, Dict
 from ..models.models import Ingredient, Recipe, IngredientCreate, IngredientUpdate
 from ..utils.sheets import read_sheet, write_sheet, update_sheet, delete_sheet
 from ..services.llm_service import get_llm_response
+from ..services.recipe_matcher import INGREDIENT_COLUMNS, MAX_SUGGESTIONS, RECIPE_COLUMNS, name_key, pad_row, suggest_recipes
+from ..services.change_feed import change_feed
+from ..services.snapshot_store import snapshot_store
+from ..services.category_classifier import classifier_store, normalize_category
+from ..services.cooking_service import cook_recipe
+from ..services.expiry_index import MAX_EXPIRY_DAYS, default_expiry, expiry_index, parse_expiry
+from ..services.recipe_embeddings import search_rows
+from ..services.session_store import ChatSession, session_store
+from ..services.table_index import commit_rows
+from ..utils.io_pool import run_io
+from ..utils.log import get_logger
+from ..utils.metrics import CHAT_ACTION_LATENCY, CHAT_LATENCY
+from ..utils.names import NameIndex
+from ..utils.resilience import ServiceUnavailable
+from ..utils.tracing import span
+from ..utils.units import normalize_unit
+import hashlib
 import os
+import time
 from datetime import datetime, timedelta
 import json
 
 router = APIRouter()
-
-# カテゴリーのマッピング定義
-CATEGORY_MAPPING = {
-    # 野菜関連
-    "野菜": "野菜類",
-    "野菜類": "野菜類",
-    "葉物": "野菜類",
-    "根菜": "野菜類",
-    "果菜": "野菜類",
-    
-    # 肉関連
-    "肉": "肉類",
-    "肉類": "肉類",
-    "牛肉": "肉類",
-    "豚肉": "肉類",
-    "鶏肉": "肉類",
-    
-    # 魚関連
-    "魚": "魚介類",
-    "魚介": "魚介類",
-    "魚介類": "魚介類",
-    "海鮮": "魚介類",
-    "シーフード": "魚介類",
-    
-    # 果物関連
-    "果物": "果物類",
-    "果物類": "果物類",
-    "フルーツ": "果物類",
-    
-    # 乳製品関連
-    "乳製品": "乳製品",
-    "乳": "乳製品",
-    "牛乳": "乳製品",
-    "チーズ": "乳製品",
-    
-    # 調味料関連
-    "調味料": "調味料",
-    "調味": "調味料",
-    "スパイス": "調味料",
-    "香辛料": "調味料",
-    
-    # その他
-    "その他": "その他",
-    "その他の": "その他",
-    "その他の材料": "その他"
-}
-
-def normalize_category(category: str) -> str:
-    """カテゴリー名を正規化する"""
-    if not category:
-        return ""
-    
-    # カテゴリー名を正規化（空白を削除し、小文字に変換）
-    normalized = category.strip().lower()
-    
-    # マッピングから正規化されたカテゴリー名を取得
-    return CATEGORY_MAPPING.get(normalized, category)
+logger = get_logger(__name__)
 
 class Message(BaseModel):
     role: str
     content: str
 
 class ChatRequest(BaseModel):
-    messages: List[Message]
+    # 新しいメッセージ（それまでの会話はsession_idの会話としてサーバーが保持する）
+    message: Optional[str] = None
+    session_id: Optional[str] = None
+    # 会話全体（以前のクライアントとの互換用。指定した場合はサーバーの会話の代わりに使う）
+    messages: Optional[List[Message]] = None
 
 class ChatResponse(BaseModel):
     message: str
     action: Optional[dict] = None
+    actions: Optional[List[dict]] = None
     ingredients: Optional[List[dict]] = None
     recipes: Optional[List[dict]] = None
     category: Optional[str] = None
+    version: Optional[int] = None
+    changes: Optional[List[dict]] = None
+    # シートを読めず、保存済みのスナップショットで応答した場合にTrue（snapshot_atはその取得時刻）
+    stale: Optional[bool] = None
+    snapshot_at: Optional[datetime] = None
+    # 次のメッセージと一緒に送るセッションID
+    session_id: Optional[str] = None
+
+# アプリケーションが作る一覧の項目（件数が多くなるため、応答のモデルでは検証しない）
+TRUSTED_LIST_FIELDS = ("ingredients", "recipes", "changes")
+
+def chat_response(response: dict) -> ORJSONResponse:
+    """チャットの応答を返す
+
+    LLMが返した項目はChatResponseで検証し、シートから作った一覧は検証せずにそのまま加える。
+    """
+    lists = {field: response.pop(field, None) for field in TRUSTED_LIST_FIELDS}
+    content = ChatResponse.model_validate(response).model_dump()
+    content.update(lists)
+    return ORJSONResponse(content)
 
 def find_ingredient_by_name(name: str) -> Optional[tuple[int, Ingredient]]:
     """材料名から材料を検索"""
@@ -108,15 +96,241 @@ def format_date(date_str: str) -> str:
     except ValueError:
         raise HTTPException(status_code=400, detail=f"無効な日付形式です: {date_str}")
 
+# まとめて書き込む材料の操作
+MUTATION_ACTIONS = ("add_ingredient", "update_ingredient", "delete_ingredient")
+
+# メトリクスのラベルに使うアクションの種類（LLMが返した任意の文字列はラベルにしない）
+KNOWN_ACTIONS = MUTATION_ACTIONS + (
+    "list_ingredients",
+    "search_recipes",
+    "list_expiring",
+    "suggest_recipes",
+    "cook_recipe",
+    "error"
+)
+
+def action_label(actions: List[dict]) -> str:
+    """チャットのターンのアクションの種類をメトリクスのラベルにする"""
+    types = {action.get("type") for action in actions}
+    if not types:
+        return "none"
+    if len(types) > 1:
+        return "multiple"
+    action_type = types.pop()
+    return action_type if action_type in KNOWN_ACTIONS else "unknown"
+
+def extract_actions(response: dict) -> List[dict]:
+    """LLMの応答からアクションの配列を取り出す（単一のactionは1件の配列として扱う）"""
+    actions = response.get("actions")
+    if isinstance(actions, list):
+        return [action for action in actions if isinstance(action, dict)]
+    action = response.get("action")
+    return [action] if isinstance(action, dict) else []
+
+# 次のターンのために残す、直前に表示したレシピ・材料の件数
+STATE_LIST_LIMIT = 10
+
+def _names(items) -> List[str]:
+    return [item["name"] for item in items or [] if isinstance(item, dict) and item.get("name")]
+
+def action_state(actions: List[dict], response: dict) -> dict:
+    """このターンで実行したアクションと、表示したレシピ・材料の名前（次のターンで「それ」などを解決するため）"""
+    return {
+        "actions": [action.get("type") for action in actions if action.get("type") in KNOWN_ACTIONS],
+        "recipes": _names(response.get("recipes"))[:STATE_LIST_LIMIT],
+        "ingredients": _names(response.get("ingredients"))[:STATE_LIST_LIMIT]
+    }
+
+def reply_content(llm_response: dict) -> str:
+    """会話に残すLLMの応答（JSONとしてパースできた応答は、アクションも含めてJSONのまま残す）"""
+    if set(llm_response) == {"message"}:
+        return str(llm_response["message"])
+    return json.dumps(llm_response, ensure_ascii=False)
+
+def turn_key(session: ChatSession) -> Optional[str]:
+    """チャットのターンの冪等キー（同じ会話に同じメッセージを再送した場合は同じキーになる）
+
+    以前の形式（会話全体を送る）のリクエストはセッションIDがなく、別の利用者の同じ会話と
+    区別できないためキーを作らない。
+    """
+    if not session.id:
+        return None
+    digest = hashlib.sha1(json.dumps(session.messages, ensure_ascii=False).encode("utf-8")).hexdigest()
+    return f"chat:{session.id}:{digest}"
+
+def context_messages(session: ChatSession) -> List[dict]:
+    """LLMに渡す会話（直前のアクションの結果があれば、最新のメッセージの前に補足する）"""
+    state = session.state
+    notes = []
+    if state.get("actions"):
+        notes.append(f"直前に実行したアクション: {', '.join(state['actions'])}")
+    if state.get("recipes"):
+        notes.append(f"直前に表示したレシピ: {'、'.join(state['recipes'])}")
+    if state.get("ingredients"):
+        notes.append(f"直前に表示した材料: {'、'.join(state['ingredients'])}")
+    if not notes:
+        return list(session.messages)
+    note = {"role": "system", "content": "\n".join(notes)}
+    return [*session.messages[:-1], note, session.messages[-1]]
+
+def read_table(spreadsheet_id: str, table: str, stale_since: Optional[List[datetime]] = None) -> List[List]:
+    """シートの行を返す
+
+    stale_sinceを渡した場合は、シートを読めなければ保存済みのスナップショットを返し、
+    その取得時刻をstale_sinceに追加する。渡さない場合（書き込み前の読み込み）は例外を送出する。
+    """
+    rows, snapshot_at = snapshot_store.read(spreadsheet_id, table, allow_stale=stale_since is not None)
+    if snapshot_at is not None:
+        stale_since.append(snapshot_at)
+    return rows
+
+def load_inventory(spreadsheet_id: str, stale_since: Optional[List[datetime]] = None) -> List[List]:
+    """材料シートの列をそろえた行のリストを返す"""
+    return [pad_row(row, INGREDIENT_COLUMNS) for row in read_table(spreadsheet_id, "Ingredients", stale_since)]
+
+def ingredient_payload(row: List) -> dict:
+    """材料シートの行をチャットの応答用の辞書に変換する"""
+    try:
+        quantity = float(row[2] or 0)
+    except ValueError:
+        quantity = 0.0
+    return {
+        "name": row[1],
+        "quantity": quantity,
+        "unit": row[3],
+        "category": row[6]
+    }
+
+# アクションの種類ごとに必要な項目（欠けているアクションは反映せずに飛ばす）
+_REQUIRED_FIELDS = {
+    "add_ingredient": ("name", "quantity"),
+    "update_ingredient": ("name", "quantity"),
+    "delete_ingredient": ("name",),
+}
+
+def _is_valid_action(action: dict) -> bool:
+    data = action.get("data")
+    if not isinstance(data, dict):
+        return False
+    fields = _REQUIRED_FIELDS.get(action.get("type"), ("name",))
+    return all(data.get(field) not in (None, "") for field in fields) and isinstance(data["name"], str)
+
+def apply_ingredient_actions(spreadsheet_id: str, actions: List[dict], inventory: Optional[List[List]]) -> List[str]:
+    """材料の追加・更新・削除をまとめて1回のbatchUpdateで反映する
+
+    更新・削除の対象はinventory（読み込み済みの材料シート）から名前で探し、
+    同じ名前がなければ表記ゆれ（「ぶた肉」と「豚肉」など）を吸収して探す。
+    入力の誤りは別の材料を書き換えるおそれがあるため対象にせず、近い名前を候補として返す。
+    書き込みに成功したらinventoryも同じ内容に書き換える。追加だけの場合はNoneでよい。
+    名前や数量が欠けたアクションは反映せず、その旨をメッセージに含める。
+    アクションごとのメッセージを返す。
+    """
+    current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    rows_by_name = {}
+    rows_by_key = {}
+    for row in inventory or []:
+        rows_by_name.setdefault(row[1], row)
+        rows_by_key.setdefault(name_key(row[1]), row)
+    names = NameIndex(rows_by_key)
+    # 追加する材料のカテゴリーは材料名からまとめて分類し、LLMが指定したカテゴリーは確信が持てない場合だけ使う
+    adds = [action["data"] for action in actions if action.get("type") == "add_ingredient" and _is_valid_action(action)]
+    categories = iter(classifier_store.get(spreadsheet_id).classify_many(
+        [data["name"] for data in adds],
+        [data.get("category") for data in adds]
+    ) if adds else [])
+
+    inserts = []
+    updates: Dict[str, List] = {}
+    deletes = []
+    messages = []
+    for action in actions:
+        action_type = action.get("type")
+        if not _is_valid_action(action):
+            messages.append("材料の名前か数量が分からなかったため、変更しませんでした。")
+            continue
+        action_data = action["data"]
+        name = action_data["name"]
+
+        if action_type == "add_ingredient":
+            # 消費期限の指定がなければカテゴリーの目安を使う
+            category = next(categories)
+            expiry_date = parse_expiry(action_data.get("expiry_date")) or default_expiry(category)
+            inserts.append([
+                None,  # 書き込み時に採番
+                name,
+                str(action_data["quantity"]),
+                normalize_unit(action_data.get("unit", "")),
+                expiry_date.isoformat() if expiry_date else "",
+                current_time,
+                category
+            ])
+            messages.append(f"{name} {action_data['quantity']}{action_data.get('unit', '')}を追加しました。")
+            continue
+
+        row = rows_by_name.get(name) or rows_by_key.get(name_key(name))
+        if row is None or row[0] in deletes:
+            candidate = rows_by_key.get(names.match(name))
+            if candidate is not None and candidate[0] not in deletes:
+                messages.append(f"{name}が見つかりませんでした。{candidate[1]}のことですか？")
+            else:
+                messages.append(f"{name}が見つかりませんでした。")
+        elif action_type == "update_ingredient":
+            updated = list(updates.get(row[0], row))
+            updated[2] = str(action_data["quantity"])
+            updated[3] = normalize_unit(action_data.get("unit", ""))
+            updated[5] = current_time
+            updates[row[0]] = updated
+            messages.append(f"{row[1]}の数量を更新しました。")
+        else:
+            # 同じターンで先に更新していても削除を優先する
+            updates.pop(row[0], None)
+            deletes.append(row[0])
+            messages.append(f"{row[1]}を削除しました。")
+
+    logger.debug(
+        "材料の変更をまとめて書き込みます",
+        extra={"added": len(inserts), "updated": len(updates), "deleted": len(deletes)}
+    )
+    commit_rows(
+        spreadsheet_id,
+        "Ingredients",
+        inserts=inserts,
+        updates=list(updates.values()),
+        deletes=[int(record_id) for record_id in deletes]
+    )
+
+    for record_id in deletes:
+        expiry_index.remove(record_id)
+    for row in list(updates.values()) + inserts:
+        expiry_index.upsert_row(row)
+    if inventory is None:
+        return messages
+    deleted = set(deletes)
+    inventory[:] = [updates.get(row[0], row) for row in inventory if row[0] not in deleted] + inserts
+    return messages
+
 @router.post("/chat", response_model=ChatResponse)
 async def chat(request: ChatRequest):
+    started = time.perf_counter()
+    label = "none"
+    status = "ok"
     try:
-        # メッセージを処理
-        messages = [{"role": "user", "content": msg.content} for msg in request.messages]
+        # サーバーが保持する会話に新しいメッセージを加える（以前の形式では送られた会話全体を使う）
+        if request.messages is not None:
+            session = ChatSession(None)
+            for msg in request.messages:
+                session.append("user", msg.content)
+        elif request.message:
+            # 応答を保存するまでは複製に加える（LLMの呼び出しが失敗したターンのメッセージを残さず、
+            # 同時のリクエストが保持している会話を途中で書き換えないようにする）
+            session = (await run_io(session_store.get, request.session_id)).copy()
+            session.append("user", request.message)
+        else:
+            raise HTTPException(status_code=400, detail="messageを指定してください")
         
         # LLMからの応答を取得
-        llm_response = get_llm_response(messages)
-        print(f"LLM Response: {llm_response}")  # デバッグ用
+        llm_response = await run_io(get_llm_response, context_messages(session))
+        logger.debug("LLM Response: %s", llm_response)
         
         # LLMの応答からJSONを抽出
         import re
@@ -127,9 +341,9 @@ async def chat(request: ChatRequest):
         if json_match:
             try:
                 response = json.loads(json_match.group(1))
-                print(f"Parsed JSON: {response}")  # デバッグ用
+                logger.debug("Parsed JSON: %s", response)
             except json.JSONDecodeError as e:
-                print(f"JSONのパースに失敗: {str(e)}")  # デバッグ用
+                logger.warning("JSONのパースに失敗: %s", e)
                 raise HTTPException(
                     status_code=500,
                     detail=f"LLMの応答のパースに失敗しました: {str(e)}"
@@ -138,193 +352,256 @@ async def chat(request: ChatRequest):
             # JSONが見つからない場合は、メッセージのみを返す
             response = {"message": llm_response["message"]}
         
-        # アクションの処理
-        if "action" in response:
-            action = response["action"]
+        # アクションの処理（"actions"の配列と単一の"action"の両方に対応）
+        actions = extract_actions(response)
+        label = action_label(actions)
+        start_version = change_feed.version
+        spreadsheet_id = os.getenv("GOOGLE_SHEETS_ID")
+        messages = []
+        inventory = None
+        recipe_rows = None
+        # 古いスナップショットで応答した読み込みの取得時刻
+        stale_since: List[datetime] = []
+        
+        # 材料の追加・更新・削除は種類ごとにまとめ、1回の書き込みで反映する
+        mutations = [action for action in actions if action.get("type") in MUTATION_ACTIONS]
+        if mutations:
+            try:
+                # 名前で対象を探す更新・削除があるときだけ材料シートを読む
+                if any(action.get("type") != "add_ingredient" for action in mutations):
+                    inventory = await run_io(load_inventory, spreadsheet_id)
+                with span("chat.apply_ingredient_actions", **{"chat.actions": len(mutations)}), \
+                        CHAT_ACTION_LATENCY.time(action="ingredient_batch"):
+                    messages.extend(await run_io(apply_ingredient_actions, spreadsheet_id, mutations, inventory))
+            except ServiceUnavailable:
+                raise
+            except Exception as e:
+                logger.exception("材料の反映中にエラーが発生")
+                raise HTTPException(
+                    status_code=500,
+                    detail=f"材料の反映中にエラーが発生しました: {str(e)}"
+                )
+        
+        for action in actions:
             action_type = action.get("type")
             action_data = action.get("data", {})
+            if action_type in MUTATION_ACTIONS:
+                # 材料の追加・更新・削除は上でまとめて反映済み
+                continue
             
-            if action_type == "add_ingredient":
-                try:
-                    # 新しい材料IDを生成
-                    ingredients = read_sheet(os.getenv("GOOGLE_SHEETS_ID"), "Ingredients!A:G")
-                    new_id = str(len(ingredients))  # ヘッダー行を考慮
-                    
-                    # 現在の日時を取得
-                    current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                    
-                    # カテゴリーを正規化
-                    category = action_data.get("category", "")
-                    normalized_category = normalize_category(category)
-                    
-                    # 材料データを準備
-                    ingredient_data = [
-                        [
-                            new_id,
-                            action_data["name"],
-                            str(action_data["quantity"]),
-                            action_data["unit"],
-                            "",  # expiry_date
-                            current_time,
-                            normalized_category
-                        ]
-                    ]
-                    
-                    print(f"Writing ingredient data: {ingredient_data}")  # デバッグ用
-                    
-                    # スプレッドシートに書き込み
-                    write_sheet(
-                        os.getenv("GOOGLE_SHEETS_ID"),
-                        "Ingredients!A:G",
-                        ingredient_data
-                    )
-                    
-                    # 材料一覧を取得して返す
-                    ingredients = read_sheet(os.getenv("GOOGLE_SHEETS_ID"), "Ingredients!A:G")
-                    if len(ingredients) > 1:  # ヘッダー行を除く
-                        response["ingredients"] = [
-                            {
-                                "name": row[1],
-                                "quantity": float(row[2]),
-                                "unit": row[3],
-                                "category": row[6]
-                            }
-                            for row in ingredients[1:]  # ヘッダー行をスキップ
-                        ]
-                    
-                    response["message"] = f"{action_data['name']} {action_data['quantity']}{action_data['unit']}を追加しました。"
-                except Exception as e:
-                    print(f"材料追加中にエラーが発生: {str(e)}")  # デバッグ用
-                    raise HTTPException(
-                        status_code=500,
-                        detail=f"材料の追加中にエラーが発生しました: {str(e)}"
-                    )
-            
-            elif action_type == "list_ingredients":
-                try:
-                    ingredients = read_sheet(os.getenv("GOOGLE_SHEETS_ID"), "Ingredients!A:G")
-                    if len(ingredients) > 1:  # ヘッダー行を除く
+            with span("chat.action", **{"chat.action.type": action_type}), \
+                    CHAT_ACTION_LATENCY.time(action=action_type if action_type in KNOWN_ACTIONS else "unknown"):
+                if action_type == "list_ingredients":
+                    try:
+                        if inventory is None:
+                            inventory = await run_io(load_inventory, spreadsheet_id, stale_since)
                         # カテゴリでフィルタリング（正規化されたカテゴリー名を使用）
                         category = action_data.get("category")
                         normalized_category = normalize_category(category) if category else None
-                        
+                    
                         filtered_ingredients = [
-                            {
-                                "name": row[1],
-                                "quantity": float(row[2]),
-                                "unit": row[3],
-                                "category": row[6]
-                            }
-                            for row in ingredients[1:]  # ヘッダー行をスキップ
+                            ingredient_payload(row)
+                            for row in inventory
                             if not normalized_category or normalize_category(row[6]) == normalized_category
                         ]
-                        
+                    
+                        response["ingredients"] = filtered_ingredients
                         if filtered_ingredients:
-                            response["ingredients"] = filtered_ingredients
                             if category:
                                 response["category"] = category
-                                response["message"] = f"{category}の材料一覧です。"
+                                messages.append(f"{category}の材料一覧です。")
                             else:
-                                response["message"] = "現在の材料一覧です。"
+                                messages.append("現在の材料一覧です。")
+                        elif category:
+                            messages.append(f"{category}の材料は登録されていません。")
                         else:
-                            if category:
-                                response["message"] = f"{category}の材料は登録されていません。"
-                                response["ingredients"] = []  # 空のリストを返す
-                            else:
-                                response["message"] = "現在、材料は登録されていません。"
-                                response["ingredients"] = []  # 空のリストを返す
-                    else:
-                        response["message"] = "現在、材料は登録されていません。"
-                        response["ingredients"] = []  # 空のリストを返す
-                except Exception as e:
-                    print(f"材料一覧取得中にエラーが発生: {str(e)}")  # デバッグ用
-                    raise HTTPException(
-                        status_code=500,
-                        detail=f"材料一覧の取得中にエラーが発生しました: {str(e)}"
-                    )
+                            messages.append("現在、材料は登録されていません。")
+                    except ServiceUnavailable:
+                        raise
+                    except Exception as e:
+                        logger.exception("材料一覧取得中にエラーが発生")
+                        raise HTTPException(
+                            status_code=500,
+                            detail=f"材料一覧の取得中にエラーが発生しました: {str(e)}"
+                        )
+            
+                elif action_type == "search_recipes":
+                    try:
+                        if recipe_rows is None:
+                            recipe_rows = await run_io(read_table, spreadsheet_id, "Recipes", stale_since)
+                        query = action_data.get("query", "").lower()
+                        matching_recipes = [
+                            {
+                                "name": row[1],
+                                "ingredients": row[2],
+                                "servings": row[3],
+                                "url": row[4],
+                                "category": row[5]
+                            }
+                            for row in (pad_row(row, RECIPE_COLUMNS) for row in recipe_rows)
+                            if query in row[1].lower() or query in row[2].lower()
+                        ]
+                        if not matching_recipes and query:
+                            # 名前や材料に含まれない表現（「さっぱりした夏の副菜」など）は意味の近いレシピを探す
+                            ranked = await run_io(search_rows, spreadsheet_id, recipe_rows, query)
+                            rows_by_id = {
+                                int(row[0]): row for row in (pad_row(row, RECIPE_COLUMNS) for row in recipe_rows) if row[0]
+                            }
+                            matching_recipes = [
+                                {
+                                    "name": row[1],
+                                    "ingredients": row[2],
+                                    "servings": row[3],
+                                    "url": row[4],
+                                    "category": row[5]
+                                }
+                                for row in (rows_by_id[record_id] for record_id, _ in ranked if record_id in rows_by_id)
+                            ]
+                        if matching_recipes:
+                            response["recipes"] = matching_recipes
+                            messages.append(f"「{query}」の検索結果です。")
+                        else:
+                            messages.append("条件に一致するレシピが見つかりませんでした。")
+                    except ServiceUnavailable:
+                        raise
+                    except Exception as e:
+                        logger.exception("レシピ検索中にエラーが発生")
+                        raise HTTPException(
+                            status_code=500,
+                            detail=f"レシピの検索中にエラーが発生しました: {str(e)}"
+                        )
             
-            elif action_type == "update_ingredient":
-                try:
-                    ingredients = read_sheet(os.getenv("GOOGLE_SHEETS_ID"), "Ingredients!A:G")
-                    for i, row in enumerate(ingredients[1:], 1):  # ヘッダー行をスキップ
-                        if row[1] == action_data["name"]:
-                            row[2] = str(action_data["quantity"])
-                            row[3] = action_data["unit"]
-                            row[5] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                            write_sheet(
-                                os.getenv("GOOGLE_SHEETS_ID"),
-                                f"Ingredients!A{i+1}:G{i+1}",
-                                [row]
-                            )
-                            response["message"] = f"{action_data['name']}の数量を更新しました。"
-                            break
-                    else:
-                        response["message"] = f"{action_data['name']}が見つかりませんでした。"
-                except Exception as e:
-                    print(f"材料更新中にエラーが発生: {str(e)}")  # デバッグ用
-                    raise HTTPException(
-                        status_code=500,
-                        detail=f"材料の更新中にエラーが発生しました: {str(e)}"
-                    )
+                elif action_type == "list_expiring":
+                    try:
+                        days = min(max(int(action_data.get("days", expiry_index.horizon_days)), 0), MAX_EXPIRY_DAYS)
+                    except (TypeError, ValueError):
+                        days = expiry_index.horizon_days
+                    try:
+                        expiring = [
+                            {
+                                "name": item["name"],
+                                "quantity": item["quantity"],
+                                "unit": item["unit"],
+                                "category": item["category"],
+                                "expiry_date": item["expiry_date"].isoformat()
+                            }
+                            for item in expiry_index.upcoming(days)
+                        ]
+                        response["ingredients"] = expiring
+                        if expiring:
+                            messages.append(f"{days}日以内に消費期限を迎える材料です。")
+                        else:
+                            messages.append(f"{days}日以内に消費期限を迎える材料はありません。")
+                    except ServiceUnavailable:
+                        raise
+                    except Exception as e:
+                        logger.exception("消費期限の確認中にエラーが発生")
+                        raise HTTPException(
+                            status_code=500,
+                            detail=f"消費期限の確認中にエラーが発生しました: {str(e)}"
+                        )
             
-            elif action_type == "delete_ingredient":
-                try:
-                    ingredients = read_sheet(os.getenv("GOOGLE_SHEETS_ID"), "Ingredients!A:G")
-                    for i, row in enumerate(ingredients[1:], 1):  # ヘッダー行をスキップ
-                        if row[1] == action_data["name"]:
-                            delete_sheet(
-                                os.getenv("GOOGLE_SHEETS_ID"),
-                                f"Ingredients!A{i+1}:G{i+1}"
-                            )
-                            response["message"] = f"{action_data['name']}を削除しました。"
-                            break
-                    else:
-                        response["message"] = f"{action_data['name']}が見つかりませんでした。"
-                except Exception as e:
-                    print(f"材料削除中にエラーが発生: {str(e)}")  # デバッグ用
-                    raise HTTPException(
-                        status_code=500,
-                        detail=f"材料の削除中にエラーが発生しました: {str(e)}"
-                    )
+                elif action_type == "suggest_recipes":
+                    try:
+                        if inventory is None:
+                            inventory = await run_io(load_inventory, spreadsheet_id, stale_since)
+                        if recipe_rows is None:
+                            recipe_rows = await run_io(read_table, spreadsheet_id, "Recipes", stale_since)
+                        try:
+                            limit = min(max(int(action_data.get("limit", 5)), 1), MAX_SUGGESTIONS)
+                        except (TypeError, ValueError):
+                            limit = 5
+                        suggestions = suggest_recipes(
+                            inventory,
+                            recipe_rows,
+                            servings=action_data.get("servings"),
+                            limit=limit
+                        )
+                        if suggestions:
+                            response["recipes"] = suggestions
+                            messages.append("今ある材料で作れるレシピの候補です。")
+                        else:
+                            messages.append("今ある材料で作れるレシピが見つかりませんでした。")
+                    except ServiceUnavailable:
+                        raise
+                    except Exception as e:
+                        logger.exception("レシピ提案中にエラーが発生")
+                        raise HTTPException(
+                            status_code=500,
+                            detail=f"レシピの提案中にエラーが発生しました: {str(e)}"
+                        )
             
-            elif action_type == "search_recipes":
-                try:
-                    recipes = read_sheet(os.getenv("GOOGLE_SHEETS_ID"), "Recipes!A:G")
-                    query = action_data.get("query", "").lower()
-                    matching_recipes = [
-                        {
-                            "name": row[1],
-                            "ingredients": row[2],
-                            "servings": row[3],
-                            "url": row[4],
-                            "category": row[5]
-                        }
-                        for row in recipes[1:]  # ヘッダー行をスキップ
-                        if query in row[1].lower() or query in row[2].lower()
-                    ]
-                    if matching_recipes:
-                        response["recipes"] = matching_recipes
-                        response["message"] = f"「{query}」の検索結果です。"
-                    else:
-                        response["message"] = "条件に一致するレシピが見つかりませんでした。"
-                except Exception as e:
-                    print(f"レシピ検索中にエラーが発生: {str(e)}")  # デバッグ用
-                    raise HTTPException(
-                        status_code=500,
-                        detail=f"レシピの検索中にエラーが発生しました: {str(e)}"
-                    )
+                elif action_type == "cook_recipe":
+                    try:
+                        # 失敗したターンの再送（同じセッション・同じメッセージ）の調理は適用済みとして扱う
+                        result = await run_io(
+                            cook_recipe,
+                            spreadsheet_id,
+                            recipe_id=action_data.get("id"),
+                            name=action_data.get("name"),
+                            servings=action_data.get("servings"),
+                            idempotency_key=turn_key(session)
+                        )
+                        if result is None:
+                            messages.append(f"{action_data.get('name', 'レシピ')}が見つかりませんでした。")
+                        elif not result["applied"]:
+                            messages.append(f"{result['name']}は既に調理済みとして記録されています。")
+                        else:
+                            message = f"{result['name']}（{result['servings']}人分）を作りました。使った材料を在庫から減らしました。"
+                            if result["missing"]:
+                                missing = "、".join(f"{m['name']} {m['quantity']}{m['unit']}" for m in result["missing"])
+                                message += f"不足していた材料: {missing}"
+                            messages.append(message)
+                            # 在庫とレシピが書き換わったので、以降のアクションでは読み直す
+                            inventory = None
+                            recipe_rows = None
+                    except ServiceUnavailable:
+                        raise
+                    except Exception as e:
+                        logger.exception("調理の記録中にエラーが発生")
+                        raise HTTPException(
+                            status_code=500,
+                            detail=f"調理の記録中にエラーが発生しました: {str(e)}"
+                        )
             
-            elif action_type == "error":
-                # エラーアクションの場合は、エラーメッセージを返すが、HTTPエラーは発生させない
-                response["message"] = action_data.get("message", "エラーが発生しました。")
-                response["ingredients"] = []  # 空のリストを返す
-                return response
+                elif action_type == "error":
+                    # エラーアクションの場合は、エラーメッセージを返すが、HTTPエラーは発生させない
+                    messages.append(action_data.get("message", "エラーが発生しました。"))
+                    response["ingredients"] = []  # 空のリストを返す
         
-        return response
+        if messages:
+            response["message"] = "\n".join(messages)
+        # 一覧全体ではなく、このターンでの変更（差分）とバージョンを返す
+        # バージョンは全ワーカーで共通なので、他のワーカーで同じ間に記録された変更も含む
+        response["version"] = change_feed.version
+        if response["version"] > start_version:
+            response["changes"] = change_feed.since(start_version)
+        if stale_since:
+            response["stale"] = True
+            response["snapshot_at"] = min(stale_since)
+        if request.messages is None:
+            if llm_response.get("action") != "error":
+                # ユーザーのメッセージとLLMの応答（アクションのJSON）、このターンの結果を次のターンのために残す
+                # （LLMの呼び出しが失敗したターンは会話に残さない）
+                session.append("assistant", reply_content(llm_response))
+                session.state = action_state(actions, response)
+                await run_io(session_store.save, session)
+            response["session_id"] = session.id
+        return chat_response(response)
     
+    except HTTPException:
+        status = "error"
+        raise
+    except ServiceUnavailable:
+        # 503とRetry-Afterはアプリケーション全体の例外ハンドラーで返す
+        status = "unavailable"
+        raise
     except Exception as e:
-        print(f"チャット処理中にエラーが発生: {str(e)}")  # デバッグ用
+        status = "error"
+        logger.exception("チャット処理中にエラーが発生")
         raise HTTPException(
             status_code=500,
             detail=f"チャットの処理中にエラーが発生しました: {str(e)}"
-        ) 
\ No newline at end of file
+        )
+    finally:
+        CHAT_LATENCY.observe(time.perf_counter() - started, action=label, status=status) 
\ No newline at end of file
@@ -1,7 +1,46 @@
-from fastapi import APIRouter, HTTPException
-from typing import List, Optional
-from ..models.models import Ingredient, IngredientCreate, IngredientUpdate, Recipe, RecipeIngredient
-from ..utils.sheets import read_sheet, write_sheet, update_sheet, delete_sheet
+from fastapi import APIRouter, Header, HTTPException, Query, Request, Response
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from pydantic import ValidationError
+from typing import Dict, List, Optional, Tuple
+from ..models.models import (
+    BulkImportResult,
+    CookRequest,
+    CookResult,
+    ExpiringIngredient,
+    Ingredient,
+    IngredientCreate,
+    IngredientTotal,
+    IngredientUpdate,
+    Recipe,
+    RecipeSuggestion
+)
+from ..utils.sheets import read_sheet
+from ..utils import data_version
+from ..utils.bulk_io import IMPORT_FIELDS, detect_format, export_lines, iter_lines, iter_records
+from ..utils.io_pool import run_io
+from ..utils.metrics import CACHE_REQUESTS
+from ..utils.resilience import ServiceUnavailable
+from ..utils.shared_store import store
+from ..utils.units import aggregate_quantities, normalize_unit, parse_quantity
+from ..services.recipe_matcher import (
+    INGREDIENT_COLUMNS,
+    MAX_SUGGESTIONS,
+    pad_row,
+    suggest_recipes
+)
+from ..services.category_classifier import CategoryClassifier, classifier_store, normalize_category
+from ..services.change_feed import change_feed, row_to_record
+from ..services.cooking_service import cook_recipe
+from ..services.expiry_index import MAX_EXPIRY_DAYS, default_expiry, expiry_index, parse_expiry
+from ..services.recipe_embeddings import search_table
+from ..services.record_store import record_store
+from ..services.sheet_watcher import sheet_watcher
+from ..services.table_index import append_rows, commit_rows, delete_row, locate_row
+import asyncio
+import base64
+import hashlib
+import json
+import orjson
 import os
 from datetime import datetime
 
@@ -10,53 +49,305 @@ router = APIRouter()
 # 環境変数からスプレッドシートIDを取得
 SPREADSHEET_ID = os.getenv("GOOGLE_SHEETS_ID")
 
+# 変更の配信が途切れないように送る空行の間隔（秒）
+SSE_KEEPALIVE_SECONDS = 15
+
+# 一覧のページサイズ
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+# 一覧の本文を共有ストアに保持する秒数（キーにデータバージョンを含むため無効化は不要）
+LIST_CACHE_TTL = 300
+
+def _parse_datetime(value: str) -> Optional[datetime]:
+    return datetime.fromisoformat(value) if value else None
+
+def row_to_ingredient(row: list) -> Ingredient:
+    """材料シートの行をIngredientに変換する"""
+    row = pad_row(row, INGREDIENT_COLUMNS)
+    data = dict(
+        id=int(row[0]),
+        name=row[1],
+        quantity=float(row[2] or 0),
+        unit=row[3],
+        expiry_date=_parse_datetime(row[4]),
+        category=row[6]
+    )
+    if row[5]:
+        data["updated_at"] = datetime.fromisoformat(row[5])
+    return Ingredient(**data)
+
+def _encode_cursor(last_id: int) -> str:
+    return base64.urlsafe_b64encode(str(last_id).encode()).decode().rstrip("=")
+
+def _decode_cursor(cursor: Optional[str]) -> int:
+    if not cursor:
+        return 0
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        return int(base64.urlsafe_b64decode(padded.encode()).decode())
+    except (ValueError, UnicodeDecodeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def _parse_fields(fields: Optional[str], model) -> Optional[Tuple[str, ...]]:
+    """fields=name,quantity のような項目指定を検証する"""
+    if not fields:
+        return None
+    selected = tuple(dict.fromkeys(f.strip() for f in fields.split(",") if f.strip()))
+    unknown = [f for f in selected if f not in model.model_fields]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(unknown)}")
+    return selected
+
+def _etag_matches(request: Request, etag: str) -> bool:
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    candidates = [tag.strip() for tag in header.split(",")]
+    return "*" in candidates or etag in candidates
+
+def list_response(
+    request: Request,
+    table: str,
+    model,
+    limit: int,
+    cursor: Optional[str],
+    fields: Optional[str]
+) -> Response:
+    """IDのカーソルでページ分割した一覧を返す
+
+    ETagはシートのデータバージョン（と再起動で変わるepoch）とクエリから作るため、If-None-Matchが一致すれば
+    シートを読まずに304を返す。本文はバージョンごとにシリアライズ済みの形で共有ストアに
+    保持するため、複数のワーカーで動かしてもシートを読むのは最初の1回だけになる。
+    シートの内容はアプリケーションが書き込んだものとして信頼し、返すページの行だけを
+    モデルを作らずに辞書にしてorjsonでシリアライズする。
+    """
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    after = _decode_cursor(cursor)
+    selected = _parse_fields(fields, model)
+    key = (table, after, limit, selected)
+
+    version = data_version.current(table)
+    digest = hashlib.sha1(repr(key).encode()).hexdigest()[:16]
+    etag = f'W/"{table}-{data_version.epoch():x}-{version}-{digest}"'
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if request.headers.get("if-none-match"):
+        matched = _etag_matches(request, etag)
+        CACHE_REQUESTS.inc(cache="list_etag", result="hit" if matched else "miss")
+        if matched:
+            return Response(status_code=304, headers=headers)
+
+    cache_key = f"list:{table}:{version}:{digest}"
+    cached = store.get(cache_key)
+    if cached is not None:
+        CACHE_REQUESTS.inc(cache="list_body", result="hit")
+        # 「次のカーソル\n本文」の形で保存している
+        cursor_part, body = bytes(cached).split(b"\n", 1)
+        next_cursor = cursor_part.decode() or None
+    else:
+        CACHE_REQUESTS.inc(cache="list_body", result="miss")
+        records = record_store.get(SPREADSHEET_ID, table)
+        start = records.position_after(after)
+        page = records.records(range(start, min(start + limit, len(records))))
+        next_cursor = _encode_cursor(page[-1]["id"]) if len(records) > start + limit else None
+
+        if selected:
+            page = [{field: record[field] for field in selected} for record in page]
+        body = orjson.dumps(page)
+        store.set(cache_key, (next_cursor or "").encode() + b"\n" + body, ttl=LIST_CACHE_TTL)
+
+    if next_cursor:
+        headers["X-Next-Cursor"] = next_cursor
+        next_url = request.url.include_query_params(cursor=next_cursor)
+        headers["Link"] = f'<{next_url}>; rel="next"'
+    return Response(content=body, media_type="application/json", headers=headers)
+
+def ingredient_to_row(ingredient: IngredientCreate) -> list:
+    """追加する材料をシートの行に変換する（IDは追加時に採番）"""
+    # 消費期限の指定がない場合はカテゴリーの目安を使う
+    if ingredient.expiry_date is None:
+        expiry = default_expiry(ingredient.category)
+        if expiry:
+            ingredient.expiry_date = datetime.combine(expiry, datetime.min.time())
+    
+    return [
+        None,
+        ingredient.name,
+        ingredient.quantity,
+        ingredient.unit,
+        ingredient.expiry_date.isoformat() if ingredient.expiry_date else "",
+        datetime.now().isoformat(),
+        ingredient.category
+    ]
+
 # 材料関連のエンドポイント
 @router.get("/ingredients", response_model=List[Ingredient])
-async def get_ingredients():
-    """材料一覧を取得"""
+async def get_ingredients(
+    request: Request,
+    limit: int = DEFAULT_PAGE_SIZE,
+    cursor: Optional[str] = None,
+    fields: Optional[str] = None
+):
+    """材料一覧を取得（cursorでページ送り、fieldsで項目を絞り込み）"""
+    try:
+        return await run_io(list_response, request, "Ingredients", Ingredient, limit, cursor, fields)
+    except HTTPException:
+        raise
+    except ServiceUnavailable:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+# 一括インポートで1回に検証する行数・エクスポートで1回に読む行数
+BULK_BATCH_SIZE = 500
+# エラー応答に含めるエラーの最大件数
+MAX_BULK_ERRORS = 100
+
+def _validate_bulk_batch(batch: List[Tuple[int, Dict]], rows: List[list], errors: List[Dict], classifier: CategoryClassifier):
+    """インポートする行をまとめて検証し、シートの行に変換する（カテゴリーが空の行は材料名から分類する）"""
+    unlabeled = [record for _, record in batch if record.get("name") and not record.get("category")]
+    for record, category in zip(unlabeled, classifier.classify_many([str(record["name"]) for record in unlabeled])):
+        record["category"] = category
+    for line_number, record in batch:
+        data = {key: value for key, value in record.items() if key in IMPORT_FIELDS and value not in (None, "")}
+        try:
+            if "expiry_date" in data:
+                expiry = parse_expiry(data["expiry_date"])
+                if expiry is None:
+                    raise ValueError(f"消費期限の形式が不正です: {data['expiry_date']}")
+                data["expiry_date"] = datetime.combine(expiry, datetime.min.time())
+            ingredient = IngredientCreate(**data)
+        except ValidationError as e:
+            if len(errors) < MAX_BULK_ERRORS:
+                message = "; ".join(f"{'.'.join(map(str, err['loc']))}: {err['msg']}" for err in e.errors())
+                errors.append({"line": line_number, "error": message})
+            continue
+        except ValueError as e:
+            if len(errors) < MAX_BULK_ERRORS:
+                errors.append({"line": line_number, "error": str(e)})
+            continue
+        ingredient.unit = normalize_unit(ingredient.unit)
+        ingredient.category = normalize_category(ingredient.category)
+        rows.append(ingredient_to_row(ingredient))
+
+@router.post("/ingredients/bulk", response_model=BulkImportResult)
+async def import_ingredients(request: Request, format: Optional[str] = None):
+    """CSV/JSONLの材料データを一括で追加
+
+    本文は受信しながら行単位で解釈し、BULK_BATCH_SIZE行ずつ検証する。
+    不正な行が1行でもあれば何も書き込まずに422を返し、
+    すべて正しければ1回のbatchUpdateでまとめて書き込む。
+    """
+    fmt = detect_format(format, request.headers.get("content-type"))
+    if fmt is None:
+        raise HTTPException(status_code=415, detail="CSV（text/csv）またはJSONL（application/x-ndjson）を指定してください")
+
+    rows: List[list] = []
+    errors: List[Dict] = []
+    batch: List[Tuple[int, Dict]] = []
+    classifier = await run_io(classifier_store.get, SPREADSHEET_ID)
+    async for line_number, record, error in iter_records(iter_lines(request.stream()), fmt):
+        if error:
+            if len(errors) < MAX_BULK_ERRORS:
+                errors.append({"line": line_number, "error": error})
+            continue
+        batch.append((line_number, record))
+        if len(batch) >= BULK_BATCH_SIZE:
+            _validate_bulk_batch(batch, rows, errors, classifier)
+            batch = []
+    _validate_bulk_batch(batch, rows, errors, classifier)
+
+    if errors:
+        raise HTTPException(status_code=422, detail=sorted(errors, key=lambda err: err["line"]))
     try:
-        values = read_sheet(SPREADSHEET_ID, "Ingredients!A2:G")
-        ingredients = []
-        for row in values:
-            ingredient = Ingredient(
-                id=int(row[0]),
-                name=row[1],
-                quantity=float(row[2]),
-                unit=row[3],
-                expiry_date=datetime.fromisoformat(row[4]) if row[4] else None,
-                updated_at=datetime.fromisoformat(row[5]),
-                category=row[6]
-            )
-            ingredients.append(ingredient)
-        return ingredients
+        ids = await run_io(append_rows, SPREADSHEET_ID, "Ingredients", rows)
+        for row in rows:
+            expiry_index.upsert_row(row)
+    except ServiceUnavailable:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+    return BulkImportResult(imported=len(ids), ids=ids)
+
+def _iter_sheet_pages(table: str, page_size: int = BULK_BATCH_SIZE):
+    """シートをページ単位で読み進める"""
+    start = 2
+    while True:
+        rows = read_sheet(SPREADSHEET_ID, f"{table}!A{start}:G{start + page_size - 1}")
+        yield [row for row in rows if row]
+        if len(rows) < page_size:
+            break
+        start += page_size
+
+async def _export_chunks(table: str, fmt: str):
+    """書き出す行をページ単位でI/Oプールで読みながら送る"""
+    chunks = export_lines(_iter_sheet_pages(table), fmt)
+    while True:
+        chunk = await run_io(next, chunks, None)
+        if chunk is None:
+            break
+        yield chunk
+
+@router.get("/ingredients/bulk")
+async def export_ingredients(format: str = "csv"):
+    """材料データをCSV/JSONLで書き出す（シートをページ単位で読みながら送信）"""
+    fmt = detect_format(format, None)
+    if fmt is None:
+        raise HTTPException(status_code=400, detail="formatにはcsvまたはjsonlを指定してください")
+    media_type = "text/csv; charset=utf-8" if fmt == "csv" else "application/x-ndjson"
+    return StreamingResponse(
+        _export_chunks("Ingredients", fmt),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="ingredients.{fmt}"'}
+    )
+
+@router.get("/ingredients/summary", response_model=List[IngredientTotal])
+async def get_ingredient_totals():
+    """材料ごとの在庫量を基準単位（g・ml・個など）で合計して取得"""
+    try:
+        rows = await run_io(read_sheet, SPREADSHEET_ID, "Ingredients!A2:G")
+        names, quantities, units = [], [], []
+        for row in rows:
+            row = pad_row(row, INGREDIENT_COLUMNS)
+            if not row[1]:
+                continue
+            # 「1/2」は数量として読み取り、「少々」のように数量のない行は合計に含めない
+            quantity, unit = parse_quantity(row[2], row[3])
+            if quantity is None:
+                continue
+            names.append(row[1])
+            quantities.append(quantity)
+            units.append(unit)
+        totals = aggregate_quantities(names, quantities, units, names=names)
+        return [
+            IngredientTotal(name=name, quantity=quantity, unit=unit)
+            for (name, unit), quantity in totals.items()
+        ]
+    except ServiceUnavailable:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@router.get("/ingredients/expiring", response_model=List[ExpiringIngredient])
+async def get_expiring_ingredients(days: int = Query(3, ge=0, le=MAX_EXPIRY_DAYS)):
+    """指定日数以内に消費期限を迎える材料を期限の近い順に取得"""
+    return expiry_index.upcoming(days)
 
 @router.post("/ingredients", response_model=Ingredient)
 async def create_ingredient(ingredient: IngredientCreate):
     """新しい材料を追加"""
     try:
-        # 既存の材料を取得して新しいIDを生成
-        values = read_sheet(SPREADSHEET_ID, "Ingredients!A2:A")
-        new_id = len(values) + 1
-        
-        # 新しい材料を追加
-        new_row = [
-            new_id,
-            ingredient.name,
-            ingredient.quantity,
-            ingredient.unit,
-            ingredient.expiry_date.isoformat() if ingredient.expiry_date else "",
-            datetime.now().isoformat(),
-            ingredient.category
-        ]
-        write_sheet(SPREADSHEET_ID, f"Ingredients!A{new_id+1}", [new_row])
+        new_row = ingredient_to_row(ingredient)
+        new_id = (await run_io(append_rows, SPREADSHEET_ID, "Ingredients", [new_row]))[0]
+        expiry_index.upsert_row(new_row)
         
         return Ingredient(
             id=new_id,
             **ingredient.dict(),
             updated_at=datetime.now()
         )
+    except ServiceUnavailable:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -65,21 +356,13 @@ async def update_ingredient(ingredient_id: int, ingredient_update: IngredientUpd
     """材料を更新"""
     try:
         # 既存の材料を確認
-        values = read_sheet(SPREADSHEET_ID, f"Ingredients!A{ingredient_id+1}:G{ingredient_id+1}")
-        if not values:
+        row = await run_io(locate_row, SPREADSHEET_ID, "Ingredients", ingredient_id)
+        if row is None:
             raise HTTPException(status_code=404, detail="Ingredient not found")
+        values = await run_io(read_sheet, SPREADSHEET_ID, f"Ingredients!A{row}:G{row}")
         
         # 既存の材料データを取得
-        existing = values[0]
-        current_ingredient = Ingredient(
-            id=int(existing[0]),
-            name=existing[1],
-            quantity=float(existing[2]),
-            unit=existing[3],
-            expiry_date=datetime.fromisoformat(existing[4]) if existing[4] else None,
-            updated_at=datetime.fromisoformat(existing[5]),
-            category=existing[6]
-        )
+        current_ingredient = row_to_ingredient(values[0])
         
         # 更新データを適用
         update_data = ingredient_update.dict(exclude_unset=True)
@@ -95,9 +378,15 @@ async def update_ingredient(ingredient_id: int, ingredient_update: IngredientUpd
             datetime.now().isoformat(),
             updated_ingredient.category
         ]
-        update_sheet(SPREADSHEET_ID, f"Ingredients!A{ingredient_id+1}", [updated_row])
+        # 行番号はワーカー間のロックの中で引き直して書き込む
+        await run_io(commit_rows, SPREADSHEET_ID, "Ingredients", updates=[updated_row])
+        expiry_index.upsert_row(updated_row)
         
         return updated_ingredient
+    except HTTPException:
+        raise
+    except ServiceUnavailable:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -105,38 +394,33 @@ async def update_ingredient(ingredient_id: int, ingredient_update: IngredientUpd
 async def delete_ingredient(ingredient_id: int):
     """材料を削除"""
     try:
-        # 既存の材料を確認
-        values = read_sheet(SPREADSHEET_ID, f"Ingredients!A{ingredient_id+1}:A{ingredient_id+1}")
-        if not values:
-            raise HTTPException(status_code=404, detail="Ingredient not found")
-        
         # 材料を削除
-        delete_sheet(SPREADSHEET_ID, f"Ingredients!A{ingredient_id+1}:G{ingredient_id+1}")
+        if not await run_io(delete_row, SPREADSHEET_ID, "Ingredients", ingredient_id):
+            raise HTTPException(status_code=404, detail="Ingredient not found")
+        expiry_index.remove(ingredient_id)
         return {"message": "Ingredient deleted successfully"}
+    except HTTPException:
+        raise
+    except ServiceUnavailable:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 # レシピ関連のエンドポイント
 @router.get("/recipes", response_model=List[Recipe])
-async def get_recipes():
-    """レシピ一覧を取得"""
+async def get_recipes(
+    request: Request,
+    limit: int = DEFAULT_PAGE_SIZE,
+    cursor: Optional[str] = None,
+    fields: Optional[str] = None
+):
+    """レシピ一覧を取得（cursorでページ送り、fieldsで項目を絞り込み）"""
     try:
-        values = read_sheet(SPREADSHEET_ID, "Recipes!A2:G")
-        recipes = []
-        for row in values:
-            # 材料リストをJSONからパース
-            ingredients = [RecipeIngredient(**ing) for ing in eval(row[2])]
-            recipe = Recipe(
-                id=int(row[0]),
-                name=row[1],
-                ingredients=ingredients,
-                servings=int(row[3]),
-                url=row[4],
-                category=row[5],
-                last_cooked=datetime.fromisoformat(row[6]) if row[6] else None
-            )
-            recipes.append(recipe)
-        return recipes
+        return await run_io(list_response, request, "Recipes", Recipe, limit, cursor, fields)
+    except HTTPException:
+        raise
+    except ServiceUnavailable:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -144,13 +428,9 @@ async def get_recipes():
 async def create_recipe(recipe: Recipe):
     """新しいレシピを追加"""
     try:
-        # 既存のレシピを取得して新しいIDを生成
-        values = read_sheet(SPREADSHEET_ID, "Recipes!A2:A")
-        new_id = len(values) + 1
-        
         # 新しいレシピを追加
         new_row = [
-            new_id,
+            None,  # 追加時に採番
             recipe.name,
             str([ing.dict() for ing in recipe.ingredients]),
             recipe.servings,
@@ -158,10 +438,10 @@ async def create_recipe(recipe: Recipe):
             recipe.category,
             recipe.last_cooked.isoformat() if recipe.last_cooked else ""
         ]
-        write_sheet(SPREADSHEET_ID, f"Recipes!A{new_id+1}", [new_row])
-        
-        recipe.id = new_id
+        recipe.id = (await run_io(append_rows, SPREADSHEET_ID, "Recipes", [new_row]))[0]
         return recipe
+    except ServiceUnavailable:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -170,8 +450,7 @@ async def update_recipe(recipe_id: int, recipe: Recipe):
     """レシピを更新"""
     try:
         # 既存のレシピを確認
-        values = read_sheet(SPREADSHEET_ID, f"Recipes!A{recipe_id+1}:A{recipe_id+1}")
-        if not values:
+        if await run_io(locate_row, SPREADSHEET_ID, "Recipes", recipe_id) is None:
             raise HTTPException(status_code=404, detail="Recipe not found")
         
         # レシピを更新
@@ -184,10 +463,14 @@ async def update_recipe(recipe_id: int, recipe: Recipe):
             recipe.category,
             recipe.last_cooked.isoformat() if recipe.last_cooked else ""
         ]
-        update_sheet(SPREADSHEET_ID, f"Recipes!A{recipe_id+1}", [updated_row])
+        await run_io(commit_rows, SPREADSHEET_ID, "Recipes", updates=[updated_row])
         
         recipe.id = recipe_id
         return recipe
+    except HTTPException:
+        raise
+    except ServiceUnavailable:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -195,59 +478,171 @@ async def update_recipe(recipe_id: int, recipe: Recipe):
 async def delete_recipe(recipe_id: int):
     """レシピを削除"""
     try:
-        # 既存のレシピを確認
-        values = read_sheet(SPREADSHEET_ID, f"Recipes!A{recipe_id+1}:A{recipe_id+1}")
-        if not values:
-            raise HTTPException(status_code=404, detail="Recipe not found")
-        
         # レシピを削除
-        delete_sheet(SPREADSHEET_ID, f"Recipes!A{recipe_id+1}:G{recipe_id+1}")
+        if not await run_io(delete_row, SPREADSHEET_ID, "Recipes", recipe_id):
+            raise HTTPException(status_code=404, detail="Recipe not found")
         return {"message": "Recipe deleted successfully"}
+    except HTTPException:
+        raise
+    except ServiceUnavailable:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@router.post("/recipes/{recipe_id}/cook", response_model=CookResult)
+async def cook(
+    recipe_id: int,
+    request: Optional[CookRequest] = None,
+    idempotency_key: Optional[str] = Header(None, max_length=128)
+):
+    """レシピを調理し、使った材料を在庫からまとめて減らす
+
+    Idempotency-Keyヘッダーが同じ再送は適用済みとして扱われ、在庫は二重に減らない。
+    """
+    request = request or CookRequest()
+    try:
+        result = await run_io(
+            cook_recipe,
+            SPREADSHEET_ID,
+            recipe_id=recipe_id,
+            servings=request.servings,
+            cooked_at=request.cooked_at,
+            idempotency_key=idempotency_key
+        )
+    except ServiceUnavailable:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+    if result is None:
+        raise HTTPException(status_code=404, detail="Recipe not found")
+    return result
 
 # レシピ検索API
 @router.get("/recipes/search", response_model=List[Recipe])
 async def search_recipes(
     ingredients: Optional[str] = None,
     category: Optional[str] = None,
-    min_servings: Optional[int] = None
+    min_servings: Optional[int] = None,
+    mode: str = "keyword",
+    q: Optional[str] = None,
+    limit: int = Query(10, ge=1, le=MAX_SUGGESTIONS)
 ):
-    """材料に基づいてレシピを検索"""
+    """材料に基づいてレシピを検索（mode=semanticではqの文章に意味の近い順に最大limit件）"""
+    if mode not in ("keyword", "semantic"):
+        raise HTTPException(status_code=400, detail="modeにはkeywordまたはsemanticを指定してください")
+    if mode == "semantic" and not q:
+        raise HTTPException(status_code=400, detail="mode=semanticではqに検索する文章を指定してください")
     try:
         # 全レシピを取得
-        values = read_sheet(SPREADSHEET_ID, "Recipes!A2:G")
-        recipes = []
-        
-        for row in values:
-            # 材料リストをJSONからパース
-            recipe_ingredients = [RecipeIngredient(**ing) for ing in eval(row[2])]
-            recipe = Recipe(
-                id=int(row[0]),
-                name=row[1],
-                ingredients=recipe_ingredients,
-                servings=int(row[3]),
-                url=row[4],
-                category=row[5],
-                last_cooked=datetime.fromisoformat(row[6]) if row[6] else None
-            )
-            
-            # フィルタリング条件をチェック
-            if ingredients:
-                # 材料名でフィルタリング（部分一致）
-                if not any(ing.lower() in recipe.name.lower() or 
-                          any(ing.lower() in i.name.lower() for i in recipe.ingredients)
-                          for ing in ingredients.split(',')):
-                    continue
-            
-            if category and recipe.category.lower() != category.lower():
-                continue
-                
-            if min_servings and recipe.servings < min_servings:
-                continue
-            
-            recipes.append(recipe)
-        
-        return recipes
+        table = await run_io(record_store.get, SPREADSHEET_ID, "Recipes")
+        # 材料名（部分一致）・カテゴリー・人数で絞り込み、該当した行だけを辞書にする
+        positions = table.search(
+            terms=ingredients.split(',') if ingredients else None,
+            category=category,
+            min_servings=min_servings
+        )
+        if mode == "semantic":
+            # 絞り込んだレシピを、埋め込みの類似度の高い順に並べる
+            positions = await run_io(search_table, SPREADSHEET_ID, table, q, limit, positions)
+        # 変換済みの辞書をそのまま返す（response_modelによる検証をしない）
+        return ORJSONResponse(table.records(positions))
+    except ServiceUnavailable:
+        raise
     except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e)) 
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=str(e)) 
+
+# 在庫からのレシピ提案API
+@router.get("/recipes/suggest", response_model=List[RecipeSuggestion])
+async def suggest_recipes_from_pantry(
+    servings: Optional[int] = None,
+    limit: int = Query(10, ge=1, le=MAX_SUGGESTIONS),
+    min_score: float = 0.0
+):
+    """今ある材料で作れるレシピを充足率の高い順に取得"""
+    try:
+        # 材料とレシピは並行して読む
+        ingredient_rows, recipe_rows = await asyncio.gather(
+            run_io(read_sheet, SPREADSHEET_ID, "Ingredients!A2:G"),
+            run_io(read_sheet, SPREADSHEET_ID, "Recipes!A2:G")
+        )
+        return suggest_recipes(
+            ingredient_rows,
+            recipe_rows,
+            servings=servings,
+            limit=limit,
+            min_score=min_score
+        )
+    except ServiceUnavailable:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+# 変更フィード
+@router.get("/changes")
+async def get_changes(since: int = 0):
+    """指定バージョンより後の材料・レシピの変更を返す"""
+    changes = change_feed.since(since)
+    if changes is None:
+        raise HTTPException(status_code=410, detail="Version is too old; reload the full list")
+    return {"version": change_feed.version, "changes": changes}
+
+def _sse(event: str, data, event_id: Optional[int] = None) -> bytes:
+    lines = [] if event_id is None else [f"id: {event_id}"]
+    lines.append(f"event: {event}")
+    lines.append(f"data: {json.dumps(data, ensure_ascii=False)}")
+    return ("\n".join(lines) + "\n\n").encode("utf-8")
+
+@router.get("/changes/stream")
+async def stream_changes(request: Request, since: Optional[int] = None):
+    """材料・レシピの変更をServer-Sent Eventsで配信する
+
+    sinceまたはLast-Event-IDのバージョンからの差分を送り、以降の変更を順に送る。
+    バージョンが古すぎる場合は材料の一覧（snapshot）から送り直す。
+    """
+    if since is None:
+        last_event_id = request.headers.get("last-event-id", "")
+        since = int(last_event_id) if last_event_id.isdigit() else None
+
+    async def events():
+        # 先に購読してから差分を求め、その間の変更を取りこぼさないようにする
+        subscriber = change_feed.subscribe()
+        try:
+            backlog = change_feed.since(since) if since is not None else None
+            if backlog is None:
+                last = change_feed.version
+                rows = await run_io(read_sheet, SPREADSHEET_ID, "Ingredients!A2:G")
+                snapshot = [row_to_record("Ingredients", row) for row in rows]
+                yield _sse("snapshot", {"version": last, "ingredients": snapshot}, last)
+            else:
+                last = since
+                for change in backlog:
+                    yield _sse("change", change, change["version"])
+                    last = change["version"]
+
+            while True:
+                if subscriber.overflowed:
+                    # 受け取りが追いつかなかったので、クライアントに取り直しを促す
+                    yield _sse("reset", {"version": change_feed.version})
+                    return
+                try:
+                    change = await asyncio.wait_for(subscriber.queue.get(), SSE_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    yield b": keepalive\n\n"
+                    continue
+                if change["version"] <= last:
+                    continue
+                yield _sse("change", change, change["version"])
+                last = change["version"]
+        finally:
+            change_feed.unsubscribe(subscriber)
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@router.get("/sync/status")
+async def get_sync_status():
+    """スプレッドシートの更新検知の状態（キャッシュの鮮度）を返す"""
+    return sheet_watcher.status()
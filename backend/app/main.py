@@ -1,24 +1,58 @@
-from fastapi import FastAPI
+import asyncio
+import math
+import time
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, ORJSONResponse, PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
 from dotenv import load_dotenv
 import os
-from .api import chat
-from .utils.sheets import initialize_sheets
 
-# .envファイルの読み込み
+# .envファイルの読み込み（環境変数を参照するモジュールより先に行う）
 load_dotenv(os.path.join(os.path.dirname(__file__), '..', '.env'))
 
-# 環境変数の確認
+from .utils.log import configure_logging, get_logger
+configure_logging()
+
+from .api import chat, endpoints
+from .utils.sheets import initialize_sheets, read_sheet
+from .services.expiry_index import expiry_index, run_expiry_scheduler
+from .services.sheet_watcher import follow_sheet_changes, run_sheet_watcher
+from .services.table_index import load_table_indexes
+from .utils.io_pool import io_pool, run_io
+from .utils.metrics import HTTP_LATENCY, registry
+from .utils.resilience import ServiceUnavailable, deadline
+from .utils.shared_store import store
+from .utils.tracing import span, tracer
+
+logger = get_logger(__name__)
+
+# 必須の環境変数（不足している間は/readyzが503を返す）
 required_env_vars = [
     "OPENAI_API_KEY",
     "GOOGLE_SHEETS_ID",
 ]
 
-missing_vars = [var for var in required_env_vars if not os.getenv(var)]
-if missing_vars:
-    raise ValueError(f"以下の環境変数が設定されていません: {', '.join(missing_vars)}")
+# 初期化を待たずに応答するパス
+READINESS_EXEMPT_PATHS = ("/", "/healthz", "/readyz", "/metrics")
+# 初期化中のリクエストを待たせる最大の秒数（超えた場合は503）
+INIT_WAIT_TIMEOUT = float(os.getenv("INIT_WAIT_TIMEOUT", "10"))
+# 初期化に失敗したときに再試行するまでの秒数
+INIT_RETRY_INTERVAL = float(os.getenv("INIT_RETRY_INTERVAL", "10"))
+# リクエストごとの締め切り（秒、X-Request-Timeoutヘッダーでこれより短くできる）
+REQUEST_TIMEOUT = float(os.getenv("REQUEST_TIMEOUT", "30"))
+
+def request_timeout(request: Request) -> float:
+    """リクエストの締め切りまでの秒数（呼び出し元が指定した値と上限の短い方）"""
+    try:
+        requested = float(request.headers.get("x-request-timeout", REQUEST_TIMEOUT))
+    except ValueError:
+        requested = REQUEST_TIMEOUT
+    return max(min(requested, REQUEST_TIMEOUT), 0.0)
+
+def missing_env_vars() -> list:
+    return [var for var in required_env_vars if not os.getenv(var)]
 
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse)
 
 # CORSの設定
 app.add_middleware(
@@ -27,21 +61,157 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag", "X-Next-Cursor", "Link", "traceparent"],
 )
 
+@app.middleware("http")
+async def wait_until_ready(request: Request, call_next):
+    """初期化が終わるまでAPIへのリクエストを待たせる"""
+    task = getattr(app.state, "init_task", None)
+    if task is not None and not task.done() and request.url.path not in READINESS_EXEMPT_PATHS:
+        try:
+            await asyncio.wait_for(asyncio.shield(task), INIT_WAIT_TIMEOUT)
+        except asyncio.TimeoutError:
+            return JSONResponse(
+                status_code=503,
+                content={"detail": "初期化中です。しばらくしてから再度お試しください。"},
+                headers={"Retry-After": str(int(INIT_RETRY_INTERVAL))}
+            )
+    return await call_next(request)
+
+@app.middleware("http")
+async def trace_requests(request: Request, call_next):
+    """リクエストごとにSERVERスパンを記録し、traceparentヘッダーで呼び出し元とつなぐ（締め切りもここで設定する）"""
+    with span(
+        f"{request.method} {request.url.path}",
+        kind="SERVER",
+        traceparent=request.headers.get("traceparent"),
+        **{"http.method": request.method, "url.path": request.url.path}
+    ) as current, deadline(request_timeout(request)):
+        started = time.perf_counter()
+        response = await call_next(request)
+        route = request.scope.get("route")
+        if route is not None:
+            # パスパラメーターを含まないルート名でまとめられるようにする
+            current.name = f"{request.method} {route.path}"
+            current.set_attribute("http.route", route.path)
+        HTTP_LATENCY.observe(
+            time.perf_counter() - started,
+            method=request.method,
+            route=route.path if route is not None else "unmatched",
+            status=response.status_code
+        )
+        current.set_attribute("http.status_code", response.status_code)
+        if response.status_code >= 500:
+            current.status = "ERROR"
+        response.headers["traceparent"] = current.traceparent
+        logger.info(
+            "%s %s %s",
+            request.method,
+            request.url.path,
+            response.status_code,
+            extra={"duration_ms": round((time.perf_counter() - started) * 1000, 2)}
+        )
+        return response
+
+@app.exception_handler(ServiceUnavailable)
+async def service_unavailable(request: Request, exc: ServiceUnavailable):
+    """外部サービスを一時的に使えない場合は503とRetry-Afterを返す"""
+    return JSONResponse(
+        status_code=503,
+        content={"detail": str(exc)},
+        headers={"Retry-After": str(max(math.ceil(exc.retry_after), 1))}
+    )
+
 # ルーターの登録
 app.include_router(chat.router, prefix="/api/v1", tags=["chat"])
+app.include_router(endpoints.router, prefix="/api/v1", tags=["ingredients", "recipes"])
+
+def initialize_data(spreadsheet_id: str):
+    """スプレッドシートの初期化とキャッシュの読み込み"""
+    with span("app.initialize"):
+        # gunicornで起動した場合はマスターで1回だけ行う（gunicorn.conf.pyを参照）
+        if os.getenv("SHEETS_INITIALIZED") != "1":
+            initialize_sheets(spreadsheet_id)
+
+        # ID採番と行番号の対応表を読み込む
+        load_table_indexes(spreadsheet_id)
+        
+        # 消費期限インデックスを作成する
+        expiry_index.load(read_sheet(spreadsheet_id, "Ingredients!A2:G"))
+
+async def initialize_in_background(spreadsheet_id: str):
+    """起動を待たせずに初期化を行い、終わったらシートの監視を始める（失敗した場合は再試行する）"""
+    while True:
+        try:
+            await run_io(initialize_data, spreadsheet_id)
+            break
+        except Exception as e:
+            app.state.init_error = str(e)
+            logger.warning("初期化に失敗しました。%s秒後に再試行します: %s", INIT_RETRY_INTERVAL, e)
+            await asyncio.sleep(INIT_RETRY_INTERVAL)
+    app.state.init_error = None
+    logger.info("初期化が完了しました")
+
+    # スプレッドシートが直接編集されたらキャッシュを読み直す（複数ワーカーの場合は1つのワーカーだけが監視し、
+    # 他のワーカーは監視役が変更フィードに流した変更を反映する）
+    interval = float(os.getenv("SHEETS_WATCH_INTERVAL", "30"))
+    if store.try_acquire_leadership("sheet_watcher"):
+        app.state.sheet_watch_task = asyncio.create_task(run_sheet_watcher(spreadsheet_id, interval))
+    else:
+        app.state.sheet_watch_task = asyncio.create_task(follow_sheet_changes(spreadsheet_id, interval))
 
 @app.on_event("startup")
 async def startup_event():
-    """アプリケーション起動時の初期化処理"""
-    try:
-        # スプレッドシートの初期化
-        initialize_sheets(os.getenv("GOOGLE_SHEETS_ID"))
-        print("スプレッドシートの初期化が完了しました。")
-    except Exception as e:
-        print(f"スプレッドシートの初期化中にエラーが発生しました: {str(e)}")
-        raise
+    """アプリケーション起動時の初期化処理（シートへのアクセスはバックグラウンドで行う）"""
+    app.state.init_error = None
+    missing = missing_env_vars()
+    if missing:
+        logger.error("以下の環境変数が設定されていません: %s", ", ".join(missing))
+        return
+
+    app.state.init_task = asyncio.create_task(
+        initialize_in_background(os.getenv("GOOGLE_SHEETS_ID"))
+    )
+
+    # 期限の確認を定期実行する（複数ワーカーの場合は1つのワーカーだけが行う）
+    if store.try_acquire_leadership("expiry_scheduler"):
+        app.state.expiry_task = asyncio.create_task(
+            run_expiry_scheduler(float(os.getenv("EXPIRY_CHECK_INTERVAL", "3600")))
+        )
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """アプリケーション終了時の後処理"""
+    for name in ("init_task", "expiry_task", "sheet_watch_task"):
+        task = getattr(app.state, name, None)
+        if task:
+            task.cancel()
+    io_pool.shutdown()
+    tracer.flush()
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    """Prometheusのテキスト形式でメトリクスを返す"""
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/healthz")
+async def healthz():
+    """プロセスが応答できるか（liveness）"""
+    return {"status": "ok"}
+
+@app.get("/readyz")
+async def readyz():
+    """リクエストを受け付けられるか（readiness）：環境変数がそろい、初期化が終わっていること"""
+    missing = missing_env_vars()
+    task = getattr(app.state, "init_task", None)
+    if missing or task is None or not task.done():
+        return JSONResponse(status_code=503, content={
+            "status": "not_ready",
+            "missing_env": missing,
+            "error": getattr(app.state, "init_error", None)
+        })
+    return {"status": "ready"}
 
 @app.get("/")
 async def root():
@@ -1,6 +1,6 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 from typing import List, Optional
-from datetime import datetime
+from datetime import date, datetime
 
 class IngredientBase(BaseModel):
     name: str
@@ -20,7 +20,7 @@ class IngredientUpdate(IngredientBase):
 
 class Ingredient(IngredientBase):
     id: Optional[int] = None
-    updated_at: datetime = datetime.now()
+    updated_at: datetime = Field(default_factory=datetime.now)
 
     class Config:
         from_attributes = True
@@ -37,4 +37,47 @@ class Recipe(BaseModel):
     servings: int
     url: Optional[str] = None
     category: str
-    last_cooked: Optional[datetime] = None 
\ No newline at end of file
+    last_cooked: Optional[datetime] = None 
+
+class ExpiringIngredient(BaseModel):
+    id: int
+    name: str
+    quantity: float
+    unit: str
+    category: str
+    expiry_date: date
+    days_left: int
+
+class BulkImportResult(BaseModel):
+    imported: int
+    ids: List[int]
+
+class IngredientTotal(BaseModel):
+    name: str
+    quantity: float
+    unit: str
+
+class RecipeSuggestion(BaseModel):
+    id: Optional[int] = None
+    name: str
+    servings: int
+    url: Optional[str] = None
+    category: str
+    last_cooked: Optional[datetime] = None
+    score: float
+    matched: List[str]
+    missing: List[RecipeIngredient]
+
+
+class CookRequest(BaseModel):
+    servings: Optional[int] = None
+    cooked_at: Optional[datetime] = None
+
+class CookResult(BaseModel):
+    recipe_id: Optional[int] = None
+    name: str
+    servings: int
+    cooked_at: datetime
+    applied: bool
+    consumed: List[RecipeIngredient]
+    missing: List[RecipeIngredient]
\ No newline at end of file
@@ -0,0 +1,285 @@
+import functools
+import os
+import threading
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Sequence, Set, Tuple
+
+import numpy as np
+
+from ..utils import data_version
+from ..utils.log import get_logger
+from ..utils.metrics import CACHE_REQUESTS
+from ..utils.names import normalize_name
+from .record_store import record_store
+
+logger = get_logger(__name__)
+
+# 材料のカテゴリー
+CATEGORIES = ("野菜類", "肉類", "魚介類", "果物類", "乳製品", "調味料", "その他")
+OTHER = "その他"
+
+# カテゴリーのマッピング定義
+CATEGORY_MAPPING = {
+    # 野菜関連
+    "野菜": "野菜類",
+    "野菜類": "野菜類",
+    "葉物": "野菜類",
+    "根菜": "野菜類",
+    "果菜": "野菜類",
+
+    # 肉関連
+    "肉": "肉類",
+    "肉類": "肉類",
+    "牛肉": "肉類",
+    "豚肉": "肉類",
+    "鶏肉": "肉類",
+
+    # 魚関連
+    "魚": "魚介類",
+    "魚介": "魚介類",
+    "魚介類": "魚介類",
+    "海鮮": "魚介類",
+    "シーフード": "魚介類",
+
+    # 果物関連
+    "果物": "果物類",
+    "果物類": "果物類",
+    "フルーツ": "果物類",
+
+    # 乳製品関連
+    "乳製品": "乳製品",
+    "乳": "乳製品",
+    "牛乳": "乳製品",
+    "チーズ": "乳製品",
+
+    # 調味料関連
+    "調味料": "調味料",
+    "調味": "調味料",
+    "スパイス": "調味料",
+    "香辛料": "調味料",
+
+    # その他
+    "その他": "その他",
+    "その他の": "その他",
+    "その他の材料": "その他"
+}
+
+# よく使う材料のカテゴリー（シートの材料で学習する前の初期値。同じ名前がシートにあればそちらを優先する）
+INGREDIENT_LEXICON = {
+    "野菜類": [
+        "玉ねぎ", "にんじん", "じゃがいも", "キャベツ", "白菜", "大根", "きゅうり", "トマト", "ミニトマト",
+        "なす", "ピーマン", "パプリカ", "ブロッコリー", "ほうれん草", "小松菜", "レタス", "長ねぎ", "ねぎ",
+        "もやし", "ごぼう", "れんこん", "かぼちゃ", "さつまいも", "里芋", "生姜", "にんにく", "ニラ",
+        "アスパラガス", "セロリ", "オクラ", "しいたけ", "しめじ", "えのき", "まいたけ", "エリンギ"
+    ],
+    "肉類": [
+        "豚肉", "豚バラ肉", "豚こま切れ肉", "牛肉", "牛こま切れ肉", "鶏肉", "鶏もも肉", "鶏むね肉",
+        "ささみ", "手羽先", "ひき肉", "合いびき肉", "ベーコン", "ハム", "ソーセージ", "ウインナー"
+    ],
+    "魚介類": [
+        "鮭", "さば", "あじ", "いわし", "ぶり", "まぐろ", "たら", "さんま", "えび", "いか", "たこ",
+        "あさり", "しじみ", "ほたて", "かに", "ツナ缶", "しらす", "ちくわ"
+    ],
+    "果物類": [
+        "りんご", "バナナ", "みかん", "オレンジ", "いちご", "ぶどう", "レモン", "キウイ", "もも", "なし",
+        "メロン", "すいか", "グレープフルーツ", "ブルーベリー"
+    ],
+    "乳製品": [
+        "牛乳", "チーズ", "バター", "ヨーグルト", "生クリーム", "クリームチーズ", "粉チーズ", "スライスチーズ"
+    ],
+    "調味料": [
+        "塩", "砂糖", "醤油", "味噌", "みりん", "酒", "料理酒", "酢", "サラダ油", "ごま油", "オリーブオイル",
+        "こしょう", "ケチャップ", "マヨネーズ", "ソース", "めんつゆ", "ポン酢", "コンソメ", "鶏ガラスープの素",
+        "だしの素", "カレールー", "片栗粉", "小麦粉", "はちみつ"
+    ],
+    "その他": [
+        "卵", "豆腐", "納豆", "油揚げ", "米", "パン", "食パン", "パスタ", "うどん", "そば", "中華麺", "パン粉"
+    ]
+}
+
+# 名前の照合結果を覚えておく件数
+CATEGORY_CACHE_SIZE = int(os.getenv("CATEGORY_CACHE_SIZE", "4096"))
+# 学習した名前と一致しない材料をモデルの推定で分類する確率の下限（下回る場合は「その他」にする）
+CATEGORY_MIN_CONFIDENCE = float(os.getenv("CATEGORY_MIN_CONFIDENCE", "0.6"))
+
+@functools.lru_cache(maxsize=1024)
+def normalize_category(category: str) -> str:
+    """カテゴリー名を正規化する"""
+    if not category:
+        return ""
+
+    # カテゴリー名を正規化（空白を削除し、小文字に変換）
+    normalized = category.strip().lower()
+
+    # マッピングから正規化されたカテゴリー名を取得
+    return CATEGORY_MAPPING.get(normalized, category)
+
+def _features(key: str) -> List[str]:
+    """照合用の表記の文字1〜3-gram（前後の印つき。「〜肉」のような語尾も特徴になる）"""
+    padded = f"^{key}$"
+    return [padded[i:i + n] for n in (1, 2, 3) for i in range(len(padded) - n + 1)]
+
+class NaiveBayes:
+    """文字n-gramの多項ナイーブベイズ（ラプラス平滑化）"""
+
+    def __init__(self, samples: Iterable[Tuple[str, str]], alpha: float = 1.0):
+        self.features: Dict[str, int] = {}
+        rows: List[int] = []
+        columns: List[int] = []
+        documents = np.zeros(len(CATEGORIES))
+        classes = {category: i for i, category in enumerate(CATEGORIES)}
+        for key, category in samples:
+            column = classes[category]
+            documents[column] += 1
+            for feature in _features(key):
+                rows.append(self.features.setdefault(feature, len(self.features)))
+                columns.append(column)
+        vocabulary = len(self.features)
+        # 最後の行は学習時に現れなかったn-gram
+        counts = np.zeros((vocabulary + 1, len(CATEGORIES)))
+        np.add.at(counts, (rows, columns), 1)
+        totals = counts.sum(axis=0) + alpha * (vocabulary + 1)
+        self.log_likelihood = np.log((counts + alpha) / totals)
+        self.log_prior = np.log((documents + 1) / (documents.sum() + len(CATEGORIES)))
+
+    def predict(self, keys: Sequence[str]) -> List[Tuple[str, float]]:
+        """照合用の表記ごとに、最も確率の高いカテゴリーとその確率を返す"""
+        if not keys:
+            return []
+        unknown = len(self.features)
+        indices: List[int] = []
+        offsets = []
+        for key in keys:
+            offsets.append(len(indices))
+            indices.extend(self.features.get(feature, unknown) for feature in _features(key))
+        scores = np.add.reduceat(self.log_likelihood[indices], offsets, axis=0) + self.log_prior
+        scores -= scores.max(axis=1, keepdims=True)
+        probabilities = np.exp(scores)
+        probabilities /= probabilities.sum(axis=1, keepdims=True)
+        best = probabilities.argmax(axis=1)
+        return [
+            (CATEGORIES[column], float(probabilities[i, column]))
+            for i, column in enumerate(best.tolist())
+        ]
+
+class CategoryClassifier:
+    """材料名からカテゴリーを求める
+
+    LLMやユーザーが有効なカテゴリー（hint、「その他」以外）を指定した場合はそれを使う。
+    指定がなければ、シートに登録済みの材料と組み込みの辞書（INGREDIENT_LEXICON）に同じ名前があれば
+    そのカテゴリーを、なければそれらで学習したナイーブベイズの推定を使い、確率が低ければ「その他」にする。
+    名前の照合は表記ゆれを吸収し（normalize_name）、結果は名前ごとにLRUで覚えておく。
+    """
+
+    def __init__(self, rows: Iterable[Tuple[str, str]] = ()):
+        lexicon = {
+            normalize_name(name): category
+            for category, names in INGREDIENT_LEXICON.items()
+            for name in names
+        }
+        # 同じ名前が複数のカテゴリーで登録されている場合は多い方にする
+        votes: Dict[str, Dict[str, int]] = {}
+        for name, category in rows:
+            category = normalize_category(category)
+            key = normalize_name(name or "")
+            if key and category in CATEGORIES:
+                counts = votes.setdefault(key, {})
+                counts[category] = counts.get(category, 0) + 1
+        self.known = dict(lexicon)
+        self.known.update({key: max(counts, key=counts.get) for key, counts in votes.items()})
+        self.model = NaiveBayes(self.known.items())
+        self._cache: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _predict(self, keys: Sequence[str]) -> List[Tuple[str, float]]:
+        """照合用の表記ごとの（カテゴリー, 確率）。覚えていないものだけまとめて推定する"""
+        results: Dict[str, Tuple[str, float]] = {}
+        with self._lock:
+            for key in keys:
+                cached = self._cache.get(key)
+                if cached is not None:
+                    self._cache.move_to_end(key)
+                    results[key] = cached
+        missing = [key for key in dict.fromkeys(keys) if key not in results]
+        CACHE_REQUESTS.inc(len(keys) - len(missing), cache="category", result="hit")
+        if missing:
+            CACHE_REQUESTS.inc(len(missing), cache="category", result="miss")
+            predicted = [
+                (self.known[key], 1.0) if key in self.known else prediction
+                for key, prediction in zip(missing, self.model.predict(missing))
+            ]
+            with self._lock:
+                for key, prediction in zip(missing, predicted):
+                    results[key] = self._cache[key] = prediction
+                while len(self._cache) > CATEGORY_CACHE_SIZE:
+                    self._cache.popitem(last=False)
+        return [results[key] for key in keys]
+
+    def classify_many(self, names: Sequence[str], hints: Optional[Sequence[Optional[str]]] = None) -> List[str]:
+        """材料名ごとのカテゴリーを返す（hintsは名前ごとに指定されたカテゴリー）"""
+        hints = hints or [None] * len(names)
+        categories = [normalize_category(hint or "") for hint in hints]
+        unhinted = [i for i, category in enumerate(categories) if category not in CATEGORIES or category == OTHER]
+        predictions = self._predict([normalize_name(names[i] or "") for i in unhinted])
+        for i, (category, probability) in zip(unhinted, predictions):
+            categories[i] = category if probability >= CATEGORY_MIN_CONFIDENCE else OTHER
+        return categories
+
+    def classify(self, name: str, hint: Optional[str] = None) -> str:
+        """材料名のカテゴリーを返す"""
+        return self.classify_many([name], [hint])[0]
+
+class ClassifierStore:
+    """シートの材料で学習した分類器を、材料シートのデータバージョンごとに1つだけ保持する
+
+    材料シートが変わったら、作り直す間も前の分類器を返し、バックグラウンドで学習し直す
+    （材料の追加のたびに書き込みの途中でシートを読んで学習し直さない）。
+    """
+
+    def __init__(self):
+        self._classifiers: Dict[str, Tuple[int, CategoryClassifier]] = {}
+        self._fallback: Optional[CategoryClassifier] = None
+        self._rebuilding: Set[str] = set()
+        self._lock = threading.Lock()
+
+    def _build(self, spreadsheet_id: str, version: int) -> CategoryClassifier:
+        table = record_store.get(spreadsheet_id, "Ingredients")
+        categories = table.categories.values
+        classifier = CategoryClassifier(
+            (name, categories[code]) for name, code in zip(table.names, table.category_codes.tolist())
+        )
+        self._classifiers[spreadsheet_id] = (version, classifier)
+        return classifier
+
+    def _rebuild(self, spreadsheet_id: str, version: int):
+        try:
+            self._build(spreadsheet_id, version)
+        except Exception as e:
+            logger.warning("カテゴリーの分類器を学習し直せませんでした: %s", e)
+        finally:
+            with self._lock:
+                self._rebuilding.discard(spreadsheet_id)
+
+    def get(self, spreadsheet_id: str) -> CategoryClassifier:
+        version = data_version.current("Ingredients")
+        cached = self._classifiers.get(spreadsheet_id)
+        if cached is not None:
+            if cached[0] != version:
+                with self._lock:
+                    start = spreadsheet_id not in self._rebuilding
+                    self._rebuilding.add(spreadsheet_id)
+                if start:
+                    threading.Thread(
+                        target=self._rebuild, args=(spreadsheet_id, version), name="category-classifier", daemon=True
+                    ).start()
+            return cached[1]
+        try:
+            return self._build(spreadsheet_id, version)
+        except Exception as e:
+            # 材料シートを読めなくても、組み込みの辞書だけで分類する
+            logger.warning("材料シートを読めないため、辞書だけでカテゴリーを分類します: %s", e)
+            if self._fallback is None:
+                self._fallback = CategoryClassifier()
+            return self._fallback
+
+classifier_store = ClassifierStore()
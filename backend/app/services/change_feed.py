@@ -0,0 +1,181 @@
+import asyncio
+import os
+import threading
+import time
+from typing import Dict, List, Optional, Sequence
+
+import orjson
+
+from ..utils.log import get_logger
+from ..utils.shared_store import store
+from .recipe_matcher import INGREDIENT_COLUMNS, RECIPE_COLUMNS, pad_row, parse_recipe_ingredients
+
+# 変更を保持する件数（これより古いバージョンからの差分は返せない）
+FEED_CAPACITY = 1000
+# 購読者ごとに溜められる未送信の変更の件数
+SUBSCRIBER_QUEUE_SIZE = 1000
+# 他のワーカーが記録した変更を購読者に送るため、共有のログを確認する間隔（秒）
+CHANGE_FEED_POLL_INTERVAL = float(os.getenv("CHANGE_FEED_POLL_INTERVAL", "0.5"))
+
+logger = get_logger(__name__)
+
+def _number(value, cast):
+    try:
+        return cast(value)
+    except (TypeError, ValueError):
+        return None
+
+def row_to_record(table: str, row: Sequence) -> Dict:
+    """シートの行を変更通知で送る辞書に変換する"""
+    if table == "Recipes":
+        row = pad_row(row, RECIPE_COLUMNS)
+        return {
+            "id": _number(row[0], int),
+            "name": row[1],
+            "ingredients": parse_recipe_ingredients(row[2]),
+            "servings": _number(row[3], int),
+            "url": row[4],
+            "category": row[5],
+            "last_cooked": row[6] or None
+        }
+    row = pad_row(row, INGREDIENT_COLUMNS)
+    return {
+        "id": _number(row[0], int),
+        "name": row[1],
+        "quantity": _number(row[2], float),
+        "unit": row[3],
+        "expiry_date": row[4] or None,
+        "updated_at": row[5] or None,
+        "category": row[6]
+    }
+
+class Subscriber:
+    """変更を受け取る購読者（イベントループごとのasyncio.Queue）"""
+
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        # 受け取りが追いつかず変更を取りこぼした
+        self.overflowed = False
+
+    def _put(self, change: Dict):
+        try:
+            self.queue.put_nowait(change)
+        except asyncio.QueueFull:
+            self.overflowed = True
+
+    def _overflow(self):
+        self.overflowed = True
+
+class ChangeFeed:
+    """材料・レシピの変更（差分）をバージョン番号付きで配信するフィード
+
+    書き込みのたびに行単位の upsert / delete を共有ストアのログに追記する。バージョンは
+    ログの連番で、全ワーカーで共通の番号になる（直近のcapacity件だけ保持する）。
+    クライアントは最後に受け取ったバージョンからの差分だけを受け取ればよく、
+    書き込みのたびに一覧全体を取り直す必要がない。購読者には、他のワーカーの変更も含めて
+    ログを順に読んで送る（購読者がいる間だけ、CHANGE_FEED_POLL_INTERVALごとに確認する）。
+    upsert・deleteはIDに対して冪等なので、同じ変更を二度適用しても結果は変わらない。
+    """
+
+    def __init__(self, capacity: int = FEED_CAPACITY, stream: str = "changes"):
+        self.capacity = capacity
+        self.stream = stream
+        self._subscribers: List[Subscriber] = []
+        self._lock = threading.Lock()
+        # このプロセスの購読者に送り終えたバージョン（購読者がいない間はNone）
+        self._delivered: Optional[int] = None
+        self._delivering = threading.Lock()
+        self._tail: Optional[threading.Thread] = None
+
+    @property
+    def version(self) -> int:
+        """最新のバージョン（全ワーカーで共通）"""
+        return store.log_head(self.stream)
+
+    def publish(self, table: str, upserts: Sequence[Sequence] = (), deletes: Sequence[int] = ()) -> int:
+        """行の追加・更新（upserts）と削除（deletes）を記録し、購読者に送る"""
+        changes = []
+        for row in upserts:
+            record = row_to_record(table, row)
+            changes.append({"table": table, "op": "upsert", "id": record["id"], "record": record})
+        for record_id in deletes:
+            changes.append({"table": table, "op": "delete", "id": int(record_id), "record": None})
+        if not changes:
+            return self.version
+        versions = store.append_log(self.stream, [orjson.dumps(change) for change in changes], self.capacity)
+        # このワーカーの購読者にはすぐに送る（他のワーカーの購読者は次の確認で受け取る）
+        self._deliver()
+        return versions[-1]
+
+    def since(self, version: int) -> Optional[List[Dict]]:
+        """指定バージョンより後の変更を返す（保持範囲より古い場合はNone）"""
+        head = self.version
+        # サーバーの再起動前のバージョンも取り直しが必要
+        if version > head:
+            return None
+        if version == head:
+            return []
+        entries = store.read_log(self.stream, version)
+        if not entries or entries[0][0] != version + 1:
+            return None
+        return [{"version": number, **orjson.loads(value)} for number, value in entries]
+
+    def _deliver(self):
+        """ログのうち、このプロセスの購読者にまだ送っていない変更を送る"""
+        with self._delivering:
+            with self._lock:
+                subscribers = list(self._subscribers)
+                delivered = self._delivered
+            if not subscribers or delivered is None:
+                return
+            changes = self.since(delivered)
+            if changes is None:
+                # 確認が追いつかず保持範囲から外れたので、購読者に取り直しを促す
+                for subscriber in subscribers:
+                    subscriber.loop.call_soon_threadsafe(subscriber._overflow)
+                delivered = self.version
+            elif changes:
+                for subscriber in subscribers:
+                    for change in changes:
+                        # 書き込みはスレッドプールからも呼ばれるため、購読者のループに渡す
+                        subscriber.loop.call_soon_threadsafe(subscriber._put, change)
+                delivered = changes[-1]["version"]
+            with self._lock:
+                if self._delivered is not None:
+                    self._delivered = delivered
+
+    def _poll(self):
+        """購読者がいる間、他のワーカーが記録した変更を確認して送る"""
+        while True:
+            time.sleep(CHANGE_FEED_POLL_INTERVAL)
+            with self._lock:
+                if not self._subscribers:
+                    self._tail = None
+                    return
+            try:
+                self._deliver()
+            except Exception as e:
+                logger.warning("変更のログを読めませんでした: %s", e)
+
+    def subscribe(self) -> Subscriber:
+        """現在のイベントループで変更を受け取る購読者を登録する（登録後の変更を受け取る）"""
+        subscriber = Subscriber(asyncio.get_running_loop())
+        version = self.version
+        with self._lock:
+            if self._delivered is None:
+                self._delivered = version
+            self._subscribers.append(subscriber)
+            if self._tail is None:
+                self._tail = threading.Thread(target=self._poll, name="change-feed", daemon=True)
+                self._tail.start()
+        return subscriber
+
+    def unsubscribe(self, subscriber: Subscriber):
+        with self._lock:
+            if subscriber in self._subscribers:
+                self._subscribers.remove(subscriber)
+            if not self._subscribers:
+                self._delivered = None
+
+change_feed = ChangeFeed()
@@ -0,0 +1,174 @@
+import os
+from datetime import datetime
+from typing import Dict, List, Optional
+
+import orjson
+
+from ..utils.sheets import read_sheet, batch_update_sheet
+from ..utils.shared_store import store
+from ..utils.units import to_canonical
+from .change_feed import change_feed
+from .expiry_index import expiry_index
+from .recipe_matcher import (
+    INGREDIENT_COLUMNS,
+    RECIPE_COLUMNS,
+    name_key,
+    pad_row,
+    parse_recipe_ingredients
+)
+
+# 同じレシピの調理が並行して二重に適用されないように、両方のシートの書き込みをワーカー間で排他する
+# （読んだ行番号で書き込むため、その間に他のワーカーが行を動かさないようにもする）
+COOK_LOCKS = ("table:Ingredients", "table:Recipes")
+# 調理の冪等キーを覚えておく秒数（この間の同じキーでの再送は在庫を二重に減らさない）
+COOK_IDEMPOTENCY_TTL = float(os.getenv("COOK_IDEMPOTENCY_TTL", "86400"))
+
+def _to_local_naive(value: datetime) -> datetime:
+    """タイムゾーン付きの日時をシートと同じローカル時刻（naive）に揃える"""
+    if value.tzinfo is not None:
+        return value.astimezone().replace(tzinfo=None)
+    return value
+
+def find_recipe_row(recipe_rows: List[List], recipe_id: Optional[int] = None, name: Optional[str] = None) -> Optional[int]:
+    """レシピ行のインデックスをIDまたは名前で検索する"""
+    key = name_key(name) if name else None
+    for i, row in enumerate(recipe_rows):
+        row = pad_row(row, RECIPE_COLUMNS)
+        if recipe_id is not None and row[0] and str(row[0]) == str(recipe_id):
+            return i
+        if key and name_key(row[1]) == key:
+            return i
+    return None
+
+def plan_consumption(
+    recipe_row: List,
+    ingredient_rows: List[List],
+    servings: Optional[int] = None
+) -> Dict:
+    """レシピを作るときの在庫の減算内容を計算する
+
+    在庫の数量とレシピの分量はまとめて基準単位に変換し、同じ材料が複数行ある場合は
+    消費期限の近い行から順に減らす。戻り値のupdatesは (行インデックス, 更新後の行) のリスト。
+    """
+    recipe_row = pad_row(recipe_row, RECIPE_COLUMNS)
+    recipe_servings = max(int(float(recipe_row[3] or 1)), 1)
+    servings = servings or recipe_servings
+    scale = servings / recipe_servings
+
+    ingredients = parse_recipe_ingredients(recipe_row[2])
+    needs, need_units = to_canonical(
+        [ing["quantity"] * scale for ing in ingredients],
+        [ing["unit"] for ing in ingredients],
+        names=[ing["name"] for ing in ingredients]
+    )
+
+    rows = [pad_row(row, INGREDIENT_COLUMNS) for row in ingredient_rows]
+    quantities = []
+    for row in rows:
+        try:
+            quantities.append(float(row[2] or 0))
+        except ValueError:
+            quantities.append(0.0)
+    stock, stock_units = to_canonical(quantities, [row[3] for row in rows], names=[row[1] for row in rows])
+
+    # 材料名ごとの在庫行（消費期限の近い順、期限なしは最後）
+    rows_by_name: Dict[str, List[int]] = {}
+    for i, row in enumerate(rows):
+        rows_by_name.setdefault(name_key(row[1]), []).append(i)
+    for indexes in rows_by_name.values():
+        indexes.sort(key=lambda i: rows[i][4] or "9999")
+
+    remaining = stock.copy()
+    consumed = []
+    missing = []
+    for ing, need, unit in zip(ingredients, needs.tolist(), need_units.tolist()):
+        if need <= 0:
+            # 「少々」「適量」など分量のない材料は在庫を減らさない
+            continue
+        left = need
+        # 在庫を減らすため、入力の誤りは許さず表記ゆれ（name_key）だけを吸収して対応付ける
+        for i in rows_by_name.get(name_key(ing["name"]), []):
+            if stock_units[i] != unit or remaining[i] <= 0:
+                continue
+            used = min(remaining[i], left)
+            remaining[i] -= used
+            left -= used
+            if left <= 0:
+                break
+        if need - left > 0:
+            consumed.append({"name": ing["name"], "quantity": round(need - left, 4), "unit": unit})
+        if left > 0:
+            missing.append({"name": ing["name"], "quantity": round(left, 4), "unit": unit})
+
+    updates = []
+    for i, row in enumerate(rows):
+        if remaining[i] == stock[i]:
+            continue
+        # 基準単位で計算した残量を行の単位に戻す
+        factor = stock[i] / quantities[i]
+        updated = list(row)
+        updated[2] = str(round(float(remaining[i] / factor), 4))
+        updates.append((i, updated))
+
+    return {
+        "servings": servings,
+        "updates": updates,
+        "consumed": consumed,
+        "missing": missing
+    }
+
+def cook_recipe(
+    spreadsheet_id: str,
+    recipe_id: Optional[int] = None,
+    name: Optional[str] = None,
+    servings: Optional[int] = None,
+    cooked_at: Optional[datetime] = None,
+    idempotency_key: Optional[str] = None
+) -> Optional[Dict]:
+    """レシピを調理済みにし、使った材料を在庫からまとめて減らす
+
+    在庫の減算とlast_cookedの更新は1回のbatchUpdateで書き込む。
+    idempotency_keyを指定した場合は、同じキー・同じレシピで適用済みの調理を共有ストアに記録し、
+    再試行では在庫を減らさずに記録した結果（appliedはFalse）を返す。
+    レシピが見つからない場合はNoneを返す。
+    """
+    cooked_at = _to_local_naive(cooked_at or datetime.now()).replace(microsecond=0)
+
+    with store.lock(COOK_LOCKS[0]), store.lock(COOK_LOCKS[1]):
+        recipe_rows = read_sheet(spreadsheet_id, "Recipes!A2:G")
+        index = find_recipe_row(recipe_rows, recipe_id=recipe_id, name=name)
+        if index is None:
+            return None
+        recipe_row = pad_row(recipe_rows[index], RECIPE_COLUMNS)
+        result = {
+            "recipe_id": int(recipe_row[0]) if recipe_row[0] else None,
+            "name": recipe_row[1],
+            "cooked_at": cooked_at,
+        }
+
+        key = f"cook:{idempotency_key}:{recipe_row[0]}" if idempotency_key else None
+        if key:
+            applied = store.get(key)
+            if applied is not None:
+                return {**orjson.loads(applied), "applied": False}
+
+        ingredient_rows = read_sheet(spreadsheet_id, "Ingredients!A2:G")
+        plan = plan_consumption(recipe_row, ingredient_rows, servings)
+
+        timestamp = cooked_at.strftime("%Y-%m-%d %H:%M:%S")
+        data = []
+        for i, row in plan["updates"]:
+            row[5] = timestamp
+            data.append((f"Ingredients!A{i+2}:G{i+2}", [row]))
+        data.append((f"Recipes!G{index+2}", [[timestamp]]))
+        batch_update_sheet(spreadsheet_id, data)
+        for _, row in plan["updates"]:
+            expiry_index.upsert_row(row)
+        recipe_row[6] = timestamp
+        change_feed.publish("Ingredients", upserts=[row for _, row in plan["updates"]])
+        change_feed.publish("Recipes", upserts=[recipe_row])
+
+        result.update(servings=plan["servings"], applied=True, consumed=plan["consumed"], missing=plan["missing"])
+        if key:
+            store.set(key, orjson.dumps(result), ttl=COOK_IDEMPOTENCY_TTL)
+        return result
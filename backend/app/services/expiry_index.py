@@ -0,0 +1,234 @@
+import asyncio
+import bisect
+import os
+import re
+import threading
+import unicodedata
+from datetime import date, datetime, timedelta
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from ..utils.log import get_logger
+from .recipe_matcher import INGREDIENT_COLUMNS, pad_row
+
+logger = get_logger(__name__)
+
+# カテゴリーごとの消費期限の目安（日数）
+DEFAULT_SHELF_LIFE_DAYS = {
+    "肉類": 3,
+    "魚介類": 2,
+    "野菜類": 7,
+    "果物類": 7,
+    "乳製品": 7,
+    "調味料": 180,
+    "その他": 30
+}
+
+# 消費期限が近い材料として問い合わせられる日数の上限
+MAX_EXPIRY_DAYS = 365
+
+# 相対的な日付の表現
+RELATIVE_DAYS = {
+    "今日": 0,
+    "きょう": 0,
+    "明日": 1,
+    "あした": 1,
+    "明後日": 2,
+    "あさって": 2
+}
+
+_PERIOD_UNITS = {
+    "日": 1,
+    "週": 7,
+    "週間": 7,
+    "ヶ月": 30,
+    "ケ月": 30,
+    "か月": 30,
+    "カ月": 30
+}
+
+_MONTH_DAY_PATTERN = re.compile(r"(\d{1,2})(?:/|月)(\d{1,2})日?")
+_PERIOD_PATTERN = re.compile(r"(\d+)\s*(週間|ヶ月|ケ月|か月|カ月|日|週)")
+
+def parse_expiry(value, today: Optional[date] = None) -> Optional[date]:
+    """「2024-05-01」「5/1」「3日後」「明日」のような消費期限の表現を日付に変換する"""
+    today = today or date.today()
+    if value is None or value == "":
+        return None
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    if isinstance(value, (int, float)):
+        return today + timedelta(days=int(value))
+
+    text = unicodedata.normalize("NFKC", str(value)).strip()
+    for fmt in ("%Y-%m-%d", "%Y/%m/%d", "%Y.%m.%d", "%Y年%m月%d日"):
+        try:
+            return datetime.strptime(text, fmt).date()
+        except ValueError:
+            pass
+    try:
+        return datetime.fromisoformat(text).date()
+    except ValueError:
+        pass
+
+    for word, days in RELATIVE_DAYS.items():
+        if text.startswith(word):
+            return today + timedelta(days=days)
+
+    match = _MONTH_DAY_PATTERN.fullmatch(text)
+    if match:
+        try:
+            candidate = date(today.year, int(match.group(1)), int(match.group(2)))
+        except ValueError:
+            return None
+        # 過ぎた日付は翌年とみなす
+        if candidate < today - timedelta(days=30):
+            candidate = candidate.replace(year=today.year + 1)
+        return candidate
+
+    match = _PERIOD_PATTERN.search(text)
+    if match:
+        return today + timedelta(days=int(match.group(1)) * _PERIOD_UNITS[match.group(2)])
+    return None
+
+def default_expiry(category: str, today: Optional[date] = None) -> Optional[date]:
+    """カテゴリーから消費期限の目安を求める"""
+    days = DEFAULT_SHELF_LIFE_DAYS.get(category)
+    if days is None:
+        return None
+    return (today or date.today()) + timedelta(days=days)
+
+class ExpiryIndex:
+    """消費期限の昇順に並べた材料のインデックス
+
+    (消費期限, 材料ID) の組をソート済みリストで保持し、材料の追加・更新・削除の
+    たびに二分探索で差分だけ反映する。期限が近い材料の問い合わせは
+    シートを読み直さずに先頭からの範囲取得で済む。
+    """
+
+    def __init__(self, horizon_days: int = 3):
+        self.horizon_days = horizon_days
+        self._order: List[Tuple[date, int]] = []
+        self._items: Dict[int, Dict] = {}
+        self._lock = threading.Lock()
+        # スケジューラーが通知済みの範囲（この日付までの期限は通知済み）
+        self._alerted_until: Optional[date] = None
+        # 通知済みの範囲に後から追加された材料（次回の確認で通知する）
+        self._pending: Dict[int, date] = {}
+        self.alerts: List[Dict] = []
+        self.last_checked_at: Optional[datetime] = None
+
+    def __len__(self) -> int:
+        return len(self._order)
+
+    def load(self, ingredient_rows: Sequence[Sequence]):
+        """材料シートの行からインデックスを作り直す"""
+        with self._lock:
+            self._order = []
+            self._items = {}
+            self._alerted_until = None
+            self._pending = {}
+            for row in ingredient_rows:
+                self._upsert_row(row)
+
+    def upsert_row(self, row: Sequence):
+        """材料シートの1行分を追加または更新する"""
+        with self._lock:
+            self._upsert_row(row)
+
+    def remove(self, ingredient_id):
+        """材料をインデックスから取り除く"""
+        with self._lock:
+            self._remove(int(ingredient_id))
+
+    def _upsert_row(self, row: Sequence):
+        row = pad_row(row, INGREDIENT_COLUMNS)
+        try:
+            ingredient_id = int(row[0])
+        except (TypeError, ValueError):
+            return
+        self._remove(ingredient_id)
+
+        expiry_date = parse_expiry(row[4])
+        try:
+            quantity = float(row[2] or 0)
+        except ValueError:
+            quantity = 0.0
+        # 期限のない材料・使い切った材料は対象外
+        if expiry_date is None or quantity <= 0:
+            return
+
+        self._items[ingredient_id] = {
+            "id": ingredient_id,
+            "name": row[1],
+            "quantity": quantity,
+            "unit": row[3],
+            "category": row[6],
+            "expiry_date": expiry_date
+        }
+        bisect.insort(self._order, (expiry_date, ingredient_id))
+        if self._alerted_until is not None and expiry_date <= self._alerted_until:
+            self._pending[ingredient_id] = expiry_date
+
+    def _remove(self, ingredient_id: int):
+        self._pending.pop(ingredient_id, None)
+        item = self._items.pop(ingredient_id, None)
+        if item is None:
+            return
+        key = (item["expiry_date"], ingredient_id)
+        position = bisect.bisect_left(self._order, key)
+        if position < len(self._order) and self._order[position] == key:
+            del self._order[position]
+
+    def upcoming(self, days: Optional[int] = None, today: Optional[date] = None) -> List[Dict]:
+        """指定日数以内に期限を迎える材料を期限の近い順に返す（期限切れを含む）"""
+        today = today or date.today()
+        days = self.horizon_days if days is None else days
+        limit = today + timedelta(days=days)
+        with self._lock:
+            end = bisect.bisect_right(self._order, (limit, float("inf")))
+            return [
+                {**self._items[ingredient_id], "days_left": (expiry_date - today).days}
+                for expiry_date, ingredient_id in self._order[:end]
+            ]
+
+    def advance(self, today: Optional[date] = None) -> List[Dict]:
+        """前回の確認以降に通知範囲へ入った材料を求める
+
+        通知済みの日付以降からの範囲だけを二分探索で取り出すため、
+        定期実行のたびに全件を走査しない。
+        """
+        today = today or date.today()
+        limit = today + timedelta(days=self.horizon_days)
+        with self._lock:
+            start = 0
+            if self._alerted_until is not None:
+                start = bisect.bisect_right(self._order, (self._alerted_until, float("inf")))
+            end = bisect.bisect_right(self._order, (limit, float("inf")))
+            entries = sorted((expiry_date, ingredient_id) for ingredient_id, expiry_date in self._pending.items())
+            new_alerts = [
+                {**self._items[ingredient_id], "days_left": (expiry_date - today).days}
+                for expiry_date, ingredient_id in entries + self._order[start:end]
+            ]
+            self._pending = {}
+            self._alerted_until = limit
+            self.alerts = new_alerts
+            self.last_checked_at = datetime.now()
+            return new_alerts
+
+expiry_index = ExpiryIndex(horizon_days=int(os.getenv("EXPIRY_ALERT_DAYS", "3")))
+
+async def run_expiry_scheduler(interval_seconds: float = 3600):
+    """期限が近づいた材料を定期的に確認するバックグラウンドタスク"""
+    while True:
+        alerts = expiry_index.advance()
+        for item in alerts:
+            logger.info(
+                "消費期限が近い材料: %s（%s、あと%d日）",
+                item["name"],
+                item["expiry_date"],
+                item["days_left"],
+                extra={"ingredient_id": item["id"]}
+            )
+        await asyncio.sleep(interval_seconds)
@@ -1,13 +1,83 @@
-from openai import OpenAI
 import os
 import json
+import threading
 from datetime import datetime, timedelta
 import requests
 from bs4 import BeautifulSoup
 from typing import Dict, List, Optional
+from ..utils.log import get_logger
+from ..utils.metrics import (
+    OPENAI_LATENCY,
+    OPENAI_REQUESTS,
+    OPENAI_TOKENS,
+    OPENAI_TOKENS_PER_CALL,
+    RECIPE_FETCH_BYTES,
+    RECIPE_FETCH_LATENCY,
+    RECIPE_PARSE_LATENCY,
+    site_of
+)
+from ..utils.resilience import THROTTLED, UNAVAILABLE, CircuitBreaker, ServiceUnavailable, call_with_retries, remaining
+from ..utils.shared_store import OPENAI_RATE_LIMIT
+from ..utils.single_flight import SingleFlight
+from ..utils.tracing import span
 
-# OpenAIクライアントの初期化
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+logger = get_logger(__name__)
+
+# OpenAIクライアント（最初の呼び出しで作成する）
+_client = None
+_client_lock = threading.Lock()
+
+def get_openai_client():
+    """OpenAIのクライアントを取得する（importに時間がかかるため起動時には読み込まない）"""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                from openai import OpenAI
+                # 再試行はcall_with_retriesで行う
+                _client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"), max_retries=0)
+    return _client
+
+# OpenAIの1回の呼び出しのタイムアウト（秒、リクエストの締め切りが近ければそちらを優先する）
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", "60"))
+
+OPENAI_BREAKER = CircuitBreaker(
+    "openai",
+    failure_threshold=int(os.getenv("OPENAI_BREAKER_THRESHOLD", "5")),
+    reset_timeout=float(os.getenv("OPENAI_BREAKER_RESET_SECONDS", "30"))
+)
+
+def classify_openai_error(error: Exception):
+    """OpenAIの例外を再試行の判断に使う種類に分ける"""
+    from openai import APIConnectionError, APIStatusError
+
+    if isinstance(error, APIStatusError):
+        if error.status_code == 429:
+            # 利用枠の不足は待っても回復しない
+            if getattr(error, "code", None) == "insufficient_quota":
+                return None, None
+            retry_after = error.response.headers.get("retry-after")
+            try:
+                return THROTTLED, float(retry_after) if retry_after else None
+            except ValueError:
+                return THROTTLED, None
+        if error.status_code >= 500:
+            return UNAVAILABLE, None
+        return None, None
+    if isinstance(error, APIConnectionError):
+        # APITimeoutErrorを含む
+        return UNAVAILABLE, None
+    return None, None
+
+def create_chat_completion(**kwargs):
+    """チャットの補完を再試行・サーキットブレーカーつきで呼び出す"""
+    def attempt():
+        OPENAI_RATE_LIMIT.acquire()
+        left = remaining()
+        timeout = OPENAI_TIMEOUT if left is None else max(min(OPENAI_TIMEOUT, left), 0.1)
+        return get_openai_client().chat.completions.create(timeout=timeout, **kwargs)
+
+    return call_with_retries(attempt, breaker=OPENAI_BREAKER, classify=classify_openai_error)
 
 SYSTEM_PROMPT = """あなたは料理のアシスタントです。以下のアクションを実行できます：
 
@@ -19,6 +89,9 @@ SYSTEM_PROMPT = """あなたは料理のアシスタントです。以下のア
    - カテゴリ別の材料一覧（例：肉類、野菜類など）
 5. レシピの検索（search_recipes）
 6. レシピの追加（add_recipe）
+7. 今ある材料で作れるレシピの提案（suggest_recipes）
+8. レシピの調理（cook_recipe）: 使った材料を在庫からまとめて減らす
+9. 消費期限が近い材料の表示（list_expiring）
 
 各アクションは以下のJSON形式で返してください：
 
@@ -55,7 +128,8 @@ SYSTEM_PROMPT = """あなたは料理のアシスタントです。以下のア
             "name": "豚肉",
             "quantity": 300,
             "unit": "g",
-            "category": "肉類"
+            "category": "肉類",
+            "expiry_date": "2024-05-01"
         }
     }
 }
@@ -89,7 +163,7 @@ SYSTEM_PROMPT = """あなたは料理のアシスタントです。以下のア
 }
 ```
 
-6. レシピの検索:
+6. レシピの検索（queryには料理名・材料名のほか、「さっぱりした夏の副菜」のような説明もそのまま指定できます）:
 ```json
 {
     "message": "レシピの検索結果です。",
@@ -119,7 +193,68 @@ SYSTEM_PROMPT = """あなたは料理のアシスタントです。以下のア
 }
 ```
 
-8. エラーの場合:
+8. 今ある材料で作れるレシピの提案:
+```json
+{
+    "message": "今ある材料で作れるレシピの候補です。",
+    "action": {
+        "type": "suggest_recipes",
+        "data": {
+            "servings": 2
+        }
+    }
+}
+```
+
+9. レシピの調理（材料の在庫を減らす）:
+```json
+{
+    "message": "カレーライスを作りました。",
+    "action": {
+        "type": "cook_recipe",
+        "data": {
+            "name": "カレーライス",
+            "servings": 4
+        }
+    }
+}
+```
+
+10. 消費期限が近い材料の表示:
+```json
+{
+    "message": "消費期限が近い材料です。",
+    "action": {
+        "type": "list_expiring",
+        "data": {
+            "days": 3
+        }
+    }
+}
+```
+
+11. 複数の操作をまとめて行う場合（例：「豚肉と玉ねぎとにんじんを追加して」）:
+```json
+{
+    "message": "材料を追加しました。",
+    "actions": [
+        {
+            "type": "add_ingredient",
+            "data": {"name": "豚肉", "quantity": 300, "unit": "g", "category": "肉類"}
+        },
+        {
+            "type": "add_ingredient",
+            "data": {"name": "玉ねぎ", "quantity": 2, "unit": "個", "category": "野菜類"}
+        },
+        {
+            "type": "add_ingredient",
+            "data": {"name": "にんじん", "quantity": 1, "unit": "本", "category": "野菜類"}
+        }
+    ]
+}
+```
+
+12. エラーの場合:
 ```json
 {
     "message": "エラーメッセージ",
@@ -141,10 +276,20 @@ SYSTEM_PROMPT = """あなたは料理のアシスタントです。以下のア
 - 調味料
 - その他
 
+材料の追加で消費期限が指定された場合は expiry_date に YYYY-MM-DD 形式、または「3日後」「明日」のような表現で含めてください。指定がない場合は expiry_date を省略してください。
+
+1回の発言に複数の材料や操作が含まれる場合は、"action" の代わりに "actions" の配列ですべての操作を返してください。
+
 ユーザーの要求に応じて、適切なアクションを選択し、JSON形式で返してください。"""
 
+# 同じURLの同時の取得をまとめる
+_recipe_fetches = SingleFlight("recipe_fetch")
+
 def extract_recipe_info(url: str) -> Dict:
-    """URLからレシピ情報を抽出する"""
+    """URLからレシピ情報を抽出する（同じURLの同時の取得は1回にまとめる）"""
+    return _recipe_fetches.do(url, lambda: _extract_recipe_info(url))
+
+def _extract_recipe_info(url: str) -> Dict:
     try:
         # User-Agentを設定してブロックを回避
         headers = {
@@ -152,22 +297,29 @@ def extract_recipe_info(url: str) -> Dict:
         }
         
         # URLからHTMLを取得
-        response = requests.get(url, headers=headers)
-        response.raise_for_status()
-        soup = BeautifulSoup(response.text, 'html.parser')
+        site = site_of(url)
+        with span("recipe.fetch", kind="CLIENT", **{"url.full": url}) as current, \
+                RECIPE_FETCH_LATENCY.time(site=site):
+            response = requests.get(url, headers=headers)
+            RECIPE_FETCH_BYTES.observe(len(response.content), site=site)
+            current.set_attribute("http.status_code", response.status_code)
+            current.set_attribute("http.response.body.size", len(response.content))
+            response.raise_for_status()
         
         # サイトごとの処理
-        if "cookpad.com" in url:
-            return extract_cookpad_recipe(soup, url)
-        elif "kurashiru.com" in url:
-            return extract_kurashiru_recipe(soup, url)
-        elif "delishkitchen.tv" in url:
-            return extract_delishkitchen_recipe(soup, url)
-        else:
-            return {
-                "error": "未対応のレシピサイトです",
-                "url": url
-            }
+        with span("recipe.parse", **{"url.full": url}), RECIPE_PARSE_LATENCY.time(site=site):
+            soup = BeautifulSoup(response.text, 'html.parser')
+            if "cookpad.com" in url:
+                return extract_cookpad_recipe(soup, url)
+            elif "kurashiru.com" in url:
+                return extract_kurashiru_recipe(soup, url)
+            elif "delishkitchen.tv" in url:
+                return extract_delishkitchen_recipe(soup, url)
+            else:
+                return {
+                    "error": "未対応のレシピサイトです",
+                    "url": url
+                }
     
     except Exception as e:
         return {
@@ -341,12 +493,29 @@ def get_llm_response(messages: list) -> dict:
             *messages
         ]
         
-        response = client.chat.completions.create(
-            model="gpt-4-turbo-preview",
-            messages=messages_with_system,
-            temperature=0.7,
-            max_tokens=1000
-        )
+        model = "gpt-4-turbo-preview"
+        with span(
+            "llm.chat.completions",
+            kind="CLIENT",
+            **{"gen_ai.request.model": model, "gen_ai.request.messages": len(messages_with_system)}
+        ) as current, OPENAI_LATENCY.time(model=model):
+            try:
+                response = create_chat_completion(
+                    model=model,
+                    messages=messages_with_system,
+                    temperature=0.7,
+                    max_tokens=1000
+                )
+            except Exception:
+                OPENAI_REQUESTS.inc(model=model, status="error")
+                raise
+            OPENAI_REQUESTS.inc(model=model, status="ok")
+            if response.usage is not None:
+                current.set_attribute("gen_ai.usage.input_tokens", response.usage.prompt_tokens)
+                current.set_attribute("gen_ai.usage.output_tokens", response.usage.completion_tokens)
+                for token_type, count in (("prompt", response.usage.prompt_tokens), ("completion", response.usage.completion_tokens)):
+                    OPENAI_TOKENS.inc(count, model=model, type=token_type)
+                    OPENAI_TOKENS_PER_CALL.observe(count, model=model, type=token_type)
         
         # レスポンスをJSONとしてパース
         try:
@@ -358,8 +527,12 @@ def get_llm_response(messages: list) -> dict:
                 "message": response.choices[0].message.content
             }
     
-    except Exception as e:
+    except ServiceUnavailable:
+        # 回路が開いている・期限切れ・レート制限は503とRetry-Afterで返す
+        raise
+    except Exception:
+        logger.exception("LLMの応答の取得中にエラーが発生しました")
         return {
             "action": "error",
-            "message": str(e)
+            "message": "応答の生成中にエラーが発生しました。しばらくしてからもう一度お試しください。"
         } 
\ No newline at end of file
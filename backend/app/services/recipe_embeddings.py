@@ -0,0 +1,464 @@
+import functools
+import hashlib
+import json
+import os
+import shutil
+import threading
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from ..utils.log import get_logger
+from ..utils.metrics import CACHE_REQUESTS
+from ..utils.names import normalize_name
+from .recipe_matcher import RECIPE_COLUMNS, pad_row, parse_recipe_ingredients
+from .record_store import record_store
+
+try:
+    import fcntl
+except ImportError:  # Windowsではプロセス間のロックを使わない
+    fcntl = None
+
+logger = get_logger(__name__)
+
+# レシピの埋め込みを保存するディレクトリ（再起動後は学習し直さずに読み込む）
+EMBEDDINGS_DIR = os.getenv(
+    "EMBEDDINGS_DIR",
+    os.path.join(os.path.dirname(__file__), "..", "..", ".embeddings")
+)
+# 埋め込みの次元数
+EMBEDDING_DIMENSIONS = int(os.getenv("EMBEDDING_DIMENSIONS", "128"))
+# 学習後に追加・更新したレシピが学習時の件数のこの割合を超えたら学習し直す
+EMBEDDING_REFIT_RATIO = float(os.getenv("EMBEDDING_REFIT_RATIO", "0.2"))
+# 意味検索で返すレシピの類似度（コサイン）の下限
+SEMANTIC_MIN_SCORE = float(os.getenv("SEMANTIC_MIN_SCORE", "0.1"))
+
+# 疎行列の積で一度に処理する要素数（一時配列の大きさを抑える）
+_CHUNK = 20000
+
+@functools.lru_cache(maxsize=65536)
+def _word_terms(word: str) -> Tuple[str, ...]:
+    key = normalize_name(word)
+    if not key:
+        return ()
+    return (key, *(key[i:i + n] for n in (2, 3) for i in range(len(key) - n + 1)))
+
+def _terms(text: str) -> List[str]:
+    """文章の特徴語（照合用の表記の文字2-gramと3-gram。空白・読点で区切った語はそれ自体も加える）"""
+    terms = []
+    for word in text.replace("、", " ").replace(",", " ").split():
+        terms.extend(_word_terms(word))
+    return terms
+
+def recipe_text(name: str, ingredient_names: Iterable[str], category: str) -> str:
+    """埋め込みを求めるレシピの文章（レシピ名・材料名・カテゴリー）"""
+    return " ".join([name, *ingredient_names, category or ""])
+
+def documents_from_rows(rows: Sequence[Sequence]) -> Dict[int, str]:
+    """レシピシートの行から、レシピID -> 文章"""
+    documents = {}
+    for row in rows:
+        if not row or not row[0]:
+            continue
+        row = pad_row(row, RECIPE_COLUMNS)
+        names = [ing["name"] for ing in parse_recipe_ingredients(row[2])]
+        documents[int(row[0])] = recipe_text(row[1], names, row[5])
+    return documents
+
+def documents_from_table(table) -> Dict[int, str]:
+    """RecipeTableから、レシピID -> 文章"""
+    names = table.ingredient_names.values
+    categories = table.categories.values
+    codes = table.ingredient_name_codes.tolist()
+    offsets = table.offsets.tolist()
+    return {
+        record_id: recipe_text(name, (names[code] for code in codes[start:stop]), categories[category])
+        for record_id, name, category, start, stop in zip(
+            table.ids.tolist(), table.names, table.category_codes.tolist(), offsets, offsets[1:]
+        )
+    }
+
+def _digest(text: str) -> str:
+    return hashlib.sha1(text.encode()).hexdigest()[:16]
+
+def _sparse_dot(keys: np.ndarray, others: np.ndarray, weights: np.ndarray, matrix: np.ndarray, size: int) -> np.ndarray:
+    """疎行列（keysの昇順に並んだ要素 (key, other, weight)）と密行列matrixの積"""
+    out = np.zeros((size, matrix.shape[1]), dtype=np.float32)
+    for start in range(0, len(keys), _CHUNK):
+        chunk = keys[start:start + _CHUNK]
+        products = weights[start:start + _CHUNK, None] * matrix[others[start:start + _CHUNK]]
+        boundaries = np.concatenate(([0], np.flatnonzero(np.diff(chunk)) + 1))
+        out[chunk[boundaries]] += np.add.reduceat(products, boundaries, axis=0)
+    return out
+
+class LatentModel:
+    """TF-IDFと特異値分解による文章の埋め込み（潜在意味解析）
+
+    文字n-gramのTF-IDF行列を乱択化SVDで次元削減し、よく一緒に現れる語を近い方向にまとめる。
+    学習後の文章（追加・更新したレシピや検索語）は学習した基底に射影する。
+    """
+
+    def __init__(self, vocabulary: Dict[str, int], idf: np.ndarray, components: np.ndarray):
+        self.vocabulary = vocabulary
+        self.idf = idf
+        self.components = components
+
+    @property
+    def dimensions(self) -> int:
+        return self.components.shape[1]
+
+    @staticmethod
+    def _weights(documents: Sequence[Sequence[str]], vocabulary: Dict[str, int]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """文章（語のリスト）ごとの語の出現回数を（行, 列, 1 + log(回数)）の配列にする（語彙にない語は除く）"""
+        rows: List[int] = []
+        columns: List[int] = []
+        frequencies: List[float] = []
+        for row, terms in enumerate(documents):
+            counts: Dict[int, int] = {}
+            for term in terms:
+                column = vocabulary.get(term)
+                if column is not None:
+                    counts[column] = counts.get(column, 0) + 1
+            rows.extend([row] * len(counts))
+            columns.extend(counts)
+            frequencies.extend(counts.values())
+        return (
+            np.array(rows, dtype=np.int64),
+            np.array(columns, dtype=np.int64),
+            1 + np.log(np.array(frequencies, dtype=np.float32))
+        )
+
+    @staticmethod
+    def _normalize_rows(rows: np.ndarray, weights: np.ndarray, count: int) -> np.ndarray:
+        norms = np.sqrt(np.bincount(rows, weights=weights ** 2, minlength=count))
+        return (weights / np.maximum(norms[rows], 1e-12)).astype(np.float32)
+
+    @classmethod
+    def fit(cls, documents: Sequence[str], dimensions: int = EMBEDDING_DIMENSIONS, seed: int = 0) -> Tuple["LatentModel", np.ndarray]:
+        """文章から学習したモデルと、文章ごとの埋め込みを返す"""
+        documents = [_terms(text) for text in documents]
+        vocabulary: Dict[str, int] = {}
+        for terms in documents:
+            for term in terms:
+                vocabulary.setdefault(term, len(vocabulary))
+        rows, columns, weights = cls._weights(documents, vocabulary)
+        count = len(documents)
+        document_frequency = np.bincount(columns, minlength=len(vocabulary))
+        idf = (np.log((1 + count) / (1 + document_frequency)) + 1).astype(np.float32)
+        weights = cls._normalize_rows(rows, weights * idf[columns], count)
+
+        dimensions = max(1, min(dimensions, count, len(vocabulary)))
+        if not vocabulary:
+            return cls(vocabulary, idf, np.zeros((0, dimensions), dtype=np.float32)), np.zeros((count, dimensions), dtype=np.float32)
+        # 乱択化SVD（Halko et al.）: X @ Ω の値域を冪乗法で絞り込み、小さな行列の特異値分解で基底を求める
+        by_column = np.argsort(columns, kind="stable")
+        def dot(matrix):
+            return _sparse_dot(rows, columns, weights, matrix, count)
+        def dot_transposed(matrix):
+            return _sparse_dot(columns[by_column], rows[by_column], weights[by_column], matrix, len(vocabulary))
+        sample = min(dimensions + 10, count, len(vocabulary))
+        basis = dot(np.random.default_rng(seed).standard_normal((len(vocabulary), sample)).astype(np.float32))
+        for _ in range(2):
+            basis, _ = np.linalg.qr(basis)
+            basis, _ = np.linalg.qr(dot_transposed(basis))
+            basis = dot(basis)
+        basis, _ = np.linalg.qr(basis)
+        _, _, vt = np.linalg.svd(dot_transposed(basis).T, full_matrices=False)
+        model = cls(vocabulary, idf, np.ascontiguousarray(vt[:dimensions].T, dtype=np.float32))
+        return model, model._embed(rows, columns, weights, count)
+
+    def _embed(self, rows: np.ndarray, columns: np.ndarray, weights: np.ndarray, count: int) -> np.ndarray:
+        vectors = _sparse_dot(rows, columns, weights, self.components, count)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-12)
+
+    def unknown_ratio(self, text: str) -> float:
+        """文章の語のうち、語彙にないものの割合"""
+        terms = _terms(text)
+        return sum(term not in self.vocabulary for term in terms) / len(terms) if terms else 0.0
+
+    def transform(self, documents: Sequence[str]) -> np.ndarray:
+        """文章ごとの埋め込み（長さ1に正規化。語彙にない語だけの文章は0ベクトル）"""
+        count = len(documents)
+        rows, columns, weights = self._weights([_terms(text) for text in documents], self.vocabulary)
+        return self._embed(rows, columns, self._normalize_rows(rows, weights * self.idf[columns], count), count)
+
+class RecipeEmbeddings:
+    """1つのスプレッドシートのレシピの埋め込み
+
+    埋め込みはメモリマップしたファイル（行 = レシピ）に置き、ワーカーのヒープには載せない。
+    モデル・埋め込み・状態のファイルは世代ごとのディレクトリに1組で置き、ポインターのファイル（current）で切り替える。
+    シートの内容と照らし合わせ、追加・更新されたレシピだけを学習済みの基底に射影して書き込み、
+    削除されたレシピは検索の対象から外す。学習後に変わったレシピが増えたら全体を学習し直す。
+    検索は問い合わせの埋め込みとの内積（コサイン類似度）をまとめて求め、上位を返す。
+    """
+
+    def __init__(self, directory: str, name: str):
+        self.directory = directory
+        self.name = name
+        self.model: Optional[LatentModel] = None
+        self.matrix: Optional[np.memmap] = None
+        # 行 -> レシピID（削除された行は-1）
+        self.ids: List[int] = []
+        self.rows: Dict[int, int] = {}
+        self.digests: Dict[int, str] = {}
+        self.fitted = 0
+        self.folded = 0
+        # 読み込んだ（書き込んだ）ファイルの世代と、その世代での更新回数
+        self.generation = 0
+        self.revision = 0
+        self._source = None
+        self._lock = threading.Lock()
+        with self._exclusive():
+            self._load()
+
+    def _root(self) -> str:
+        return os.path.join(self.directory, self.name)
+
+    def _path(self, filename: str, generation: Optional[int] = None) -> str:
+        generation = self.generation if generation is None else generation
+        return os.path.join(self._root(), f"gen-{generation}", filename)
+
+    @contextmanager
+    def _exclusive(self) -> Iterator[None]:
+        """ワーカー間で埋め込みのファイルの読み込み・書き込みを排他する"""
+        os.makedirs(self._root(), exist_ok=True)
+        with open(os.path.join(self._root(), "lock"), "a") as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            yield
+
+    def _read_pointer(self) -> Optional[Tuple[int, int]]:
+        """現在の（世代, 更新回数）"""
+        try:
+            with open(os.path.join(self._root(), "current"), encoding="ascii") as f:
+                generation, revision = f.read().split()
+            return int(generation), int(revision)
+        except (OSError, ValueError):
+            return None
+
+    def _write_pointer(self):
+        """現在の世代を切り替える（モデル・埋め込み・状態のファイルは世代ごとに1組で入れ替わる）"""
+        path = os.path.join(self._root(), "current")
+        temp = f"{path}.{os.getpid()}.tmp"
+        with open(temp, "w", encoding="ascii") as f:
+            f.write(f"{self.generation} {self.revision}")
+        os.replace(temp, path)
+        for entry in os.listdir(self._root()):
+            # 古い世代を消す（メモリマップ中の他のワーカーは、次に読み直すまで消したファイルをそのまま使える）
+            if entry.startswith("gen-") and entry != f"gen-{self.generation}":
+                shutil.rmtree(os.path.join(self._root(), entry), ignore_errors=True)
+
+    def _start_generation(self) -> int:
+        """新しい世代のディレクトリを作り、前の世代を返す（ポインターを書き換えるまで他のワーカーからは見えない）"""
+        previous = self.generation
+        self.generation += 1
+        directory = os.path.dirname(self._path("state.json"))
+        shutil.rmtree(directory, ignore_errors=True)
+        os.makedirs(directory)
+        return previous
+
+    def _replace(self, filename: str, write):
+        """現在の世代のファイルを、一時ファイルに書いてから置き換える"""
+        path = self._path(filename)
+        temp = f"{path}.{os.getpid()}.tmp"
+        write(temp)
+        os.replace(temp, path)
+
+    def _load(self):
+        pointer = self._read_pointer()
+        if pointer is None:
+            return
+        generation = pointer[0]
+        try:
+            with np.load(self._path("model.npz", generation)) as saved:
+                terms = saved["terms"].tolist()
+                model = LatentModel(
+                    {term: i for i, term in enumerate(terms)}, saved["idf"], saved["components"]
+                )
+            with open(self._path("state.json", generation), encoding="utf-8") as f:
+                state = json.load(f)
+            matrix = np.memmap(self._path("vectors", generation), dtype=np.float32, mode="r+")
+            matrix = matrix.reshape(-1, model.dimensions)
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning("保存済みの埋め込みを読み込めませんでした: %s", e)
+            return
+        self.model, self.matrix = model, matrix
+        self.generation, self.revision = pointer
+        self.ids = state["ids"][:len(matrix)]
+        self.fitted, self.folded = state["fitted"], state["folded"]
+        self.rows = {record_id: row for row, record_id in enumerate(self.ids) if record_id >= 0}
+        self.digests = {int(record_id): digest for record_id, digest in state["digests"].items()}
+
+    def _save_state(self):
+        """現在の世代の状態を書き、ポインターを更新する（埋め込みの行は先に書き込んでおく）"""
+        self.revision += 1
+        state = {
+            "ids": self.ids,
+            "digests": {str(record_id): digest for record_id, digest in self.digests.items()},
+            "fitted": self.fitted,
+            "folded": self.folded
+        }
+        def write(path):
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump(state, f)
+        self._replace("state.json", write)
+        self._write_pointer()
+
+    def _allocate(self, capacity: int):
+        """容量capacity行のファイルを作り、これまでの行を写してメモリマップし直す"""
+        dimensions = self.model.dimensions
+        def write(path):
+            matrix = np.memmap(path, dtype=np.float32, mode="w+", shape=(max(capacity, 1), dimensions))
+            if self.matrix is not None and self.matrix.shape[1] == dimensions:
+                matrix[:len(self.ids)] = self.matrix[:len(self.ids)]
+            matrix.flush()
+        self._replace("vectors", write)
+        self.matrix = np.memmap(self._path("vectors"), dtype=np.float32, mode="r+").reshape(-1, dimensions)
+
+    def _fit(self, documents: Dict[int, str]):
+        record_ids = list(documents)
+        texts = [documents[record_id] for record_id in record_ids]
+        self.model, vectors = LatentModel.fit(texts)
+        self._start_generation()
+        terms = np.array(list(self.model.vocabulary), dtype=str)
+        def write(path):
+            with open(path, "wb") as f:
+                np.savez(f, terms=terms, idf=self.model.idf, components=self.model.components)
+        self._replace("model.npz", write)
+        self.matrix = None
+        self.ids = []
+        self._allocate(len(record_ids) * 2)
+        self.matrix[:len(record_ids)] = vectors
+        self.matrix.flush()
+        self.ids = record_ids
+        self.rows = {record_id: row for row, record_id in enumerate(record_ids)}
+        self.digests = {record_id: _digest(text) for record_id, text in documents.items()}
+        self.fitted, self.folded = len(record_ids), 0
+        logger.info("レシピの埋め込みを学習しました", extra={"recipes": len(record_ids), "dimensions": self.model.dimensions})
+
+    def _fold(self, changed: Dict[int, str], removed: Sequence[int]):
+        for record_id in removed:
+            self.ids[self.rows.pop(record_id)] = -1
+            self.digests.pop(record_id, None)
+        new = [record_id for record_id in changed if record_id not in self.rows]
+        if len(self.ids) + len(new) > len(self.matrix):
+            # 大きくしたファイルは新しい世代に作る（モデルは前の世代と同じものを使う）
+            previous = self._start_generation()
+            try:
+                os.link(self._path("model.npz", previous), self._path("model.npz"))
+            except OSError:
+                shutil.copyfile(self._path("model.npz", previous), self._path("model.npz"))
+            self._allocate((len(self.ids) + len(new)) * 2)
+        for record_id in new:
+            self.rows[record_id] = len(self.ids)
+            self.ids.append(record_id)
+        if changed:
+            vectors = self.model.transform(list(changed.values()))
+            self.matrix[[self.rows[record_id] for record_id in changed]] = vectors
+            self.matrix.flush()
+        self.digests.update({record_id: _digest(text) for record_id, text in changed.items()})
+        self.folded += len(changed)
+
+    def sync(self, load_documents: Callable[[], Dict[int, str]], source=None):
+        """埋め込みをload_documents()が返すレシピID -> 文章にそろえる（sourceが前回と同じオブジェクトなら読まない）
+
+        ファイルの読み書きはワーカー間で排他し、他のワーカーが世代や状態を更新していれば読み直してから差分を求める。
+        """
+        if source is not None and source is self._source:
+            return
+        with self._exclusive():
+            pointer = self._read_pointer()
+            if pointer is not None and pointer != (self.generation, self.revision):
+                self._load()
+            documents = load_documents()
+            changed = {
+                record_id: text for record_id, text in documents.items()
+                if self.digests.get(record_id) != _digest(text)
+            }
+            removed = [record_id for record_id in self.rows if record_id not in documents]
+            if (
+                self.model is None
+                or self.folded + len(changed) > max(self.fitted, 1) * EMBEDDING_REFIT_RATIO
+                # 学習時になかった語が半分以上のレシピは、射影してもほとんど何も表せない
+                or any(self.model.unknown_ratio(text) >= 0.5 for text in changed.values())
+            ):
+                CACHE_REQUESTS.inc(cache="embeddings", result="miss")
+                self._fit(documents)
+                self._save_state()
+            elif changed or removed:
+                CACHE_REQUESTS.inc(cache="embeddings", result="miss")
+                self._fold(changed, removed)
+                self._save_state()
+            else:
+                CACHE_REQUESTS.inc(cache="embeddings", result="hit")
+        self._source = source
+
+    def search(
+        self,
+        load_documents: Callable[[], Dict[int, str]],
+        query: str,
+        limit: int = 10,
+        candidates: Optional[Iterable[int]] = None,
+        min_score: float = SEMANTIC_MIN_SCORE,
+        source=None
+    ) -> List[Tuple[int, float]]:
+        """queryに意味の近いレシピの (レシピID, 類似度) を類似度の高い順に返す（candidatesはレシピIDの絞り込み）"""
+        with self._lock:
+            self.sync(load_documents, source)
+            count = len(self.ids)
+            if not count or not self.model.vocabulary:
+                return []
+            scores = np.asarray(self.matrix[:count]) @ self.model.transform([query])[0]
+            ids = np.array(self.ids)
+        allowed = ids >= 0
+        if candidates is not None:
+            allowed &= np.isin(ids, np.fromiter(candidates, dtype=np.int64))
+        scores = np.where(allowed & (scores >= min_score), scores, -np.inf)
+        limit = min(limit, int(np.isfinite(scores).sum()))
+        if limit <= 0:
+            return []
+        top = np.argpartition(-scores, limit - 1)[:limit]
+        top = top[np.argsort(-scores[top])]
+        return [(int(ids[row]), float(scores[row])) for row in top]
+
+class EmbeddingStore:
+    """スプレッドシートごとのレシピの埋め込み"""
+
+    def __init__(self, directory: str = EMBEDDINGS_DIR):
+        self.directory = directory
+        self._indexes: Dict[str, RecipeEmbeddings] = {}
+        self._lock = threading.Lock()
+
+    def get(self, spreadsheet_id: str) -> RecipeEmbeddings:
+        with self._lock:
+            index = self._indexes.get(spreadsheet_id)
+            if index is None:
+                digest = hashlib.sha1(spreadsheet_id.encode()).hexdigest()[:12]
+                index = self._indexes[spreadsheet_id] = RecipeEmbeddings(self.directory, f"recipes-{digest}")
+            return index
+
+embedding_store = EmbeddingStore()
+
+def search_table(spreadsheet_id: str, table, query: str, limit: int = 10, positions: Optional[np.ndarray] = None) -> np.ndarray:
+    """RecipeTableのレシピのうち、queryに意味の近いものの位置を類似度の高い順に返す（positionsは対象の絞り込み）"""
+    candidates = None if positions is None else table.ids[positions].tolist()
+    ranked = embedding_store.get(spreadsheet_id).search(
+        lambda: documents_from_table(table), query, limit=limit, candidates=candidates, source=table
+    )
+    return np.searchsorted(table.ids, [record_id for record_id, _ in ranked]).astype(np.intp)
+
+def search_rows(spreadsheet_id: str, rows: Sequence[Sequence], query: str, limit: int = 10) -> List[Tuple[int, float]]:
+    """レシピシートの行のうち、queryに意味の近いものの (レシピID, 類似度) を類似度の高い順に返す
+
+    埋め込みはsearch_tableと同じく列ごとの配列（record_store）にそろえ、データバージョンが
+    変わらない限り照合し直さない。シートを読めない場合だけ渡された行（スナップショットなど）を使う。
+    """
+    index = embedding_store.get(spreadsheet_id)
+    try:
+        table = record_store.get(spreadsheet_id, "Recipes")
+    except Exception as e:
+        logger.warning("レシピシートを読めないため、渡された行で埋め込みを照合します: %s", e)
+        return index.search(lambda: documents_from_rows(rows), query, limit=limit)
+    return index.search(lambda: documents_from_table(table), query, limit=limit, source=table)
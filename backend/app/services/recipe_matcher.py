@@ -0,0 +1,277 @@
+import ast
+import heapq
+import json
+from typing import Dict, List, Optional, Sequence, Tuple
+from ..utils.metrics import CACHE_REQUESTS
+from ..utils.names import NameIndex, normalize_name
+from ..utils.units import aggregate_quantities, parse_quantity, to_canonical
+
+# Ingredientsシートの列数（id, name, quantity, unit, expiry_date, updated_at, category）
+INGREDIENT_COLUMNS = 7
+# Recipesシートの列数（id, name, ingredients, servings, url, category, last_cooked）
+RECIPE_COLUMNS = 7
+# レシピの提案で一度に返す件数の上限
+MAX_SUGGESTIONS = 100
+
+def pad_row(row: Sequence, width: int) -> List:
+    """末尾の空セルが省略された行を指定の列数まで埋める"""
+    row = list(row)
+    if len(row) < width:
+        row.extend([""] * (width - len(row)))
+    return row
+
+def name_key(name: str) -> str:
+    """材料名の照合用キーを作成する（全角/半角・カタカナ/ひらがな・漢字表記と読みの違いを吸収する）"""
+    return normalize_name(name or "")
+
+def parse_recipe_ingredients(cell: str) -> List[Dict]:
+    """レシピシートの材料セルを材料のリストに変換する"""
+    if not cell:
+        return []
+    try:
+        parsed = ast.literal_eval(cell)
+    except (ValueError, SyntaxError):
+        try:
+            parsed = json.loads(cell)
+        except json.JSONDecodeError:
+            # カンマ区切りの材料名のみの場合
+            parsed = [name for name in cell.split(",") if name.strip()]
+
+    ingredients = []
+    for item in parsed if isinstance(parsed, (list, tuple)) else []:
+        if isinstance(item, dict) and item.get("name"):
+            # 「1/2」「大さじ1」のような表記は分量の文字列から数量（と単位）を読み取る
+            quantity, unit = parse_quantity(item.get("quantity"), item.get("unit"))
+            ingredients.append({
+                "name": str(item["name"]).strip(),
+                "quantity": quantity or 0.0,
+                "unit": unit
+            })
+        elif isinstance(item, str) and item.strip():
+            # 分量のない材料名のみの形式（チャット経由で追加されたレシピなど）
+            ingredients.append({"name": item.strip(), "quantity": 0.0, "unit": ""})
+    return ingredients
+
+def _to_float(value, default: float = 0.0) -> float:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return default
+
+def build_pantry(ingredient_rows: Sequence[Sequence]) -> Dict[str, Dict[str, float]]:
+    """材料シートの行から在庫（材料名 -> {基準単位: 数量}）を作成する"""
+    keys, names, quantities, units = [], [], [], []
+    for row in ingredient_rows:
+        row = pad_row(row, INGREDIENT_COLUMNS)
+        key = name_key(row[1])
+        quantity = _to_float(row[2])
+        if not key or quantity <= 0:
+            continue
+        keys.append(key)
+        names.append(row[1])
+        quantities.append(quantity)
+        units.append(row[3])
+
+    pantry: Dict[str, Dict[str, float]] = {}
+    for (key, unit), total in aggregate_quantities(keys, quantities, units, names=names).items():
+        pantry.setdefault(key, {})[unit] = total
+    return pantry
+
+class RecipeIndex:
+    """レシピの必要材料をビットセットとして前計算したインデックス
+
+    各材料名にビット位置を割り当て、レシピごとに必要材料のビットマスクを保持する。
+    在庫側も同じ語彙でビットマスク化することで、材料の重なりをAND演算と
+    ビット数のカウントだけで求められる。
+    在庫の材料名が語彙にない場合は、入力の誤りとみなせる近い名前に対応付ける。
+    """
+
+    def __init__(self, recipe_rows: Sequence[Sequence]):
+        self.vocab: Dict[str, int] = {}
+        self.keys: List[str] = []
+        self.recipes: List[Dict] = []
+        self.masks: List[int] = []
+        # レシピごとの (ビット位置, 1人分の数量, 基準単位, 表示名, 重み)
+        # 同じ材料が比較できない単位で複数回出てくる場合は単位ごとに分け、重みで1材料分に按分する
+        self.requirements: List[List[Tuple[int, float, str, str, float]]] = []
+
+        # 全レシピの材料の分量をまとめて基準単位に変換する
+        parsed = []
+        names, quantities, units = [], [], []
+
+        for row in recipe_rows:
+            row = pad_row(row, RECIPE_COLUMNS)
+            if not row[1]:
+                continue
+            ingredients = parse_recipe_ingredients(row[2])
+            if not ingredients:
+                continue
+            parsed.append((row, ingredients))
+            for ing in ingredients:
+                names.append(ing["name"])
+                quantities.append(ing["quantity"])
+                units.append(ing["unit"])
+        values, canonical = to_canonical(quantities, units, names=names)
+
+        offset = 0
+        for row, ingredients in parsed:
+            servings = max(int(_to_float(row[3], 1)), 1)
+            mask = 0
+            requirements = []
+            positions: Dict[Tuple[int, str], int] = {}
+            counts: Dict[int, int] = {}
+            for ing, quantity, unit in zip(
+                ingredients,
+                values[offset:offset + len(ingredients)].tolist(),
+                canonical[offset:offset + len(ingredients)].tolist()
+            ):
+                key = name_key(ing["name"])
+                bit = self.vocab.get(key)
+                if bit is None:
+                    bit = self.vocab[key] = len(self.keys)
+                    self.keys.append(key)
+                per_serving = quantity / servings
+                position = positions.get((bit, unit))
+                if position is not None:
+                    # 同じ材料が同じ単位で複数回出てくる場合は数量を合算する
+                    b, q, u, n, w = requirements[position]
+                    requirements[position] = (b, q + per_serving, u, n, w)
+                    continue
+                mask |= 1 << bit
+                positions[bit, unit] = len(requirements)
+                counts[bit] = counts.get(bit, 0) + 1
+                requirements.append((bit, per_serving, unit, ing["name"], 1.0))
+            offset += len(ingredients)
+            requirements = [
+                (bit, per_serving, unit, display_name, 1.0 / counts[bit])
+                for bit, per_serving, unit, display_name, _ in requirements
+            ]
+
+            self.recipes.append({
+                "id": int(_to_float(row[0])) if row[0] else None,
+                "name": row[1],
+                "servings": servings,
+                "url": row[4] or None,
+                "category": row[5],
+                "last_cooked": row[6] or None
+            })
+            self.masks.append(mask)
+            self.requirements.append(requirements)
+        self.names = NameIndex(self.keys)
+
+    def __len__(self) -> int:
+        return len(self.recipes)
+
+    def resolve_pantry(self, pantry: Dict[str, Dict[str, float]]) -> Dict[int, Dict[str, float]]:
+        """在庫の材料をこの語彙のビット位置に対応付ける（同じ位置になった材料の数量は合算する）"""
+        stock: Dict[int, Dict[str, float]] = {}
+        for key, quantities in pantry.items():
+            bit = self.vocab.get(key)
+            if bit is None:
+                match = self.names.match(key)
+                bit = self.vocab.get(match) if match else None
+            if bit is None:
+                continue
+            merged = stock.setdefault(bit, {})
+            for unit, quantity in quantities.items():
+                merged[unit] = merged.get(unit, 0.0) + quantity
+        return stock
+
+    def rank(
+        self,
+        pantry: Dict[str, Dict[str, float]],
+        servings: Optional[int] = None,
+        limit: int = 10,
+        min_score: float = 0.0
+    ) -> List[Dict]:
+        """在庫の充足率でレシピを順位付けする（limitが0以下なら空のリスト）"""
+        if limit <= 0:
+            return []
+        stock = self.resolve_pantry(pantry)
+        pantry_bits = 0
+        for bit in stock:
+            pantry_bits |= 1 << bit
+
+        # ビット数だけで求まる充足率は数量を考慮したスコアの上限になるため、
+        # 上限の高い順に評価し、上位limit件に届かなくなった時点で打ち切る
+        candidates = []
+        for i, mask in enumerate(self.masks):
+            hit = mask & pantry_bits
+            if not hit:
+                continue
+            bound = hit.bit_count() / mask.bit_count()
+            if bound >= min_score:
+                candidates.append((bound, i, hit))
+        candidates.sort(key=lambda item: (-item[0], item[1]))
+
+        top: List[Tuple[float, int, int, List[str], List[Dict], int]] = []
+        for bound, i, hit in candidates:
+            if len(top) >= limit and bound < top[0][0]:
+                break
+
+            recipe = self.recipes[i]
+            target_servings = servings or recipe["servings"]
+            total = 0.0
+            matched = []
+            missing = []
+            for bit, per_serving, unit, display_name, weight in self.requirements[i]:
+                need = per_serving * target_servings
+                if not hit >> bit & 1:
+                    missing.append({"name": display_name, "quantity": need, "unit": unit})
+                    continue
+                have = stock[bit].get(unit) if need > 0 else None
+                if have is None or have >= need:
+                    # 分量不明・単位が比較できない場合は在庫があれば充足とみなす
+                    total += weight
+                    if display_name not in matched:
+                        matched.append(display_name)
+                else:
+                    total += weight * have / need
+                    missing.append({"name": display_name, "quantity": need - have, "unit": unit})
+
+            # 重みは材料ごとに合計1なので、材料の数で割れば充足率の上限（bound）を超えない
+            score = total / self.masks[i].bit_count()
+            if score < min_score:
+                continue
+            entry = (score, -len(missing), -i, matched, missing, target_servings)
+            if len(top) < limit:
+                heapq.heappush(top, entry)
+            elif entry[:3] > top[0][:3]:
+                heapq.heapreplace(top, entry)
+
+        top.sort(key=lambda item: item[:3], reverse=True)
+        return [
+            {
+                **self.recipes[-neg_index],
+                "servings": target_servings,
+                "score": round(score, 4),
+                "matched": matched,
+                "missing": missing
+            }
+            for score, _, neg_index, matched, missing, target_servings in top
+        ]
+
+_index_cache: Dict[str, object] = {"fingerprint": None, "index": None}
+
+def get_recipe_index(recipe_rows: Sequence[Sequence]) -> RecipeIndex:
+    """レシピ行からインデックスを取得する（内容が変わらない限り再利用）"""
+    fingerprint = hash(tuple(tuple(row) for row in recipe_rows))
+    if _index_cache["fingerprint"] != fingerprint:
+        CACHE_REQUESTS.inc(cache="recipe_index", result="miss")
+        _index_cache["index"] = RecipeIndex(recipe_rows)
+        _index_cache["fingerprint"] = fingerprint
+    else:
+        CACHE_REQUESTS.inc(cache="recipe_index", result="hit")
+    return _index_cache["index"]
+
+def suggest_recipes(
+    ingredient_rows: Sequence[Sequence],
+    recipe_rows: Sequence[Sequence],
+    servings: Optional[int] = None,
+    limit: int = 10,
+    min_score: float = 0.0
+) -> List[Dict]:
+    """今ある材料で作れるレシピを充足率の高い順に返す"""
+    index = get_recipe_index(recipe_rows)
+    pantry = build_pantry(ingredient_rows)
+    return index.rank(pantry, servings=servings, limit=limit, min_score=min_score)
@@ -0,0 +1,240 @@
+import sys
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+
+from ..utils import data_version
+from ..utils.metrics import CACHE_REQUESTS
+from ..utils.sheets import read_sheet
+from .recipe_matcher import INGREDIENT_COLUMNS, RECIPE_COLUMNS, pad_row, parse_recipe_ingredients
+
+EPOCH = datetime(1970, 1, 1)
+# 日時が空の場合の値
+NO_TIME = int(np.iinfo(np.int64).min)
+
+def to_epoch_us(value: str) -> int:
+    """ISO形式の日時をエポックからのマイクロ秒にする（空ならNO_TIME、タイムゾーン付きの値はUTCにそろえる）"""
+    if not value:
+        return NO_TIME
+    parsed = datetime.fromisoformat(value)
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return (parsed - EPOCH) // timedelta(microseconds=1)
+
+def from_epoch_us(value: int) -> Optional[datetime]:
+    """to_epoch_usの値を日時に戻す"""
+    return None if value == NO_TIME else EPOCH + timedelta(microseconds=value)
+
+class Vocabulary:
+    """繰り返し現れる文字列（カテゴリー・単位・材料名）を1つにまとめ、番号で参照する"""
+
+    __slots__ = ("values", "_codes")
+
+    def __init__(self):
+        self.values: List[str] = []
+        self._codes: Dict[str, int] = {}
+
+    def code(self, value) -> int:
+        value = str(value)
+        code = self._codes.get(value)
+        if code is None:
+            code = self._codes[value] = len(self.values)
+            self.values.append(sys.intern(value))
+        return code
+
+    def encode(self, values) -> np.ndarray:
+        return np.fromiter((self.code(value) for value in values), dtype=np.int32)
+
+    def matching(self, predicate) -> List[int]:
+        """predicateが真になる文字列の番号"""
+        return [code for code, value in enumerate(self.values) if predicate(value)]
+
+class _Table:
+    """シートの行を列ごとの配列でIDの昇順に保持する表の共通部分（records()はそれぞれの表で定義する）"""
+
+    __slots__ = ("ids", "names")
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def position_after(self, record_id: int) -> int:
+        """IDがrecord_idより大きい最初の行の位置"""
+        return int(np.searchsorted(self.ids, record_id, side="right"))
+
+def _sorted_rows(rows: Sequence[Sequence], width: int) -> List[List]:
+    return sorted(
+        (pad_row(row, width) for row in rows if row and row[0]),
+        key=lambda row: int(row[0])
+    )
+
+class IngredientTable(_Table):
+    """材料シートの列ごとの配列
+
+    数量はfloat64、日時はエポックからのマイクロ秒（int64）の配列にし、
+    単位とカテゴリーは語彙の番号の配列にする。応答用の辞書は返す行の分だけ作る。
+    """
+
+    __slots__ = ("quantities", "expiry_dates", "updated_at", "units", "unit_codes", "categories", "category_codes")
+
+    def __init__(self, rows: Sequence[Sequence]):
+        rows = _sorted_rows(rows, INGREDIENT_COLUMNS)
+        count = len(rows)
+        self.ids = np.fromiter((int(row[0]) for row in rows), dtype=np.int64, count=count)
+        self.names = [str(row[1]) for row in rows]
+        self.quantities = np.fromiter((float(row[2] or 0) for row in rows), dtype=np.float64, count=count)
+        self.expiry_dates = np.fromiter((to_epoch_us(row[4]) for row in rows), dtype=np.int64, count=count)
+        self.updated_at = np.fromiter((to_epoch_us(row[5]) for row in rows), dtype=np.int64, count=count)
+        self.units = Vocabulary()
+        self.unit_codes = self.units.encode(row[3] for row in rows)
+        self.categories = Vocabulary()
+        self.category_codes = self.categories.encode(row[6] for row in rows)
+
+    def records(self, positions) -> List[Dict]:
+        """指定した位置の行を、Ingredientと同じ項目の辞書にする（モデルを作らず検証もしない）"""
+        positions = np.asarray(positions, dtype=np.intp)
+        now = datetime.now()
+        return [
+            {
+                "name": self.names[i],
+                "quantity": quantity,
+                "unit": self.units.values[unit],
+                "category": self.categories.values[category],
+                "expiry_date": from_epoch_us(expiry),
+                "id": record_id,
+                # 更新日時が空の行はIngredientの既定値と同じく現在時刻にする
+                "updated_at": from_epoch_us(updated) or now
+            }
+            for i, record_id, quantity, unit, category, expiry, updated in zip(
+                positions.tolist(),
+                self.ids[positions].tolist(),
+                self.quantities[positions].tolist(),
+                self.unit_codes[positions].tolist(),
+                self.category_codes[positions].tolist(),
+                self.expiry_dates[positions].tolist(),
+                self.updated_at[positions].tolist()
+            )
+        ]
+
+class RecipeTable(_Table):
+    """レシピシートの列ごとの配列
+
+    材料はすべてのレシピの分を1列にまとめ、レシピごとの開始位置（offsets）で区切る。
+    材料名・単位・カテゴリーは語彙の番号の配列にする。
+    """
+
+    __slots__ = (
+        "servings", "urls", "last_cooked", "categories", "category_codes",
+        "offsets", "ingredient_names", "ingredient_name_codes", "ingredient_quantities",
+        "ingredient_units", "ingredient_unit_codes"
+    )
+
+    def __init__(self, rows: Sequence[Sequence]):
+        rows = _sorted_rows(rows, RECIPE_COLUMNS)
+        count = len(rows)
+        self.ids = np.fromiter((int(row[0]) for row in rows), dtype=np.int64, count=count)
+        self.names = [str(row[1]) for row in rows]
+        self.servings = np.fromiter((int(float(row[3] or 1)) for row in rows), dtype=np.int32, count=count)
+        self.urls = [row[4] or None for row in rows]
+        self.last_cooked = np.fromiter((to_epoch_us(row[6]) for row in rows), dtype=np.int64, count=count)
+        self.categories = Vocabulary()
+        self.category_codes = self.categories.encode(row[5] for row in rows)
+
+        parsed = [parse_recipe_ingredients(row[2]) for row in rows]
+        self.offsets = np.zeros(count + 1, dtype=np.int32)
+        np.cumsum([len(ingredients) for ingredients in parsed], out=self.offsets[1:])
+        flat = [ing for ingredients in parsed for ing in ingredients]
+        self.ingredient_names = Vocabulary()
+        self.ingredient_name_codes = self.ingredient_names.encode(ing["name"] for ing in flat)
+        self.ingredient_quantities = np.fromiter((ing["quantity"] for ing in flat), dtype=np.float64, count=len(flat))
+        self.ingredient_units = Vocabulary()
+        self.ingredient_unit_codes = self.ingredient_units.encode(ing["unit"] for ing in flat)
+
+    def search(
+        self,
+        terms: Optional[Sequence[str]] = None,
+        category: Optional[str] = None,
+        min_servings: Optional[int] = None
+    ) -> np.ndarray:
+        """条件に合うレシピの位置を返す
+
+        termsのいずれかがレシピ名か材料名に含まれるもの（大文字・小文字を区別しない）、
+        カテゴリーが一致するもの、人数がmin_servings以上のものに絞り込む。
+        """
+        mask = np.ones(len(self), dtype=bool)
+        if terms:
+            matched = np.zeros(len(self), dtype=bool)
+            lowered = [name.lower() for name in self.names]
+            owners = np.repeat(np.arange(len(self)), np.diff(self.offsets))
+            for term in terms:
+                term = term.lower()
+                matched |= np.fromiter((term in name for name in lowered), dtype=bool, count=len(self))
+                codes = self.ingredient_names.matching(lambda name: term in name.lower())
+                if codes:
+                    matched[owners[np.isin(self.ingredient_name_codes, codes)]] = True
+            mask &= matched
+        if category:
+            codes = self.categories.matching(lambda value: value.lower() == category.lower())
+            mask &= np.isin(self.category_codes, codes)
+        if min_servings:
+            mask &= self.servings >= min_servings
+        return np.flatnonzero(mask)
+
+    def records(self, positions) -> List[Dict]:
+        """指定した位置の行を、Recipeと同じ項目の辞書にする（モデルを作らず検証もしない）"""
+        positions = np.asarray(positions, dtype=np.intp)
+        names = self.ingredient_names.values
+        units = self.ingredient_units.values
+        return [
+            {
+                "id": record_id,
+                "name": self.names[i],
+                "ingredients": [
+                    {"name": names[name], "quantity": quantity, "unit": units[unit]}
+                    for name, quantity, unit in zip(
+                        self.ingredient_name_codes[start:stop].tolist(),
+                        self.ingredient_quantities[start:stop].tolist(),
+                        self.ingredient_unit_codes[start:stop].tolist()
+                    )
+                ],
+                "servings": servings,
+                "url": self.urls[i],
+                "category": self.categories.values[category],
+                "last_cooked": from_epoch_us(last_cooked)
+            }
+            for i, record_id, servings, category, last_cooked, start, stop in zip(
+                positions.tolist(),
+                self.ids[positions].tolist(),
+                self.servings[positions].tolist(),
+                self.category_codes[positions].tolist(),
+                self.last_cooked[positions].tolist(),
+                self.offsets[positions].tolist(),
+                self.offsets[positions + 1].tolist()
+            )
+        ]
+
+TABLE_TYPES = {"Ingredients": IngredientTable, "Recipes": RecipeTable}
+
+class RecordStore:
+    """シートの全行を列ごとの配列にした表を、データバージョンごとに1つだけ保持する
+
+    表は複数のリクエストで共有するため、取得した側で書き換えないこと。
+    """
+
+    def __init__(self):
+        self._tables: Dict[Tuple[str, str], Tuple[int, _Table]] = {}
+
+    def get(self, spreadsheet_id: str, table: str) -> Union[IngredientTable, RecipeTable]:
+        # 読み込み中に書き込まれた場合は次の呼び出しで読み直されるよう、先にバージョンを取る
+        version = data_version.current(table)
+        key = (spreadsheet_id, table)
+        cached = self._tables.get(key)
+        if cached is not None and cached[0] == version:
+            CACHE_REQUESTS.inc(cache="records", result="hit")
+            return cached[1]
+        CACHE_REQUESTS.inc(cache="records", result="miss")
+        built = TABLE_TYPES[table](read_sheet(spreadsheet_id, f"{table}!A2:G"))
+        self._tables[key] = (version, built)
+        return built
+
+record_store = RecordStore()
@@ -0,0 +1,145 @@
+import json
+import os
+import re
+import secrets
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+from ..utils.log import get_logger
+from ..utils.metrics import CACHE_REQUESTS
+
+logger = get_logger(__name__)
+
+# メモリに保持する会話の数（超えたら最も長く使われていないものから外す）
+CHAT_SESSION_MAX = int(os.getenv("CHAT_SESSION_MAX", "1000"))
+# 最後のやり取りからこの秒数が過ぎた会話は破棄する
+CHAT_SESSION_TTL = float(os.getenv("CHAT_SESSION_TTL", "86400"))
+# 会話を保存するディレクトリ（指定した場合のみ。再起動後や他のワーカーでも会話を続けられる。gunicornでは既定で一時ディレクトリ）
+CHAT_SESSION_DIR = os.getenv("CHAT_SESSION_DIR")
+# LLMに渡す会話の上限（メッセージ数と文字数。古いものから外す）
+CHAT_CONTEXT_MESSAGES = int(os.getenv("CHAT_CONTEXT_MESSAGES", "20"))
+CHAT_CONTEXT_CHARS = int(os.getenv("CHAT_CONTEXT_CHARS", "8000"))
+
+_SESSION_ID = re.compile(r"[A-Za-z0-9_-]{16,64}")
+
+class ChatSession:
+    """1つの会話（LLMに渡す直近のメッセージと、直前のアクションの結果）"""
+
+    __slots__ = ("id", "messages", "state", "updated_at")
+
+    def __init__(self, session_id: str, messages: Optional[List[Dict]] = None, state: Optional[Dict] = None, updated_at: float = 0.0):
+        self.id = session_id
+        self.messages: List[Dict] = messages or []
+        self.state: Dict = state or {}
+        self.updated_at = updated_at or time.time()
+
+    def append(self, role: str, content: str):
+        """メッセージを加え、上限を超えた古いメッセージを外す（最新のメッセージは必ず残す）"""
+        self.messages.append({"role": role, "content": content})
+        del self.messages[:-CHAT_CONTEXT_MESSAGES]
+        total = sum(len(message["content"]) for message in self.messages)
+        while len(self.messages) > 1 and total > CHAT_CONTEXT_CHARS:
+            total -= len(self.messages.pop(0)["content"])
+
+    def copy(self) -> "ChatSession":
+        """このターンで書き換える会話の複製（保存するまで保持している会話は変えない）"""
+        return ChatSession(self.id, list(self.messages), dict(self.state), self.updated_at)
+
+    def to_dict(self) -> Dict:
+        return {"id": self.id, "messages": self.messages, "state": self.state, "updated_at": self.updated_at}
+
+class SessionStore:
+    """チャットの会話をサーバー側で保持する
+
+    メモリ上は大きさに上限のあるLRUで保持し、directoryを指定した場合はファイルにも書き込む。
+    メモリから外れた会話や、他のワーカーが更新した会話はファイルから読み直す。
+    クライアントは会話全体ではなく新しいメッセージとセッションIDだけを送ればよい。
+    """
+
+    def __init__(self, directory: Optional[str] = CHAT_SESSION_DIR, max_sessions: int = CHAT_SESSION_MAX, ttl: float = CHAT_SESSION_TTL):
+        self.directory = directory
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self._sessions: "OrderedDict[str, ChatSession]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._swept_at = 0.0
+
+    def _path(self, session_id: str) -> str:
+        return os.path.join(self.directory, f"{session_id}.json")
+
+    def _load_file(self, session_id: str) -> Optional[ChatSession]:
+        try:
+            with open(self._path(session_id), encoding="utf-8") as f:
+                saved = json.load(f)
+            return ChatSession(session_id, saved["messages"], saved["state"], saved["updated_at"])
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def _save_file(self, session: ChatSession):
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            path = self._path(session.id)
+            temp = f"{path}.{os.getpid()}.tmp"
+            with open(temp, "w", encoding="utf-8") as f:
+                json.dump(session.to_dict(), f, ensure_ascii=False)
+            os.replace(temp, path)
+        except OSError as e:
+            logger.warning("会話を保存できませんでした: %s", e)
+
+    def _sweep(self):
+        """期限を過ぎた会話のファイルを消す（CHAT_SESSION_TTLの間隔で1回）"""
+        now = time.time()
+        if now - self._swept_at < self.ttl:
+            return
+        self._swept_at = now
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return
+        for name in names:
+            path = os.path.join(self.directory, name)
+            try:
+                if name.endswith(".json") and now - os.path.getmtime(path) > self.ttl:
+                    os.remove(path)
+            except OSError:
+                pass
+
+    def _expired(self, session: ChatSession) -> bool:
+        return time.time() - session.updated_at > self.ttl
+
+    def get(self, session_id: Optional[str]) -> ChatSession:
+        """会話を返す（IDがない・見つからない・期限切れの場合は新しい会話を作る）"""
+        if session_id and _SESSION_ID.fullmatch(session_id):
+            with self._lock:
+                session = self._sessions.get(session_id)
+                if session is not None:
+                    self._sessions.move_to_end(session_id)
+            if self.directory:
+                # 他のワーカーが続きを書き込んでいればファイルの方が新しい
+                saved = self._load_file(session_id)
+                if saved is not None and (session is None or saved.updated_at > session.updated_at):
+                    session = saved
+            if session is not None and not self._expired(session):
+                CACHE_REQUESTS.inc(cache="chat_session", result="hit")
+                return session
+        CACHE_REQUESTS.inc(cache="chat_session", result="miss")
+        return ChatSession(secrets.token_urlsafe(16))
+
+    def save(self, session: ChatSession):
+        """会話を保持する（ファイルへの保存はdirectoryを指定した場合のみ）"""
+        session.updated_at = time.time()
+        with self._lock:
+            self._sessions[session.id] = session
+            self._sessions.move_to_end(session.id)
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+        if self.directory:
+            self._save_file(session)
+            self._sweep()
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+session_store = SessionStore()
@@ -0,0 +1,243 @@
+import asyncio
+import hashlib
+import threading
+import time
+from contextlib import ExitStack
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from ..utils import data_version
+from ..utils.io_pool import run_io
+from ..utils.log import get_logger
+from ..utils.metrics import GaugeFunc
+from ..utils.tracing import span
+from ..utils.sheets import SHEETS_WATCH_DRIVE, batch_read_sheet, get_spreadsheet_revision, read_sheet
+from ..utils.shared_store import store
+from .change_feed import change_feed
+from .expiry_index import expiry_index
+from .recipe_matcher import INGREDIENT_COLUMNS, RECIPE_COLUMNS, pad_row
+from .snapshot_store import snapshot_store
+from .table_index import TABLE_INDEXES, _rows_moved
+
+# 監視するシートとデータの範囲
+WATCHED_RANGES = {
+    "Ingredients": "Ingredients!A2:G",
+    "Recipes": "Recipes!A2:G"
+}
+
+# Drive APIが使えないときの代わりの目印（消費期限やカテゴリーなどの編集も検知するため、監視する範囲全体）
+CHECKSUM_RANGES = list(WATCHED_RANGES.values())
+
+logger = get_logger(__name__)
+
+_COLUMNS = {
+    "Ingredients": INGREDIENT_COLUMNS,
+    "Recipes": RECIPE_COLUMNS
+}
+
+def _row_hash(row: List) -> str:
+    return hashlib.sha1("\x1f".join(str(value) for value in row).encode("utf-8")).hexdigest()
+
+class SheetWatcher:
+    """スプレッドシートが直接編集されたことを検知し、ローカルのキャッシュを読み直す
+
+    定期的に安価な目印（SHEETS_WATCH_DRIVEを指定した場合はDriveのファイルのversion。
+    指定しない場合や権限がなければ監視する範囲のチェックサム）
+    だけを取得し、変わっていたときに限り材料・レシピのシートを1回のbatchGetで読み直す。
+    行ごとのハッシュを前回と比べ、内容が変わったシートについてだけID対応表・消費期限
+    インデックスを作り直し、データバージョンを進め、変わった行を変更フィードに流す。
+    複数ワーカーの場合は1つのワーカーだけが監視し、他のワーカーはフィードに流れた変更を
+    消費期限インデックスに反映する（follow_sheet_changes）。ID対応表は次の書き込みの前に読み直される。
+    このサーバー自身の書き込みでも目印は変わるが、その場合も読み直しは1回のbatchGetで済み、
+    フィードに流れる行はID単位で冪等なので重複しても害はない。
+    """
+
+    def __init__(self):
+        self.mode = "drive" if SHEETS_WATCH_DRIVE else "checksum"
+        # このワーカーの役割（watcher: シートを監視する / follower: 監視役の変更を反映する）
+        self.role: Optional[str] = None
+        self.interval_seconds: Optional[float] = None
+        self.revision: Optional[str] = None
+        self._row_hashes: Dict[str, Dict[int, str]] = {}
+        self._lock = threading.Lock()
+        self.checks = 0
+        self.reloads = 0
+        self.errors = 0
+        self.last_error: Optional[str] = None
+        self.last_checked_at: Optional[datetime] = None
+        self.last_changed_at: Optional[datetime] = None
+        self.last_reloaded_at: Optional[datetime] = None
+        self._last_success = None
+
+    def _signal(self, spreadsheet_id: str) -> str:
+        if self.mode == "drive":
+            try:
+                return get_spreadsheet_revision(spreadsheet_id)
+            except Exception as e:
+                # スコープが足りないトークンなどではチェックサムに切り替える
+                logger.warning("Driveのリビジョンを取得できないため、チェックサムで更新を検知します: %s", e)
+                self.mode = "checksum"
+        values = batch_read_sheet(spreadsheet_id, CHECKSUM_RANGES)
+        digest = hashlib.sha1()
+        for rows in values:
+            for row in rows:
+                digest.update(_row_hash(row).encode("ascii"))
+            digest.update(b"|")
+        return digest.hexdigest()
+
+    def check(self, spreadsheet_id: str) -> List[str]:
+        """目印を確認し、変わっていれば読み直す。読み直したシート名を返す"""
+        with self._lock, span("sheets.watch.check") as current:
+            self.checks += 1
+            try:
+                revision = self._signal(spreadsheet_id)
+                changed = []
+                if revision != self.revision:
+                    if self.revision is not None:
+                        self.last_changed_at = datetime.now()
+                    changed = self._reload(spreadsheet_id, initial=self.revision is None)
+                    self.revision = revision
+            except Exception as e:
+                self.errors += 1
+                self.last_error = str(e)
+                raise
+            current.set_attribute("sheets.watch.mode", self.mode)
+            current.set_attribute("sheets.watch.changed", ",".join(changed))
+            self.last_checked_at = datetime.now()
+            self._last_success = time.monotonic()
+            return changed
+
+    def _reload(self, spreadsheet_id: str, initial: bool = False) -> List[str]:
+        # 読み直しと対応表の作り直しの間に（他のワーカーも含めて）書き込みが入らないようにする
+        with ExitStack() as stack:
+            for table in WATCHED_RANGES:
+                stack.enter_context(store.lock(f"table:{table}"))
+            for table in WATCHED_RANGES:
+                stack.enter_context(TABLE_INDEXES[table]._lock)
+            values = batch_read_sheet(spreadsheet_id, list(WATCHED_RANGES.values()))
+            changed = []
+            for table, rows in zip(WATCHED_RANGES, values):
+                rows = [pad_row(row, _COLUMNS[table]) for row in rows]
+                hashes = {}
+                for row in rows:
+                    try:
+                        hashes[int(row[0])] = _row_hash(row)
+                    except ValueError:
+                        continue
+                previous = self._row_hashes.get(table)
+                self._row_hashes[table] = hashes
+                if previous == hashes:
+                    continue
+                changed.append(table)
+                if initial:
+                    # 最初の読み込みの内容をスナップショットにする
+                    snapshot_store.put(spreadsheet_id, table, rows, data_version.current(table))
+                    continue
+
+                index = TABLE_INDEXES[table]
+                index.load(rows, str(index.next_id))
+                # 他のワーカーの対応表も読み直させる
+                _rows_moved(index)
+                if table == "Ingredients":
+                    expiry_index.load(rows)
+                snapshot_store.put(spreadsheet_id, table, rows, data_version.bump(table))
+                previous = previous or {}
+                upserts = [
+                    row for row in rows
+                    if row[0].isdigit() and previous.get(int(row[0])) != hashes[int(row[0])]
+                ]
+                deletes = [record_id for record_id in previous if record_id not in hashes]
+                change_feed.publish(table, upserts=upserts, deletes=deletes)
+        if changed and not initial:
+            self.reloads += 1
+            self.last_reloaded_at = datetime.now()
+            logger.info("スプレッドシートの変更を検知し、読み直しました", extra={"tables": changed})
+        return changed
+
+    def staleness_seconds(self) -> Optional[float]:
+        """最後にシートの更新を確認してからの経過秒数（キャッシュが古い可能性のある時間）"""
+        if self._last_success is None:
+            return None
+        return round(time.monotonic() - self._last_success, 3)
+
+    def status(self) -> Dict:
+        """更新検知の状態と、キャッシュがどれだけ古い可能性があるかを返す"""
+        return {
+            "role": self.role,
+            "mode": self.mode,
+            "revision": self.revision,
+            "interval_seconds": self.interval_seconds,
+            "staleness_seconds": self.staleness_seconds(),
+            "checks": self.checks,
+            "reloads": self.reloads,
+            "errors": self.errors,
+            "last_error": self.last_error,
+            "last_checked_at": self.last_checked_at.isoformat() if self.last_checked_at else None,
+            "last_changed_at": self.last_changed_at.isoformat() if self.last_changed_at else None,
+            "last_reloaded_at": self.last_reloaded_at.isoformat() if self.last_reloaded_at else None,
+            "data_versions": {table: data_version.current(table) for table in WATCHED_RANGES}
+        }
+
+sheet_watcher = SheetWatcher()
+
+def _staleness_metric() -> Dict:
+    staleness = sheet_watcher.staleness_seconds()
+    return {(): staleness} if staleness is not None else {}
+
+SHEETS_STALENESS = GaugeFunc(
+    "sheets_cache_staleness_seconds",
+    "Seconds since the spreadsheet was last confirmed unchanged",
+    [],
+    _staleness_metric
+)
+
+async def run_sheet_watcher(spreadsheet_id: str, interval_seconds: float = 30):
+    """スプレッドシートの更新を定期的に確認するバックグラウンドタスク"""
+    sheet_watcher.role = "watcher"
+    sheet_watcher.interval_seconds = interval_seconds
+    while True:
+        try:
+            await run_io(sheet_watcher.check, spreadsheet_id)
+        except Exception as e:
+            logger.warning("スプレッドシートの更新確認中にエラーが発生しました: %s", e)
+        await asyncio.sleep(interval_seconds)
+
+def _ingredient_row(record: Dict) -> List:
+    """変更フィードの材料の記録を材料シートの行の形に戻す"""
+    return [
+        str(record["id"]),
+        record["name"],
+        record["quantity"],
+        record["unit"],
+        record["expiry_date"] or "",
+        record["updated_at"] or "",
+        record["category"]
+    ]
+
+async def follow_sheet_changes(spreadsheet_id: str, interval_seconds: float = 30):
+    """シートを監視しないワーカーで、他のワーカーが流した材料の変更を消費期限インデックスに反映する"""
+    sheet_watcher.role = "follower"
+    sheet_watcher.interval_seconds = interval_seconds
+    version = change_feed.version
+    while True:
+        await asyncio.sleep(interval_seconds)
+        try:
+            head = change_feed.version
+            changes = change_feed.since(version)
+            if changes is None:
+                # フィードの保持範囲より古くなった場合はシートから作り直す
+                rows = await run_io(read_sheet, spreadsheet_id, WATCHED_RANGES["Ingredients"])
+                expiry_index.load(rows)
+                version = head
+                continue
+            for change in changes:
+                if change["table"] != "Ingredients":
+                    continue
+                if change["op"] == "delete":
+                    expiry_index.remove(change["id"])
+                else:
+                    expiry_index.upsert_row(_ingredient_row(change["record"]))
+            if changes:
+                version = changes[-1]["version"]
+        except Exception as e:
+            logger.warning("他のワーカーの変更を反映できませんでした: %s", e)
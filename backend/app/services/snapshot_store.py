@@ -0,0 +1,137 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+from ..utils import data_version
+from ..utils.log import get_logger
+from ..utils.metrics import CACHE_REQUESTS
+from ..utils.sheets import read_sheet
+
+logger = get_logger(__name__)
+
+# スナップショットを保存するディレクトリ（再起動後もシートに接続できない間はこれを返す）
+SNAPSHOT_DIR = os.getenv(
+    "SNAPSHOT_DIR",
+    os.path.join(os.path.dirname(__file__), "..", "..", ".snapshots")
+)
+# この秒数より古いスナップショットは、返したあとバックグラウンドで読み直す
+SNAPSHOT_TTL = float(os.getenv("SNAPSHOT_TTL", "300"))
+
+# シート名 -> 読み込む範囲
+TABLE_RANGES = {
+    "Ingredients": "Ingredients!A2:G",
+    "Recipes": "Recipes!A2:G"
+}
+
+class Snapshot:
+    """シートの行と取得時刻、取得時点のデータバージョン（ファイルから読んだ場合はNone）"""
+
+    __slots__ = ("rows", "fetched_at", "version")
+
+    def __init__(self, rows: List[List], fetched_at: float, version: Optional[int]):
+        self.rows = rows
+        self.fetched_at = fetched_at
+        self.version = version
+
+class SnapshotStore:
+    """シートの読み込みを、最後に読めた内容（スナップショット）で補う
+
+    データバージョンが変わっていなければシートを読まずにスナップショットを返し、
+    SNAPSHOT_TTLを過ぎていればバックグラウンドで読み直す（stale-while-revalidate）。
+    書き込みでバージョンが変わった場合はその場で読み直すため、自分の書き込みは次の読み込みに反映される。
+    読み直しに失敗した場合、allow_staleなら古いスナップショットとその取得時刻を返す。
+    スナップショットはファイルにも保存し、再起動直後にシートに接続できない場合にも返せるようにする。
+    """
+
+    def __init__(self, directory: str = SNAPSHOT_DIR, ttl: float = SNAPSHOT_TTL):
+        self.directory = directory
+        self.ttl = ttl
+        self._snapshots: Dict[Tuple[str, str], Snapshot] = {}
+        self._refreshing = set()
+        self._lock = threading.Lock()
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    def _path(self, spreadsheet_id: str, table: str) -> str:
+        digest = hashlib.sha1(spreadsheet_id.encode()).hexdigest()[:12]
+        return os.path.join(self.directory, f"{table}-{digest}.json")
+
+    def _background(self, function, *args):
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="snapshot")
+        self._executor.submit(function, *args)
+
+    def _load_file(self, spreadsheet_id: str, table: str) -> Optional[Snapshot]:
+        try:
+            with open(self._path(spreadsheet_id, table), encoding="utf-8") as f:
+                saved = json.load(f)
+            return Snapshot(saved["rows"], saved["fetched_at"], None)
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def _save_file(self, spreadsheet_id: str, table: str, snapshot: Snapshot):
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            path = self._path(spreadsheet_id, table)
+            temp = f"{path}.{os.getpid()}.tmp"
+            with open(temp, "w", encoding="utf-8") as f:
+                json.dump({"table": table, "fetched_at": snapshot.fetched_at, "rows": snapshot.rows}, f, ensure_ascii=False)
+            os.replace(temp, path)
+        except OSError as e:
+            logger.warning("スナップショットを保存できませんでした: %s", e)
+
+    def put(self, spreadsheet_id: str, table: str, rows: List[List], version: int):
+        """読み込んだ行をスナップショットとして保持する（ファイルへの保存はバックグラウンドで行う）"""
+        snapshot = Snapshot([list(row) for row in rows], time.time(), version)
+        self._snapshots[(spreadsheet_id, table)] = snapshot
+        self._background(self._save_file, spreadsheet_id, table, snapshot)
+
+    def _fetch(self, spreadsheet_id: str, table: str) -> List[List]:
+        # 読み込み中に書き込まれた場合は次の読み込みで読み直されるよう、先にバージョンを取る
+        version = data_version.current(table)
+        rows = read_sheet(spreadsheet_id, TABLE_RANGES[table])
+        self.put(spreadsheet_id, table, rows, version)
+        return rows
+
+    def _refresh(self, spreadsheet_id: str, table: str):
+        try:
+            self._fetch(spreadsheet_id, table)
+        except Exception as e:
+            logger.warning("%sのスナップショットを更新できませんでした: %s", table, e)
+        finally:
+            self._refreshing.discard((spreadsheet_id, table))
+
+    def read(self, spreadsheet_id: str, table: str, allow_stale: bool = True) -> Tuple[List[List], Optional[datetime]]:
+        """シートの行を返す（2つ目の値は古いスナップショットを返した場合のその取得時刻、最新ならNone）"""
+        key = (spreadsheet_id, table)
+        snapshot = self._snapshots.get(key)
+        if snapshot is None:
+            snapshot = self._load_file(spreadsheet_id, table)
+            if snapshot is not None:
+                self._snapshots[key] = snapshot
+
+        if snapshot is not None and snapshot.version == data_version.current(table):
+            CACHE_REQUESTS.inc(cache="snapshot", result="hit")
+            if time.time() - snapshot.fetched_at > self.ttl and key not in self._refreshing:
+                self._refreshing.add(key)
+                self._background(self._refresh, spreadsheet_id, table)
+            return [list(row) for row in snapshot.rows], None
+
+        try:
+            rows = self._fetch(spreadsheet_id, table)
+            CACHE_REQUESTS.inc(cache="snapshot", result="miss")
+            return rows, None
+        except Exception as e:
+            if not allow_stale or snapshot is None:
+                raise
+            CACHE_REQUESTS.inc(cache="snapshot", result="stale")
+            logger.warning("%sを読み込めないため、保存済みのスナップショットを返します: %s", table, e)
+            return [list(row) for row in snapshot.rows], datetime.fromtimestamp(snapshot.fetched_at)
+
+snapshot_store = SnapshotStore()
@@ -0,0 +1,248 @@
+import re
+import threading
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Sequence
+
+from ..utils.sheets import (
+    batch_mutate_sheet,
+    batch_read_sheet,
+    batch_update_sheet,
+    delete_row_request,
+    delete_sheet,
+    get_sheet_id,
+    update_cells_request
+)
+from ..utils.shared_store import store
+from .change_feed import change_feed
+
+# シート名 -> 次のIDを保存するMetaシートのセル
+META_CELLS = {
+    "Ingredients": "Meta!B2",
+    "Recipes": "Meta!B3"
+}
+
+class TableIndex:
+    """シートごとのID採番と「ID -> 行番号」の対応表
+
+    次のIDはMetaシートに保存し、行の追加と同じbatchUpdateで更新する。
+    削除された行のIDは再利用しないため、行数からIDを決める方式と違って
+    削除後や同時追加でもIDが重複しない。行番号はヘッダーを1行目とした
+    シート上の行番号で、追加・削除のたびに差分だけ更新する。
+    rows_versionは読み込み時点の共有ストアの行の追加・削除の回数で、
+    他のワーカーが行を動かしたかどうかの判定に使う。
+    """
+
+    def __init__(self, table: str):
+        self.table = table
+        self.next_id = 1
+        self.last_row = 1
+        self.rows_version = 0
+        self._rows: Dict[int, int] = {}
+        self._lock = threading.RLock()
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def load(self, id_rows: List[List], stored_next_id: Optional[str] = None):
+        """A列（A2以降）の値と保存済みの次のIDから対応表を作り直す"""
+        with self._lock:
+            self._rows = {}
+            for offset, row in enumerate(id_rows):
+                try:
+                    self._rows[int(row[0])] = offset + 2
+                except (IndexError, TypeError, ValueError):
+                    continue
+            self.last_row = len(id_rows) + 1
+            max_id = max(self._rows, default=0)
+            try:
+                stored = int(stored_next_id) if stored_next_id else 0
+            except ValueError:
+                stored = 0
+            self.next_id = max(stored, max_id + 1)
+
+    def row_of(self, record_id: int) -> Optional[int]:
+        """IDに対応するシート上の行番号を返す"""
+        return self._rows.get(int(record_id))
+
+    def allocate(self, count: int = 1) -> List[tuple]:
+        """IDと追加先の行番号を採番する"""
+        with self._lock:
+            allocated = []
+            for _ in range(count):
+                self.last_row += 1
+                allocated.append((self.next_id, self.last_row))
+                self._rows[self.next_id] = self.last_row
+                self.next_id += 1
+            return allocated
+
+    def release(self, allocated: List[tuple]):
+        """書き込みに失敗した採番の行を取り消す（IDは再利用しない）"""
+        with self._lock:
+            for record_id, _ in allocated:
+                self._rows.pop(record_id, None)
+            self.last_row -= len(allocated)
+
+    def remove(self, record_id: int) -> Optional[int]:
+        """IDを対応表から取り除き、後続の行番号を詰める"""
+        with self._lock:
+            row = self._rows.pop(int(record_id), None)
+            if row is None:
+                return None
+            for key, value in self._rows.items():
+                if value > row:
+                    self._rows[key] = value - 1
+            self.last_row -= 1
+            return row
+
+ingredient_index = TableIndex("Ingredients")
+recipe_index = TableIndex("Recipes")
+
+TABLE_INDEXES = {
+    "Ingredients": ingredient_index,
+    "Recipes": recipe_index
+}
+
+_loaded = set()
+_load_lock = threading.Lock()
+
+def _rows_version_key(table: str) -> str:
+    return f"table_rows:{table}"
+
+def load_table_indexes(spreadsheet_id: str):
+    """全シートのA列とMetaシートを1回のbatchGetで読み込み、対応表を作る"""
+    with _load_lock:
+        tables = list(TABLE_INDEXES)
+        # 読み込み中に他のワーカーが書いた場合は、次の書き込みの前にもう一度読み直される
+        rows_versions = [store.counter(_rows_version_key(table)) for table in tables]
+        ranges = [f"{table}!A2:A" for table in tables] + ["Meta!B2:B3"]
+        values = batch_read_sheet(spreadsheet_id, ranges)
+        stored = [row[0] if row else None for row in values[-1]]
+        stored += [None] * (len(tables) - len(stored))
+        for table, id_rows, next_id, rows_version in zip(tables, values, stored, rows_versions):
+            TABLE_INDEXES[table].load(id_rows, next_id)
+            TABLE_INDEXES[table].rows_version = rows_version
+        _loaded.add(spreadsheet_id)
+
+def get_table_index(spreadsheet_id: str, table: str) -> TableIndex:
+    """シートの対応表を取得する（未読み込みなら読み込む）"""
+    if spreadsheet_id not in _loaded:
+        load_table_indexes(spreadsheet_id)
+    return TABLE_INDEXES[table]
+
+def locate_row(spreadsheet_id: str, table: str, record_id: int) -> Optional[int]:
+    """IDの行番号を返す（他のワーカーが行を動かしていれば対応表を読み直す）"""
+    index = get_table_index(spreadsheet_id, table)
+    if index.rows_version != store.counter(_rows_version_key(table)):
+        load_table_indexes(spreadsheet_id)
+    return index.row_of(record_id)
+
+@contextmanager
+def _writing(spreadsheet_id: str, table: str) -> Iterator[TableIndex]:
+    """シートへの書き込みの区間（ワーカー間で排他し、他のワーカーの追加・削除を反映してから書く）"""
+    with store.lock(f"table:{table}"):
+        index = get_table_index(spreadsheet_id, table)
+        if index.rows_version != store.counter(_rows_version_key(table)):
+            load_table_indexes(spreadsheet_id)
+        with index._lock:
+            yield index
+
+def _rows_moved(index: TableIndex):
+    """行の追加・削除をしたことを他のワーカーに知らせる（_writingの中で呼ぶ）"""
+    index.rows_version = store.incr(_rows_version_key(index.table))
+
+def append_rows(spreadsheet_id: str, table: str, rows: List[List]) -> List[int]:
+    """IDを採番して行を追加する
+
+    行の書き込みと次のIDの保存を1回のbatchUpdateで行うため、既存の行は読まない。
+    各行の先頭（id列）は採番したIDで上書きされる。
+    """
+    if not rows:
+        return []
+    with _writing(spreadsheet_id, table) as index:
+        allocated = index.allocate(len(rows))
+        for (record_id, _), row in zip(allocated, rows):
+            row[0] = record_id
+        first_row = allocated[0][1]
+        last_row = allocated[-1][1]
+        try:
+            batch_update_sheet(spreadsheet_id, [
+                (f"{table}!A{first_row}:G{last_row}", rows),
+                (META_CELLS[table], [[index.next_id]])
+            ])
+        except Exception:
+            index.release(allocated)
+            raise
+        _rows_moved(index)
+        change_feed.publish(table, upserts=rows)
+        return [record_id for record_id, _ in allocated]
+
+def delete_row(spreadsheet_id: str, table: str, record_id: int) -> bool:
+    """IDで行を削除する（見つからない場合はFalse）"""
+    with _writing(spreadsheet_id, table) as index:
+        row = index.row_of(record_id)
+        if row is None:
+            return False
+        delete_sheet(spreadsheet_id, f"{table}!A{row}:G{row}")
+        index.remove(record_id)
+        _rows_moved(index)
+        change_feed.publish(table, deletes=[record_id])
+        return True
+
+def _meta_request(spreadsheet_id: str, table: str, next_id: int) -> dict:
+    """次のIDをMetaシートに保存するupdateCellsリクエストを作る"""
+    column, row = re.fullmatch(r"Meta!([A-Z])(\d+)", META_CELLS[table]).groups()
+    return update_cells_request(
+        get_sheet_id(spreadsheet_id, "Meta"),
+        int(row),
+        [[next_id]],
+        start_column=ord(column) - ord("A")
+    )
+
+def commit_rows(
+    spreadsheet_id: str,
+    table: str,
+    inserts: Sequence[List] = (),
+    updates: Sequence[List] = (),
+    deletes: Sequence[int] = ()
+) -> List[int]:
+    """行の追加・更新・削除を1回のbatchUpdateでまとめて反映する
+
+    更新と追加を書き込んでから、削除を行番号の大きい順に行うため、リクエストの途中で
+    行番号がずれない。updatesの各行は先頭のidで対象の行を決める。
+    見つからないIDの削除は無視する。追加した行のIDを返す。
+    """
+    if not (inserts or updates or deletes):
+        return []
+    with _writing(spreadsheet_id, table) as index:
+        sheet_id = get_sheet_id(spreadsheet_id, table)
+        requests = []
+        for row in updates:
+            row_number = index.row_of(row[0])
+            if row_number is None:
+                raise KeyError(f"{table}にID {row[0]} の行が見つかりません")
+            requests.append(update_cells_request(sheet_id, row_number, [row]))
+
+        delete_ids = [int(record_id) for record_id in deletes if index.row_of(record_id) is not None]
+        delete_rows = sorted((index.row_of(record_id) for record_id in delete_ids), reverse=True)
+
+        allocated = index.allocate(len(inserts)) if inserts else []
+        for (record_id, _), row in zip(allocated, inserts):
+            row[0] = record_id
+        tables = [table]
+        if allocated:
+            requests.append(update_cells_request(sheet_id, allocated[0][1], list(inserts)))
+            requests.append(_meta_request(spreadsheet_id, table, index.next_id))
+            tables.append("Meta")
+        requests.extend(delete_row_request(sheet_id, row_number) for row_number in delete_rows)
+
+        try:
+            batch_mutate_sheet(spreadsheet_id, requests, tables)
+        except Exception:
+            index.release(allocated)
+            raise
+        for record_id in delete_ids:
+            index.remove(record_id)
+        if allocated or delete_ids:
+            _rows_moved(index)
+        change_feed.publish(table, upserts=list(updates) + list(inserts), deletes=delete_ids)
+        return [record_id for record_id, _ in allocated]
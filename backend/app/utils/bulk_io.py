@@ -0,0 +1,106 @@
+import codecs
+import csv
+import io
+import json
+from typing import AsyncIterator, Dict, Iterator, List, Optional, Tuple
+
+# インポート・エクスポートで扱う材料の列
+IMPORT_FIELDS = ["name", "quantity", "unit", "category", "expiry_date"]
+EXPORT_FIELDS = ["id", "name", "quantity", "unit", "expiry_date", "updated_at", "category"]
+
+CSV_MEDIA_TYPES = {"text/csv", "application/csv"}
+JSONL_MEDIA_TYPES = {"application/x-ndjson", "application/jsonl", "application/json-lines", "application/ndjson"}
+
+def detect_format(fmt: Optional[str], content_type: Optional[str]) -> Optional[str]:
+    """クエリ指定またはContent-Typeからcsv/jsonlを判定する"""
+    if fmt:
+        fmt = fmt.lower()
+        return fmt if fmt in ("csv", "jsonl") else None
+    media_type = (content_type or "").split(";")[0].strip().lower()
+    if media_type in CSV_MEDIA_TYPES:
+        return "csv"
+    if media_type in JSONL_MEDIA_TYPES:
+        return "jsonl"
+    return None
+
+async def iter_lines(chunks: AsyncIterator[bytes]) -> AsyncIterator[str]:
+    """受信中のバイト列を行単位に分割する（本文全体をメモリに載せない）"""
+    decoder = codecs.getincrementaldecoder("utf-8-sig")()
+    buffer = ""
+    async for chunk in chunks:
+        buffer += decoder.decode(chunk)
+        *lines, buffer = buffer.split("\n")
+        for line in lines:
+            yield line.rstrip("\r")
+    buffer += decoder.decode(b"", final=True)
+    if buffer:
+        yield buffer.rstrip("\r")
+
+async def iter_records(lines: AsyncIterator[str], fmt: str) -> AsyncIterator[Tuple[int, Optional[Dict], Optional[str]]]:
+    """行を (行番号, レコード, エラー) に変換する"""
+    header: Optional[List[str]] = None
+    pending = ""
+    line_number = 0
+    start_line = 0
+    async for line in lines:
+        line_number += 1
+        if fmt == "jsonl":
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError as e:
+                yield line_number, None, f"JSONの形式が不正です: {e.msg}"
+                continue
+            if not isinstance(record, dict):
+                yield line_number, None, "各行はJSONオブジェクトである必要があります"
+                continue
+            yield line_number, record, None
+            continue
+
+        # CSV: 引用符内の改行で分かれた行はつなげてから解釈する
+        if not pending:
+            start_line = line_number
+        pending = f"{pending}\n{line}" if pending else line
+        if pending.count('"') % 2:
+            continue
+        text, pending = pending, ""
+        if not text.strip():
+            continue
+        values = next(csv.reader([text]))
+        if header is None:
+            header = [value.strip() for value in values]
+            continue
+        yield start_line, dict(zip(header, values)), None
+
+    if pending:
+        yield start_line, None, "引用符が閉じられていません"
+
+def _csv_line(values: List) -> str:
+    output = io.StringIO()
+    csv.writer(output, lineterminator="\n").writerow(values)
+    return output.getvalue()
+
+def _number(value, cast):
+    try:
+        return cast(value)
+    except (TypeError, ValueError):
+        return value
+
+def export_lines(pages: Iterator[List[List]], fmt: str) -> Iterator[bytes]:
+    """シートの行のページを順にCSV/JSONLの行として書き出す"""
+    if fmt == "csv":
+        yield _csv_line(EXPORT_FIELDS).encode("utf-8")
+    for rows in pages:
+        chunk = []
+        for row in rows:
+            row = list(row) + [""] * (len(EXPORT_FIELDS) - len(row))
+            if fmt == "csv":
+                chunk.append(_csv_line(row[:len(EXPORT_FIELDS)]))
+            else:
+                record = dict(zip(EXPORT_FIELDS, row))
+                record["id"] = _number(record["id"], int)
+                record["quantity"] = _number(record["quantity"], float)
+                chunk.append(json.dumps(record, ensure_ascii=False) + "\n")
+        if chunk:
+            yield "".join(chunk).encode("utf-8")
@@ -0,0 +1,31 @@
+import secrets
+from typing import Optional
+
+from .shared_store import store
+
+# シートのデータのバージョン（書き込みのたびに増える）
+# 共有ストアに置くため、複数のワーカーで動かしても同じ値を参照する
+def table_of(range_name: str) -> str:
+    """A1形式の範囲からシート名を取り出す"""
+    return range_name.split('!')[0].strip("'")
+
+def current(table: str) -> int:
+    """シートの現在のデータバージョンを返す"""
+    return store.counter(f"data_version:{table}")
+
+def bump(table: str) -> int:
+    """シートのデータが変わったことを記録し、新しいバージョンを返す"""
+    return store.incr(f"data_version:{table}")
+
+_epoch: Optional[int] = None
+
+def epoch() -> int:
+    """共有ストアを作るたびに変わる乱数（再起動でバージョンが0から数え直されても、以前の値と区別する）"""
+    global _epoch
+    if _epoch is None:
+        # 消えないようにカウンターとして保存し、最初のワーカーだけが決める
+        with store.lock("data_version:epoch"):
+            if not store.counter("data_version:epoch"):
+                store.incr("data_version:epoch", secrets.randbits(48) | 1)
+            _epoch = store.counter("data_version:epoch")
+    return _epoch
@@ -0,0 +1,118 @@
+import asyncio
+import contextvars
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict, Optional, TypeVar
+
+from .metrics import IO_POOL_TASKS, IO_POOL_WAIT, GaugeFunc
+from .resilience import check_deadline
+
+T = TypeVar("T")
+
+# シート・レシピサイトへのブロッキングな入出力を同時に行うスレッド数
+IO_POOL_SIZE = int(os.getenv("IO_POOL_SIZE", "16"))
+
+class IOPool:
+    """ブロッキングな入出力をイベントループの外で実行する、大きさに上限のあるスレッドプール
+
+    googleapiclientやrequestsはブロッキングなため、async defのハンドラーから直接呼ぶと
+    その間イベントループが止まり、他のリクエストが処理されない。run()で呼び出すと
+    このプールのスレッドで実行し、終わるまで他のリクエストを処理する。
+    スレッドがすべて使用中の間は順番を待ち、待っている数と待ち時間をメトリクスに記録する。
+    トレースの親スパンやリクエストの締め切りは呼び出し元から引き継ぎ、
+    順番を待つ間に締め切りを過ぎた場合は実行せずにDeadlineExceededを送出する。
+    """
+
+    def __init__(self, name: str, max_workers: int):
+        self.name = name
+        self.max_workers = max_workers
+        self.queued = 0
+        self.active = 0
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._lock = threading.Lock()
+        POOLS[name] = self
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(
+                        max_workers=self.max_workers,
+                        thread_name_prefix=self.name
+                    )
+        return self._executor
+
+    def _after_fork(self):
+        # 親プロセスのスレッドは子プロセスには存在しない
+        self._executor = None
+        self._lock = threading.Lock()
+        self.queued = 0
+        self.active = 0
+
+    def _run(self, submitted: float, context: contextvars.Context, function: Callable[..., T], args, kwargs) -> T:
+        with self._lock:
+            self.queued -= 1
+            self.active += 1
+        IO_POOL_WAIT.observe(time.perf_counter() - submitted, pool=self.name)
+        try:
+            return context.run(self._call, function, args, kwargs)
+        finally:
+            with self._lock:
+                self.active -= 1
+
+    @staticmethod
+    def _call(function: Callable[..., T], args, kwargs) -> T:
+        check_deadline()
+        return function(*args, **kwargs)
+
+    def _cancelled(self, future: Future):
+        # 順番を待っている間に呼び出し元が取り消した（実行されないため_runで減らされない）
+        if future.cancelled():
+            with self._lock:
+                self.queued -= 1
+
+    async def run(self, function: Callable[..., T], *args, **kwargs) -> T:
+        """functionをプールのスレッドで実行し、結果を返す"""
+        IO_POOL_TASKS.inc(pool=self.name)
+        context = contextvars.copy_context()
+        with self._lock:
+            self.queued += 1
+        try:
+            future = self._get_executor().submit(self._run, time.perf_counter(), context, function, args, kwargs)
+        except BaseException:
+            with self._lock:
+                self.queued -= 1
+            raise
+        future.add_done_callback(self._cancelled)
+        return await asyncio.wrap_future(future)
+
+    def shutdown(self):
+        """待っている処理を取り消してプールを止める（実行中の処理の終了は待たない）"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+# 名前 -> スレッドプール
+POOLS: Dict[str, IOPool] = {}
+
+IO_POOL_QUEUE_DEPTH = GaugeFunc(
+    "io_pool_queue_depth",
+    "Blocking I/O calls waiting for a free thread",
+    ["pool"],
+    lambda: {(name, ): pool.queued for name, pool in POOLS.items()}
+)
+IO_POOL_ACTIVE = GaugeFunc(
+    "io_pool_active_threads",
+    "Threads currently running blocking I/O calls",
+    ["pool"],
+    lambda: {(name, ): pool.active for name, pool in POOLS.items()}
+)
+
+io_pool = IOPool("io", IO_POOL_SIZE)
+os.register_at_fork(after_in_child=io_pool._after_fork)
+
+async def run_io(function: Callable[..., T], *args, **kwargs) -> T:
+    """シートの読み書きやレシピサイトの取得などのブロッキングな処理をI/Oプールで実行する"""
+    return await io_pool.run(function, *args, **kwargs)
@@ -0,0 +1,299 @@
+import math
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+# レイテンシ（秒）の既定のバケット
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+# バイト数・トークン数のバケット
+SIZE_BUCKETS = (1_000, 10_000, 50_000, 100_000, 250_000, 500_000, 1_000_000, 5_000_000)
+TOKEN_BUCKETS = (50, 100, 250, 500, 1_000, 2_000, 4_000, 8_000, 16_000)
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(f'{extra[0]}="{extra[1]}"')
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+class _Metric:
+    """スレッドごとに値を分けて持つメトリクスの基底クラス
+
+    値の更新は呼び出したスレッド専用の辞書だけを書き換えるためロックを取らない。
+    スレッドの辞書を一覧に登録するのは各スレッドで最初の1回だけで、
+    list.appendはGILの下でアトミックに行われる。/metricsの出力時に全スレッドの値を合算する。
+    """
+
+    type_name = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._shards: List[Dict] = []
+        self._local = threading.local()
+        registry.register(self)
+
+    def _shard(self) -> Dict:
+        shard = getattr(self._local, "values", None)
+        if shard is None:
+            shard = self._local.values = {}
+            self._shards.append(shard)
+        return shard
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def _snapshots(self) -> List[Dict]:
+        # dict.copy()はGILの下で一度に行われるため、書き込み中のスレッドがあっても安全
+        return [shard.copy() for shard in list(self._shards)]
+
+class Counter(_Metric):
+    """増加だけするカウンター"""
+
+    type_name = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        shard = self._shard()
+        key = self._key(labels)
+        shard[key] = shard.get(key, 0) + amount
+
+    def values(self) -> Dict[Tuple[str, ...], float]:
+        totals: Dict[Tuple[str, ...], float] = {}
+        for snapshot in self._snapshots():
+            for key, value in snapshot.items():
+                totals[key] = totals.get(key, 0) + value
+        return totals
+
+    def collect(self) -> List[str]:
+        return [
+            f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+            for key, value in sorted(self.values().items())
+        ]
+
+class Histogram(_Metric):
+    """値の分布をバケットごとに数えるヒストグラム"""
+
+    type_name = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        super().__init__(name, documentation, labelnames)
+
+    def observe(self, value: float, **labels):
+        shard = self._shard()
+        key = self._key(labels)
+        state = shard.get(key)
+        if state is None:
+            # [バケットごとの件数..., 合計, 件数]
+            state = shard[key] = [0] * len(self.buckets) + [0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                state[i] += 1
+                break
+        state[-2] += value
+        state[-1] += 1
+
+    @contextmanager
+    def time(self, **labels) -> Iterator[None]:
+        """with文の区間の所要時間（秒）を記録する"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def collect(self) -> List[str]:
+        totals: Dict[Tuple[str, ...], List[float]] = {}
+        for snapshot in self._snapshots():
+            for key, state in snapshot.items():
+                state = list(state)
+                total = totals.setdefault(key, [0] * len(state))
+                for i, value in enumerate(state):
+                    total[i] += value
+        lines = []
+        for key, state in sorted(totals.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, state):
+                cumulative += count
+                labels = _format_labels(self.labelnames, key, ("le", _format_value(bound)))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(state[-2])}")
+            lines.append(f"{self.name}_count{labels} {int(state[-1])}")
+        return lines
+
+class GaugeFunc(_Metric):
+    """出力時に関数を呼んで値を求めるゲージ（関数はラベルの値のタプル -> 値の辞書を返す）"""
+
+    type_name = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str], function: Callable[[], Dict[Tuple[str, ...], float]]):
+        self.function = function
+        super().__init__(name, documentation, labelnames)
+
+    def collect(self) -> List[str]:
+        return [
+            f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+            for key, value in sorted(self.function().items())
+        ]
+
+class Registry:
+    """メトリクスの一覧とPrometheusのテキスト形式への書き出し"""
+
+    def __init__(self):
+        self._metrics: List[_Metric] = []
+
+    def register(self, metric: _Metric):
+        self._metrics.append(metric)
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.type_name}")
+            lines.extend(metric.collect())
+        return "\n".join(lines) + "\n"
+
+registry = Registry()
+
+# アプリケーション全体で使うメトリクス
+HTTP_LATENCY = Histogram(
+    "http_request_duration_seconds",
+    "Latency of HTTP requests by route",
+    ["method", "route", "status"]
+)
+CHAT_LATENCY = Histogram(
+    "chat_request_duration_seconds",
+    "Latency of /chat turns by action type",
+    ["action", "status"]
+)
+CHAT_ACTION_LATENCY = Histogram(
+    "chat_action_duration_seconds",
+    "Time spent dispatching each chat action",
+    ["action"]
+)
+SHEET_OPERATIONS = Counter(
+    "sheet_operations_total",
+    "Calls of the spreadsheet helper functions",
+    ["operation"]
+)
+SHEET_OPERATION_ERRORS = Counter(
+    "sheet_operation_errors_total",
+    "Failed calls of the spreadsheet helper functions",
+    ["operation"]
+)
+SHEET_OPERATION_LATENCY = Histogram(
+    "sheet_operation_duration_seconds",
+    "Latency of the spreadsheet helper functions",
+    ["operation"]
+)
+GOOGLE_API_REQUESTS = Counter(
+    "google_api_requests_total",
+    "HTTP requests sent to the Sheets and Drive APIs",
+    ["method", "status"]
+)
+OPENAI_REQUESTS = Counter(
+    "openai_requests_total",
+    "Chat completion requests sent to OpenAI",
+    ["model", "status"]
+)
+OPENAI_TOKENS = Counter(
+    "openai_tokens_total",
+    "OpenAI tokens consumed",
+    ["model", "type"]
+)
+OPENAI_TOKENS_PER_CALL = Histogram(
+    "openai_tokens_per_call",
+    "OpenAI tokens per chat completion call",
+    ["model", "type"],
+    buckets=TOKEN_BUCKETS
+)
+OPENAI_LATENCY = Histogram(
+    "openai_request_duration_seconds",
+    "Latency of OpenAI chat completion calls",
+    ["model"]
+)
+RECIPE_FETCH_BYTES = Histogram(
+    "recipe_fetch_bytes",
+    "Size of fetched recipe pages",
+    ["site"],
+    buckets=SIZE_BUCKETS
+)
+RECIPE_FETCH_LATENCY = Histogram(
+    "recipe_fetch_duration_seconds",
+    "Latency of fetching recipe pages",
+    ["site"]
+)
+RECIPE_PARSE_LATENCY = Histogram(
+    "recipe_parse_duration_seconds",
+    "Time spent parsing recipe pages",
+    ["site"]
+)
+RATE_LIMIT_WAIT = Histogram(
+    "rate_limit_wait_seconds",
+    "Time spent waiting for a shared rate limit token",
+    ["bucket"]
+)
+RATE_LIMIT_REJECTED = Counter(
+    "rate_limit_rejected_total",
+    "Calls rejected because the rate limit wait exceeded the limit",
+    ["bucket"]
+)
+EXTERNAL_CALL_RETRIES = Counter(
+    "external_call_retries_total",
+    "Retries of calls to external services by failure kind",
+    ["dependency", "reason"]
+)
+CIRCUIT_BREAKER_TRANSITIONS = Counter(
+    "circuit_breaker_transitions_total",
+    "Circuit breaker state changes per dependency",
+    ["dependency", "state"]
+)
+IO_POOL_TASKS = Counter(
+    "io_pool_tasks_total",
+    "Blocking I/O calls dispatched to the I/O thread pool",
+    ["pool"]
+)
+IO_POOL_WAIT = Histogram(
+    "io_pool_wait_seconds",
+    "Time blocking I/O calls waited for a free thread",
+    ["pool"]
+)
+SINGLE_FLIGHT_CALLS = Counter(
+    "single_flight_calls_total",
+    "Calls that ran (leader) or joined an identical in-flight call (shared)",
+    ["group", "result"]
+)
+CACHE_REQUESTS = Counter(
+    "cache_requests_total",
+    "Cache lookups by result",
+    ["cache", "result"]
+)
+
+def _cache_hit_ratios() -> Dict[Tuple[str, ...], float]:
+    totals: Dict[str, List[float]] = {}
+    for (cache, result), value in CACHE_REQUESTS.values().items():
+        counts = totals.setdefault(cache, [0, 0])
+        counts[0 if result == "hit" else 1] += value
+    return {(cache,): hits / (hits + misses) for cache, (hits, misses) in totals.items() if hits + misses}
+
+CACHE_HIT_RATIO = GaugeFunc(
+    "cache_hit_ratio",
+    "Hit ratio of in-process caches",
+    ["cache"],
+    _cache_hit_ratios
+)
+
+def site_of(url: str) -> str:
+    """URLからラベルに使うサイト名（ホスト名）を取り出す"""
+    host = url.split("://", 1)[-1].split("/", 1)[0]
+    return host.removeprefix("www.") or "unknown"
@@ -0,0 +1,238 @@
+import functools
+import json
+import os
+import re
+import unicodedata
+from typing import Dict, Iterable, List, Optional
+
+from .log import get_logger
+
+logger = get_logger(__name__)
+
+# 材料名によく使われる漢字表記 -> 読み（ひらがな）
+# 「豚肉」と「ぶた肉」、「玉葱」と「玉ねぎ」のような表記ゆれを同じ読みにそろえる。
+# 最も長く一致する表記から置き換えるため、「牛乳」は「牛」+「乳」ではなく「ぎゅうにゅう」になる。
+READINGS: Dict[str, str] = {
+    # 肉・卵
+    "豚": "ぶた",
+    "牛": "ぎゅう",
+    "鶏": "とり",
+    "鳥": "とり",
+    "肉": "にく",
+    "挽き": "ひき",
+    "挽": "ひき",
+    "卵": "たまご",
+    "玉子": "たまご",
+    "鶏卵": "たまご",
+
+    # 野菜・きのこ
+    "玉葱": "たまねぎ",
+    "長葱": "ながねぎ",
+    "葱": "ねぎ",
+    "玉": "たま",
+    "人参": "にんじん",
+    "大根": "だいこん",
+    "胡瓜": "きゅうり",
+    "茄子": "なす",
+    "南瓜": "かぼちゃ",
+    "牛蒡": "ごぼう",
+    "蓮根": "れんこん",
+    "生姜": "しょうが",
+    "大蒜": "にんにく",
+    "白菜": "はくさい",
+    "小松菜": "こまつな",
+    "菠薐草": "ほうれんそう",
+    "法蓮草": "ほうれんそう",
+    "青梗菜": "ちんげんさい",
+    "韮": "にら",
+    "馬鈴薯": "じゃがいも",
+    "薩摩芋": "さつまいも",
+    "里芋": "さといも",
+    "芋": "いも",
+    "椎茸": "しいたけ",
+    "舞茸": "まいたけ",
+    "檸檬": "れもん",
+    "苺": "いちご",
+    "林檎": "りんご",
+    "蜜柑": "みかん",
+
+    # 魚介
+    "鮭": "さけ",
+    "鯖": "さば",
+    "鰯": "いわし",
+    "鯵": "あじ",
+    "海老": "えび",
+    "蝦": "えび",
+    "烏賊": "いか",
+    "蛸": "たこ",
+
+    # 調味料・その他（「酒」は「鮭」と同じ読みになるため含めない）
+    "塩": "しお",
+    "酢": "す",
+    "米": "こめ",
+    "醤油": "しょうゆ",
+    "味醂": "みりん",
+    "味噌": "みそ",
+    "砂糖": "さとう",
+    "胡麻": "ごま",
+    "牛乳": "ぎゅうにゅう",
+    "豆腐": "とうふ",
+    "納豆": "なっとう",
+    "油揚げ": "あぶらあげ",
+    "小麦粉": "こむぎこ",
+    "片栗粉": "かたくりこ",
+}
+
+# 読みの辞書を追加するJSONファイル（{"表記": "読み"}、組み込みの辞書より優先する）
+READINGS_FILE = os.getenv("INGREDIENT_READINGS_FILE")
+
+_SPACES = re.compile(r"\s+")
+# カタカナ（ァ〜ヶ）をひらがなにする
+_KATAKANA_TO_HIRAGANA = {code: code - 0x60 for code in range(ord("ァ"), ord("ヶ") + 1)}
+
+def _fold(text: str) -> str:
+    """NFKCで正規化し、空白を除いて小文字・ひらがなにそろえる"""
+    text = unicodedata.normalize("NFKC", text or "").lower()
+    return _SPACES.sub("", text).translate(_KATAKANA_TO_HIRAGANA)
+
+def _load_readings() -> Dict[str, str]:
+    readings = dict(READINGS)
+    if READINGS_FILE:
+        try:
+            with open(READINGS_FILE, encoding="utf-8") as f:
+                readings.update(json.load(f))
+        except (OSError, ValueError) as e:
+            logger.warning("読みの辞書を読み込めませんでした: %s", e)
+    return {_fold(written): _fold(reading) for written, reading in readings.items()}
+
+_readings = _load_readings()
+_longest_reading = max((len(written) for written in _readings), default=0)
+
+def _to_reading(text: str) -> str:
+    """辞書にある表記を、最も長く一致するものから順に読みに置き換える"""
+    parts = []
+    i = 0
+    while i < len(text):
+        for length in range(min(_longest_reading, len(text) - i), 0, -1):
+            reading = _readings.get(text[i:i + length])
+            if reading is not None:
+                parts.append(reading)
+                i += length
+                break
+        else:
+            parts.append(text[i])
+            i += 1
+    return "".join(parts)
+
+@functools.lru_cache(maxsize=8192)
+def normalize_name(name: str) -> str:
+    """材料名の照合用の表記（NFKC・小文字・ひらがな・読み）にする
+
+    全角/半角・大文字/小文字・カタカナ/ひらがな・空白の違いと、
+    辞書にある漢字表記と読みの違いを吸収する。
+    """
+    return _to_reading(_fold(name))
+
+def edit_distance(a: str, b: str, limit: int) -> int:
+    """2つの文字列の編集距離（limitを超えることが確定したらlimit + 1を返す）"""
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, start=1):
+        current = [i]
+        for j, cb in enumerate(b, start=1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ca != cb)))
+        if min(current) > limit:
+            return limit + 1
+        previous = current
+    return previous[-1]
+
+def max_typos(key: str) -> int:
+    """照合用の表記の長さに応じて許す入力の誤りの数（短い名前ほど誤りを許さない）"""
+    if len(key) <= 2:
+        return 0
+    return 1 if len(key) <= 5 else 2
+
+# 照合に使うn-gramの長さ（名前の前後を埋めてから切り出す）
+GRAM_SIZE = 3
+
+def _grams(key: str) -> set:
+    padded = "^" * (GRAM_SIZE - 1) + key + "$" * (GRAM_SIZE - 1)
+    return {padded[i:i + GRAM_SIZE] for i in range(len(padded) - GRAM_SIZE + 1)}
+
+class NameIndex:
+    """材料名の索引（トライグラムの転置索引）
+
+    名前は照合用の表記（normalize_name）で登録し、表記ゆれは正規化で、
+    入力の誤りは編集距離で吸収する。1文字の誤りで変わるトライグラムは高々3つのため、
+    共通するトライグラムが少なすぎる名前は編集距離を計算せずに除外でき、
+    登録数が多くても編集距離を求めるのは候補の数件だけで済む。
+    """
+
+    def __init__(self, names: Iterable[str] = ()):
+        self._keys: List[str] = []
+        self._positions: Dict[str, int] = {}
+        # トライグラム -> それを含む名前の位置
+        self._postings: Dict[str, List[int]] = {}
+        self._cache: Dict[str, Optional[str]] = {}
+        for name in names:
+            self.add(name)
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def __contains__(self, name: str) -> bool:
+        return normalize_name(name) in self._positions
+
+    def add(self, name: str):
+        key = normalize_name(name)
+        if not key or key in self._positions:
+            return
+        position = self._positions[key] = len(self._keys)
+        self._keys.append(key)
+        for gram in _grams(key):
+            self._postings.setdefault(gram, []).append(position)
+        self._cache.clear()
+
+    def _candidates(self, key: str, limit: int) -> List[str]:
+        grams = _grams(key)
+        # 誤りがlimit個以内なら、少なくともこの数のトライグラムが共通する
+        required = len(grams) - GRAM_SIZE * limit
+        counts: Dict[int, int] = {}
+        for gram in grams:
+            for position in self._postings.get(gram, ()):
+                counts[position] = counts.get(position, 0) + 1
+        if required <= 0:
+            positions = range(len(self._keys))
+        else:
+            positions = [position for position, count in counts.items() if count >= required]
+        return [
+            self._keys[position] for position in positions
+            if abs(len(self._keys[position]) - len(key)) <= limit
+        ]
+
+    def match(self, name: str) -> Optional[str]:
+        """nameに対応する登録済みの照合用の表記を返す
+
+        同じ表記があればそれを、なければ許容範囲で編集距離が最も近いものを返す。
+        最も近いものが複数ある場合は取り違えないよう、見つからなかったものとしてNoneを返す。
+        """
+        key = normalize_name(name)
+        if key in self._positions:
+            return key
+        if key in self._cache:
+            return self._cache[key]
+        limit = max_typos(key)
+        best = None
+        if key and limit:
+            nearest: List[str] = []
+            distance = limit + 1
+            for candidate in self._candidates(key, limit):
+                d = edit_distance(key, candidate, limit)
+                if d < distance:
+                    distance, nearest = d, [candidate]
+                elif d == distance:
+                    nearest.append(candidate)
+            best = nearest[0] if len(nearest) == 1 else None
+        self._cache[key] = best
+        return best
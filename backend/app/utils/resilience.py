@@ -0,0 +1,172 @@
+import contextvars
+import random
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, Optional, Tuple, TypeVar
+
+from .metrics import CIRCUIT_BREAKER_TRANSITIONS, EXTERNAL_CALL_RETRIES, GaugeFunc
+
+T = TypeVar("T")
+
+# リクエストの締め切り（time.monotonic()の値、リクエストやタスクごとに引き継がれる）
+_deadline: contextvars.ContextVar[Optional[float]] = contextvars.ContextVar("deadline", default=None)
+
+# 失敗の種類（classifyが返す値）
+THROTTLED = "throttled"      # 429: リクエストは処理されていないため、常に再試行してよい
+UNAVAILABLE = "unavailable"  # 5xx・タイムアウト・接続エラー: 冪等な呼び出しだけ再試行する
+
+class ServiceUnavailable(Exception):
+    """外部サービスを一時的に呼び出せない（retry_after秒後に再試行できる）"""
+
+    def __init__(self, message: str, retry_after: float = 1.0):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class CircuitOpenError(ServiceUnavailable):
+    """サーキットブレーカーが開いているため呼び出さなかった"""
+
+class DeadlineExceeded(ServiceUnavailable):
+    """リクエストの締め切りを過ぎた"""
+
+@contextmanager
+def deadline(seconds: Optional[float]) -> Iterator[None]:
+    """区間の処理の締め切りを設定する（外側の締め切りより後には延ばさない）"""
+    if seconds is None:
+        yield
+        return
+    new = time.monotonic() + seconds
+    current = _deadline.get()
+    token = _deadline.set(new if current is None else min(current, new))
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+def remaining() -> Optional[float]:
+    """締め切りまでの残り秒数（締め切りがなければNone）"""
+    current = _deadline.get()
+    return None if current is None else current - time.monotonic()
+
+def check_deadline():
+    """締め切りを過ぎていればDeadlineExceededを送出する"""
+    left = remaining()
+    if left is not None and left <= 0:
+        raise DeadlineExceeded("リクエストの締め切りを過ぎました")
+
+class CircuitBreaker:
+    """外部サービスごとのサーキットブレーカー
+
+    続けてfailure_threshold回失敗したら開き、reset_timeout秒の間は呼び出さずに
+    CircuitOpenErrorを送出する。その後は1回だけ試しに呼び出し（半開）、
+    成功すれば閉じ、失敗すればもう一度開く。
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self._opened_at = 0.0
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+        BREAKERS[name] = self
+
+    def _transition(self, state: str):
+        if state != self.state:
+            self.state = state
+            CIRCUIT_BREAKER_TRANSITIONS.inc(dependency=self.name, state=state)
+
+    def before_call(self):
+        """呼び出してよいか確認する（開いている場合はCircuitOpenError）"""
+        with self._lock:
+            if self.state == self.CLOSED:
+                return
+            wait = self._opened_at + self.reset_timeout - time.monotonic()
+            if self.state == self.OPEN and wait <= 0:
+                self._transition(self.HALF_OPEN)
+            if self.state == self.HALF_OPEN and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return
+            raise CircuitOpenError(
+                f"{self.name}は一時的に利用できません",
+                retry_after=max(wait, 1.0)
+            )
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self._trial_in_flight = False
+            self._transition(self.CLOSED)
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._trial_in_flight = False
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+                self._transition(self.OPEN)
+
+    def record_ignored(self):
+        """サービスの障害ではない失敗（4xxなど）の後に呼ぶ"""
+        with self._lock:
+            self._trial_in_flight = False
+
+# 名前 -> サーキットブレーカー
+BREAKERS: Dict[str, CircuitBreaker] = {}
+
+_STATE_VALUES = {CircuitBreaker.CLOSED: 0, CircuitBreaker.HALF_OPEN: 1, CircuitBreaker.OPEN: 2}
+
+CIRCUIT_BREAKER_STATE = GaugeFunc(
+    "circuit_breaker_state",
+    "Circuit breaker state per dependency (0=closed, 1=half-open, 2=open)",
+    ["dependency"],
+    lambda: {(name, ): _STATE_VALUES[breaker.state] for name, breaker in BREAKERS.items()}
+)
+
+def call_with_retries(
+    function: Callable[[], T],
+    breaker: CircuitBreaker,
+    classify: Callable[[Exception], Tuple[Optional[str], Optional[float]]],
+    idempotent: bool = True,
+    attempts: int = 4,
+    base_delay: float = 0.5,
+    max_delay: float = 8.0
+) -> T:
+    """外部サービスの呼び出しを、サーキットブレーカーと指数バックオフの再試行つきで行う
+
+    classifyは例外から (失敗の種類, Retry-Afterの秒数) を返す。種類がNoneの例外は
+    呼び出し側の誤りとしてそのまま送出し、ブレーカーの失敗にも数えない。
+    待ち時間は上限つきの指数関数にジッターを加えたもので、Retry-Afterがあればそれ以上待つ。
+    締め切りまでに次の試行が間に合わない場合は再試行せずに最後の例外を送出する。
+    """
+    for attempt in range(attempts):
+        # 締め切りの確認を先に行う（ブレーカーの試行枠を取ってから送出すると、枠が解放されない）
+        check_deadline()
+        breaker.before_call()
+        try:
+            result = function()
+        except Exception as e:
+            kind, retry_after = classify(e)
+            if kind is None:
+                breaker.record_ignored()
+                raise
+            breaker.record_failure()
+            if attempt == attempts - 1 or (kind == UNAVAILABLE and not idempotent):
+                raise
+            delay = random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+            if retry_after:
+                delay = max(delay, retry_after)
+            left = remaining()
+            if left is not None and delay >= left:
+                raise
+            EXTERNAL_CALL_RETRIES.inc(dependency=breaker.name, reason=kind)
+            time.sleep(delay)
+            continue
+        breaker.record_success()
+        return result
@@ -0,0 +1,293 @@
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from collections import deque
+from typing import Deque, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from .metrics import RATE_LIMIT_REJECTED, RATE_LIMIT_WAIT
+from .resilience import ServiceUnavailable
+
+try:
+    import fcntl
+except ImportError:  # Windowsではプロセス間のロックを使わない
+    fcntl = None
+
+class RateLimitExceeded(ServiceUnavailable):
+    """レート制限の待ち時間が上限を超えた（retry_after秒後にトークンが取れる）"""
+
+class MemoryStore:
+    """1プロセスで動かすときのストア（ワーカー間では共有しない）"""
+
+    def __init__(self, max_entries: int = 1024):
+        self.max_entries = max_entries
+        self._values: Dict[str, Tuple[bytes, Optional[float]]] = {}
+        self._counters: Dict[str, int] = {}
+        self._buckets: Dict[str, Tuple[float, float]] = {}
+        self._locks: Dict[str, threading.RLock] = {}
+        self._logs: Dict[str, Deque[Tuple[int, bytes]]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[bytes]:
+        entry = self._values.get(key)
+        if entry is None:
+            return None
+        value, expires_at = entry
+        if expires_at is not None and expires_at < time.time():
+            self._values.pop(key, None)
+            return None
+        return value
+
+    def set(self, key: str, value: bytes, ttl: Optional[float] = None):
+        with self._lock:
+            if len(self._values) >= self.max_entries:
+                self._values.clear()
+            self._values[key] = (value, time.time() + ttl if ttl else None)
+
+    def counter(self, key: str) -> int:
+        return self._counters.get(key, 0)
+
+    def incr(self, key: str, amount: int = 1) -> int:
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+            return self._counters[key]
+
+    def log_head(self, stream: str) -> int:
+        """ログの最後の番号（まだ追記していなければ0）"""
+        return self.counter(f"log:{stream}")
+
+    def append_log(self, stream: str, values: Sequence[bytes], capacity: int) -> List[int]:
+        """ログに値を追記し、割り当てた連番を返す（直近のcapacity件だけ残す）"""
+        with self._lock:
+            head = self._counters.get(f"log:{stream}", 0)
+            numbers = list(range(head + 1, head + len(values) + 1))
+            log = self._logs.get(stream)
+            if log is None or log.maxlen != capacity:
+                log = self._logs[stream] = deque(log or (), maxlen=capacity)
+            log.extend(zip(numbers, values))
+            self._counters[f"log:{stream}"] = head + len(values)
+            return numbers
+
+    def read_log(self, stream: str, after: int) -> List[Tuple[int, bytes]]:
+        """指定した番号より後のログを番号順に返す"""
+        with self._lock:
+            return [entry for entry in self._logs.get(stream, ()) if entry[0] > after]
+
+    def take_tokens(self, bucket: str, rate: float, capacity: float, tokens: float = 1) -> float:
+        """トークンを取り出す。足りなければ取り出さずに必要な待ち時間（秒）を返す"""
+        with self._lock:
+            now = time.time()
+            available, updated_at = self._buckets.get(bucket, (capacity, now))
+            available = min(capacity, available + (now - updated_at) * rate)
+            wait = 0.0 if available >= tokens else (tokens - available) / rate
+            if not wait:
+                available -= tokens
+            self._buckets[bucket] = (available, now)
+            return wait
+
+    @contextmanager
+    def lock(self, name: str) -> Iterator[None]:
+        with self._lock:
+            lock = self._locks.setdefault(name, threading.RLock())
+        with lock:
+            yield
+
+    def try_acquire_leadership(self, name: str) -> bool:
+        return True
+
+class SqliteStore(MemoryStore):
+    """ワーカー間で共有するストア（SQLiteのファイル1つ、Redisの代わり）
+
+    キャッシュの値・カウンター・トークンバケット・ログをSQLiteに置き、更新は
+    BEGIN IMMEDIATEのトランザクションで行うため、複数のプロセスから同時に
+    呼ばれても値が食い違わない。ロックは同じディレクトリのロックファイルに対する
+    flockで、プロセスが終了すれば自動的に解放される。
+    """
+
+    def __init__(self, path: str, max_entries: int = 10000):
+        super().__init__(max_entries)
+        self.path = path
+        self._local = threading.local()
+        self._leaderships: Dict[str, int] = {}
+        with self._connect() as db:
+            db.executescript("""
+                CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value BLOB, expires_at REAL);
+                CREATE TABLE IF NOT EXISTS counters (key TEXT PRIMARY KEY, value INTEGER NOT NULL);
+                CREATE TABLE IF NOT EXISTS buckets (name TEXT PRIMARY KEY, tokens REAL NOT NULL, updated_at REAL NOT NULL);
+                CREATE TABLE IF NOT EXISTS log (stream TEXT NOT NULL, seq INTEGER NOT NULL, value BLOB NOT NULL, PRIMARY KEY (stream, seq));
+            """)
+
+    def _connect(self) -> sqlite3.Connection:
+        # 接続はスレッドごとに持つ（sqlite3の接続はスレッド間で共有できない）
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+        return db
+
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        db = self._connect()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            yield db
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+
+    def get(self, key: str) -> Optional[bytes]:
+        row = self._connect().execute(
+            "SELECT value FROM kv WHERE key = ? AND (expires_at IS NULL OR expires_at >= ?)",
+            (key, time.time())
+        ).fetchone()
+        return row[0] if row else None
+
+    def set(self, key: str, value: bytes, ttl: Optional[float] = None):
+        with self._transaction() as db:
+            count = db.execute("SELECT COUNT(*) FROM kv").fetchone()[0]
+            if count >= self.max_entries:
+                # 期限切れを消しても溢れる場合は古い順に半分消す
+                db.execute("DELETE FROM kv WHERE expires_at IS NOT NULL AND expires_at < ?", (time.time(),))
+                db.execute("DELETE FROM kv WHERE rowid IN (SELECT rowid FROM kv ORDER BY rowid LIMIT ?)", (self.max_entries // 2,))
+            db.execute(
+                "INSERT OR REPLACE INTO kv (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, value, time.time() + ttl if ttl else None)
+            )
+
+    def counter(self, key: str) -> int:
+        row = self._connect().execute("SELECT value FROM counters WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else 0
+
+    def incr(self, key: str, amount: int = 1) -> int:
+        with self._transaction() as db:
+            db.execute(
+                "INSERT INTO counters (key, value) VALUES (?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET value = value + excluded.value",
+                (key, amount)
+            )
+            return db.execute("SELECT value FROM counters WHERE key = ?", (key,)).fetchone()[0]
+
+    def append_log(self, stream: str, values: Sequence[bytes], capacity: int) -> List[int]:
+        # 番号の割り当てと追記を同じトランザクションで行うため、ワーカー間でも連番が重ならない
+        with self._transaction() as db:
+            key = f"log:{stream}"
+            db.execute(
+                "INSERT INTO counters (key, value) VALUES (?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET value = value + excluded.value",
+                (key, len(values))
+            )
+            head = db.execute("SELECT value FROM counters WHERE key = ?", (key,)).fetchone()[0]
+            numbers = list(range(head - len(values) + 1, head + 1))
+            db.executemany(
+                "INSERT INTO log (stream, seq, value) VALUES (?, ?, ?)",
+                [(stream, number, value) for number, value in zip(numbers, values)]
+            )
+            db.execute("DELETE FROM log WHERE stream = ? AND seq <= ?", (stream, head - capacity))
+            return numbers
+
+    def read_log(self, stream: str, after: int) -> List[Tuple[int, bytes]]:
+        return self._connect().execute(
+            "SELECT seq, value FROM log WHERE stream = ? AND seq > ? ORDER BY seq",
+            (stream, after)
+        ).fetchall()
+
+    def take_tokens(self, bucket: str, rate: float, capacity: float, tokens: float = 1) -> float:
+        with self._transaction() as db:
+            now = time.time()
+            row = db.execute("SELECT tokens, updated_at FROM buckets WHERE name = ?", (bucket,)).fetchone()
+            available, updated_at = row if row else (capacity, now)
+            available = min(capacity, available + max(now - updated_at, 0) * rate)
+            wait = 0.0 if available >= tokens else (tokens - available) / rate
+            if not wait:
+                available -= tokens
+            db.execute(
+                "INSERT OR REPLACE INTO buckets (name, tokens, updated_at) VALUES (?, ?, ?)",
+                (bucket, available, now)
+            )
+            return wait
+
+    def _lock_path(self, name: str) -> str:
+        return f"{self.path}.{name.replace(':', '_').replace('/', '_')}.lock"
+
+    @contextmanager
+    def lock(self, name: str) -> Iterator[None]:
+        # 同じプロセス内のスレッドはRLockで、プロセス間はflockで排他する
+        with super().lock(name):
+            if fcntl is None:
+                yield
+                return
+            with open(self._lock_path(name), "a") as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def try_acquire_leadership(self, name: str) -> bool:
+        """名前ごとに1つのプロセスだけが持てる役割を取得する（プロセスの終了まで保持）"""
+        if fcntl is None or name in self._leaderships:
+            return True
+        fd = os.open(self._lock_path(f"leader-{name}"), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return False
+        self._leaderships[name] = fd
+        return True
+
+    def _after_fork(self):
+        # sqlite3の接続とロックはfork前のものを子プロセスで使えないため作り直す
+        self._local = threading.local()
+        self._leaderships = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+def _create_store() -> MemoryStore:
+    path = os.getenv("SHARED_STORE_PATH")
+    return SqliteStore(path) if path else MemoryStore()
+
+store = _create_store()
+if isinstance(store, SqliteStore):
+    os.register_at_fork(after_in_child=store._after_fork)
+
+class TokenBucket:
+    """全ワーカーで共有するトークンバケット（外部APIの呼び出し回数の制限）"""
+
+    def __init__(self, name: str, per_minute: float, burst: Optional[float] = None, max_wait: float = 10.0):
+        self.name = name
+        self.rate = per_minute / 60
+        self.capacity = burst or per_minute
+        self.max_wait = max_wait
+
+    def acquire(self, tokens: float = 1):
+        """トークンが取れるまで待つ（待ち時間がmax_waitを超える場合はRateLimitExceeded）"""
+        if self.rate <= 0:
+            return
+        started = time.monotonic()
+        deadline = started + self.max_wait
+        while True:
+            wait = store.take_tokens(self.name, self.rate, self.capacity, tokens)
+            if not wait:
+                RATE_LIMIT_WAIT.observe(time.monotonic() - started, bucket=self.name)
+                return
+            if time.monotonic() + wait > deadline:
+                RATE_LIMIT_REJECTED.inc(bucket=self.name)
+                raise RateLimitExceeded(f"{self.name}のレート制限を超えました（{wait:.1f}秒待ちが必要）", retry_after=wait)
+            time.sleep(wait)
+
+# Sheets APIの既定の上限はユーザーごとに毎分60リクエスト
+SHEETS_RATE_LIMIT = TokenBucket(
+    "sheets",
+    float(os.getenv("SHEETS_REQUESTS_PER_MINUTE", "60")),
+    max_wait=float(os.getenv("RATE_LIMIT_MAX_WAIT", "10"))
+)
+OPENAI_RATE_LIMIT = TokenBucket(
+    "openai",
+    float(os.getenv("OPENAI_REQUESTS_PER_MINUTE", "500")),
+    max_wait=float(os.getenv("RATE_LIMIT_MAX_WAIT", "10"))
+)
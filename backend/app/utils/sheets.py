@@ -1,154 +1,418 @@
+from google.oauth2 import service_account
 from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
 from google.auth.transport.requests import Request
+from google_auth_httplib2 import AuthorizedHttp
 from googleapiclient.discovery import build
-import os.path
+from googleapiclient.errors import HttpError
+from googleapiclient.http import HttpRequest
+from datetime import datetime
+import functools
+import httplib2
+import json
+import os
 import pickle
+import sys
+import threading
+import time
+from . import data_version
+from .log import get_logger
+from .metrics import GOOGLE_API_REQUESTS, SHEET_OPERATION_ERRORS, SHEET_OPERATION_LATENCY, SHEET_OPERATIONS
+from .resilience import THROTTLED, UNAVAILABLE, CircuitBreaker, call_with_retries
+from .shared_store import SHEETS_RATE_LIMIT
+from .single_flight import SingleFlight
+from .tracing import span
+
+logger = get_logger(__name__)
+
+# シートの更新検知にDriveのリビジョンを使うか（drive.metadata.readonlyの権限が必要なため指定した場合のみ。
+# 使わない場合は監視する範囲のチェックサムで検知する）
+SHEETS_WATCH_DRIVE = os.getenv("SHEETS_WATCH_DRIVE", "false").lower() in ("1", "true", "yes")
 
 # スコープの設定（必要最小限の権限に制限）
 SCOPES = ['https://www.googleapis.com/auth/spreadsheets']
+if SHEETS_WATCH_DRIVE:
+    SCOPES.append('https://www.googleapis.com/auth/drive.metadata.readonly')
 
-def get_google_sheets_service():
-    """Google Sheets APIのサービスを取得する"""
-    creds = None
-    
-    # トークンが存在する場合は読み込む
-    if os.path.exists('token.pickle'):
-        with open('token.pickle', 'rb') as token:
-            creds = pickle.load(token)
-    
-    # 有効な認証情報がない場合は新規取得
-    if not creds or not creds.valid:
-        if creds and creds.expired and creds.refresh_token:
+# 認証情報のファイルはbackendディレクトリを基準にする（起動時のカレントディレクトリに依存しない）
+BACKEND_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+TOKEN_FILE = os.getenv("GOOGLE_TOKEN_FILE", os.path.join(BACKEND_DIR, 'token.json'))
+LEGACY_TOKEN_FILE = os.path.join(BACKEND_DIR, 'token.pickle')
+CLIENT_SECRETS_FILE = os.getenv("GOOGLE_CLIENT_SECRETS_FILE", os.path.join(BACKEND_DIR, 'credentials.json'))
+
+# 有効期限のこの秒数前からバックグラウンドでトークンを更新する
+TOKEN_REFRESH_MARGIN = float(os.getenv("GOOGLE_TOKEN_REFRESH_MARGIN", "300"))
+
+# 読み込んだ認証情報（プロセス内で使い回し、リクエストのたびにファイルを読まない）
+_credentials = None
+_credentials_lock = threading.Lock()
+_refreshing = threading.Event()
+
+def _interactive_auth_allowed() -> bool:
+    """ブラウザでの認証を行ってよいか（既定では端末から起動した場合だけ）"""
+    setting = os.getenv("GOOGLE_AUTH_INTERACTIVE")
+    if setting is not None:
+        return setting.lower() in ("1", "true", "yes")
+    return sys.stdin is not None and sys.stdin.isatty()
+
+def _save_token(creds: Credentials):
+    """OAuthのトークンをJSONで保存する（リフレッシュトークンを得たときだけ呼ぶ）"""
+    fd = os.open(TOKEN_FILE, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w') as f:
+        f.write(creds.to_json())
+
+def _load_credentials():
+    """認証情報を読み込む
+
+    優先順位: サービスアカウント（GOOGLE_SERVICE_ACCOUNT_JSON・GOOGLE_SERVICE_ACCOUNT_FILE・
+    GOOGLE_APPLICATION_CREDENTIALS）、OAuthのトークン（GOOGLE_OAUTH_TOKEN_JSON・token.json・
+    旧形式のtoken.pickle）、ブラウザでの認証の順。
+    保存済みのOAuthのトークンは許可を得たときのスコープのまま読み込む
+    （スコープを足すと更新時にinvalid_scopeになるため）。
+    """
+    info = os.getenv("GOOGLE_SERVICE_ACCOUNT_JSON")
+    if info:
+        return service_account.Credentials.from_service_account_info(json.loads(info), scopes=SCOPES)
+    path = os.getenv("GOOGLE_SERVICE_ACCOUNT_FILE") or os.getenv("GOOGLE_APPLICATION_CREDENTIALS")
+    if path:
+        return service_account.Credentials.from_service_account_file(path, scopes=SCOPES)
+
+    token = os.getenv("GOOGLE_OAUTH_TOKEN_JSON")
+    if token:
+        return Credentials.from_authorized_user_info(json.loads(token))
+    if os.path.exists(TOKEN_FILE):
+        return Credentials.from_authorized_user_file(TOKEN_FILE)
+    if os.path.exists(LEGACY_TOKEN_FILE):
+        # 旧形式（pickle）のトークンは一度だけ読み込み、JSONに移し替える
+        with open(LEGACY_TOKEN_FILE, 'rb') as f:
+            creds = pickle.load(f)
+        _save_token(creds)
+        logger.info("token.pickleを%sに移行しました", TOKEN_FILE)
+        return creds
+
+    if not _interactive_auth_allowed():
+        raise RuntimeError(
+            "Google APIの認証情報がありません。GOOGLE_SERVICE_ACCOUNT_FILEなどでサービスアカウントを指定するか、"
+            "端末から起動して初回の認証を行ってください"
+        )
+    # ブラウザでの認証は初回だけなので、必要になるまで読み込まない
+    from google_auth_oauthlib.flow import InstalledAppFlow
+    flow = InstalledAppFlow.from_client_secrets_file(CLIENT_SECRETS_FILE, SCOPES)
+    creds = flow.run_local_server(port=0)
+    _save_token(creds)
+    return creds
+
+def _refresh_in_background(creds):
+    def refresh():
+        try:
             creds.refresh(Request())
-        else:
-            flow = InstalledAppFlow.from_client_secrets_file(
-                'credentials.json', SCOPES)
-            creds = flow.run_local_server(port=0)
-        
-        # トークンを保存
-        with open('token.pickle', 'wb') as token:
-            pickle.dump(creds, token)
+        except Exception as e:
+            logger.warning("認証トークンの更新に失敗しました: %s", e)
+        finally:
+            _refreshing.clear()
+
+    if not _refreshing.is_set():
+        _refreshing.set()
+        threading.Thread(target=refresh, name="google-token-refresh", daemon=True).start()
+
+def get_credentials():
+    """Google APIの認証情報を取得する
+
+    読み込みは最初の1回だけで、以降はメモリ上の認証情報を返す。
+    期限切れが近づいたらバックグラウンドで更新するため、通常はリクエストを待たせない。
+    トークンの更新はファイルに書き戻さない（リフレッシュトークンは変わらない）。
+    """
+    global _credentials
+    creds = _credentials
+    if creds is None:
+        with _credentials_lock:
+            if _credentials is None:
+                _credentials = _load_credentials()
+            creds = _credentials
+
+    if not creds.valid:
+        # 期限切れ、またはサービスアカウントで未取得の場合はその場で取得する
+        with _credentials_lock:
+            if not creds.valid:
+                creds.refresh(Request())
+    elif creds.expiry is not None:
+        remaining = (creds.expiry - datetime.utcnow()).total_seconds()
+        if remaining < TOKEN_REFRESH_MARGIN:
+            _refresh_in_background(creds)
+    return creds
+
+# Google APIの1回のHTTPリクエストのタイムアウト（秒）
+GOOGLE_API_TIMEOUT = float(os.getenv("GOOGLE_API_TIMEOUT", "10"))
+
+# 同じリクエストを2回送ると結果が変わるメソッド（5xxやタイムアウトの後は再試行しない）
+NON_IDEMPOTENT_METHODS = {
+    "sheets.spreadsheets.batchUpdate",
+    "sheets.spreadsheets.values.append"
+}
+
+GOOGLE_BREAKER = CircuitBreaker(
+    "google_sheets",
+    failure_threshold=int(os.getenv("GOOGLE_BREAKER_THRESHOLD", "5")),
+    reset_timeout=float(os.getenv("GOOGLE_BREAKER_RESET_SECONDS", "30"))
+)
+
+def classify_google_error(error: Exception):
+    """Google APIの例外を再試行の判断に使う種類に分ける"""
+    if isinstance(error, HttpError):
+        status = error.resp.status
+        if status == 429:
+            retry_after = error.resp.get("retry-after")
+            return THROTTLED, float(retry_after) if retry_after and retry_after.isdigit() else None
+        if status >= 500:
+            return UNAVAILABLE, None
+        return None, None
+    if isinstance(error, (OSError, httplib2.HttpLib2Error)):
+        # タイムアウト・接続エラー
+        return UNAVAILABLE, None
+    return None, None
+
+class TracedHttpRequest(HttpRequest):
+    """Google APIの呼び出しごとにスパンを記録するリクエスト
+
+    全ワーカー共通のレート制限を通し、429・5xxはバックオフして再試行する。
+    失敗が続いた場合はサーキットブレーカーが開き、しばらくは呼び出さずに失敗させる。
+    """
+
+    def execute(self, http=None, num_retries=0):
+        method = self.methodId or "google.api"
+        return call_with_retries(
+            lambda: self._execute_once(method, http, num_retries),
+            breaker=GOOGLE_BREAKER,
+            classify=classify_google_error,
+            idempotent=method not in NON_IDEMPOTENT_METHODS
+        )
+
+    def _execute_once(self, method: str, http, num_retries: int):
+        SHEETS_RATE_LIMIT.acquire()
+        with span(
+            method,
+            kind="CLIENT",
+            **{"http.method": self.method, "http.url": self.uri.split("?")[0]}
+        ):
+            try:
+                result = super().execute(http=http, num_retries=num_retries)
+            except HttpError as e:
+                GOOGLE_API_REQUESTS.inc(method=method, status=str(e.resp.status))
+                raise
+            except Exception:
+                GOOGLE_API_REQUESTS.inc(method=method, status="error")
+                raise
+            GOOGLE_API_REQUESTS.inc(method=method, status="ok")
+            return result
+
+def _instrumented(function):
+    """シート操作の呼び出し回数・エラー数・所要時間をメトリクスに記録する"""
+    operation = function.__name__
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        SHEET_OPERATIONS.inc(operation=operation)
+        started = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        except Exception:
+            SHEET_OPERATION_ERRORS.inc(operation=operation)
+            raise
+        finally:
+            SHEET_OPERATION_LATENCY.observe(time.perf_counter() - started, operation=operation)
+    return wrapper
 
-    return build('sheets', 'v4', credentials=creds)
+# スレッドごとのサービス（httplib2の接続はスレッド間で共有できないため）
+_services = threading.local()
+
+def _reset_services():
+    # fork後の子プロセスでは親の接続を使わない
+    global _services
+    _services = threading.local()
+
+os.register_at_fork(after_in_child=_reset_services)
+
+def _service(name: str, version: str):
+    service = getattr(_services, name, None)
+    if service is None:
+        http = AuthorizedHttp(get_credentials(), http=httplib2.Http(timeout=GOOGLE_API_TIMEOUT))
+        service = build(name, version, http=http, requestBuilder=TracedHttpRequest)
+        setattr(_services, name, service)
+    else:
+        # 認証情報の期限の確認（必要ならバックグラウンドで更新）だけを行う
+        get_credentials()
+    return service
+
+def get_google_sheets_service():
+    """Google Sheets APIのサービスを取得する（スレッドごとに1回だけ作成する）"""
+    return _service('sheets', 'v4')
+
+def get_drive_service():
+    """Google Drive APIのサービスを取得する（ファイルのメタデータ参照用）"""
+    return _service('drive', 'v3')
+
+def get_spreadsheet_revision(spreadsheet_id: str) -> str:
+    """スプレッドシートのリビジョン（編集のたびに増えるDriveのversion）を取得する"""
+    metadata = get_drive_service().files().get(
+        fileId=spreadsheet_id,
+        fields='version,modifiedTime'
+    ).execute()
+    return str(metadata.get('version') or metadata.get('modifiedTime'))
+
+# Metaシートの初期内容（各シートの次に採番するID）
+META_ROWS = [
+    ['key', 'value'],
+    ['ingredients_next_id', ''],
+    ['recipes_next_id', '']
+]
+
+# スプレッドシートID -> {シート名: sheetId}
+_sheet_id_cache = {}
+
+def get_sheet_id(spreadsheet_id: str, title: str) -> int:
+    """シート名から行削除などに使うsheetIdを取得する"""
+    sheet_ids = _sheet_id_cache.get(spreadsheet_id)
+    if sheet_ids is None or title not in sheet_ids:
+        service = get_google_sheets_service()
+        spreadsheet = service.spreadsheets().get(
+            spreadsheetId=spreadsheet_id,
+            fields='sheets.properties(title,sheetId)'
+        ).execute()
+        sheet_ids = {
+            s['properties']['title']: s['properties']['sheetId']
+            for s in spreadsheet.get('sheets', [])
+        }
+        _sheet_id_cache[spreadsheet_id] = sheet_ids
+    return sheet_ids[title]
+
+# シート名 -> ヘッダー行
+SHEET_HEADERS = {
+    'Ingredients': ['id', 'name', 'quantity', 'unit', 'expiry_date', 'updated_at', 'category'],
+    'Recipes': ['id', 'name', 'ingredients', 'servings', 'url', 'category', 'last_cooked']
+}
+
+def _header_format_request(sheet_id: int) -> dict:
+    """ヘッダー行を太字・灰色の背景にするrepeatCellリクエストを作る"""
+    return {
+        'repeatCell': {
+            'range': {
+                'sheetId': sheet_id,
+                'startRowIndex': 0,
+                'endRowIndex': 1
+            },
+            'cell': {
+                'userEnteredFormat': {
+                    'backgroundColor': {
+                        'red': 0.8,
+                        'green': 0.8,
+                        'blue': 0.8
+                    },
+                    'textFormat': {
+                        'bold': True
+                    }
+                }
+            },
+            'fields': 'userEnteredFormat(backgroundColor,textFormat)'
+        }
+    }
 
 def initialize_sheets(spreadsheet_id: str):
-    """スプレッドシートの初期化（ヘッダー行の設定）"""
+    """スプレッドシートの初期化（ヘッダー行の設定）
+
+    ヘッダーが既に入っているシートには書き込まないため、初期化済みのスプレッドシートでは
+    シートの一覧とヘッダー行を読むだけで終わる。
+    """
     try:
         service = get_google_sheets_service()
         sheet = service.spreadsheets()
         
-        # スプレッドシートの情報を取得
-        spreadsheet = sheet.get(spreadsheetId=spreadsheet_id).execute()
-        sheets = spreadsheet.get('sheets', [])
-        
         # シートIDを取得
-        sheet_ids = {}
-        for s in sheets:
-            sheet_ids[s['properties']['title']] = s['properties']['sheetId']
-        
-        # 材料シートのヘッダー
-        ingredients_headers = [
-            ['id', 'name', 'quantity', 'unit', 'expiry_date', 'updated_at', 'category']
-        ]
-        
-        # レシピシートのヘッダー
-        recipes_headers = [
-            ['id', 'name', 'ingredients', 'servings', 'url', 'category', 'last_cooked']
-        ]
+        spreadsheet = sheet.get(
+            spreadsheetId=spreadsheet_id,
+            fields='sheets.properties(title,sheetId)'
+        ).execute()
+        sheet_ids = {
+            s['properties']['title']: s['properties']['sheetId']
+            for s in spreadsheet.get('sheets', [])
+        }
         
-        # ヘッダーの書き込み
-        if 'Ingredients' in sheet_ids:
-            sheet.values().update(
+        # ID採番用のMetaシートがない場合は作成する
+        if 'Meta' not in sheet_ids:
+            reply = sheet.batchUpdate(
                 spreadsheetId=spreadsheet_id,
-                range='Ingredients!A1',
-                valueInputOption='RAW',
-                body={'values': ingredients_headers}
+                body={'requests': [{'addSheet': {'properties': {'title': 'Meta'}}}]}
             ).execute()
-        
-        if 'Recipes' in sheet_ids:
+            sheet_ids['Meta'] = reply['replies'][0]['addSheet']['properties']['sheetId']
             sheet.values().update(
                 spreadsheetId=spreadsheet_id,
-                range='Recipes!A1',
+                range='Meta!A1',
                 valueInputOption='RAW',
-                body={'values': recipes_headers}
+                body={'values': META_ROWS}
             ).execute()
+        _sheet_id_cache[spreadsheet_id] = sheet_ids
         
-        # ヘッダー行の書式設定
-        requests = []
-        
-        # Ingredientsシートの書式設定
-        if 'Ingredients' in sheet_ids:
-            requests.append({
-                'repeatCell': {
-                    'range': {
-                        'sheetId': sheet_ids['Ingredients'],
-                        'startRowIndex': 0,
-                        'endRowIndex': 1
-                    },
-                    'cell': {
-                        'userEnteredFormat': {
-                            'backgroundColor': {
-                                'red': 0.8,
-                                'green': 0.8,
-                                'blue': 0.8
-                            },
-                            'textFormat': {
-                                'bold': True
-                            }
-                        }
-                    },
-                    'fields': 'userEnteredFormat(backgroundColor,textFormat)'
-                }
-            })
-        
-        # Recipesシートの書式設定
-        if 'Recipes' in sheet_ids:
-            requests.append({
-                'repeatCell': {
-                    'range': {
-                        'sheetId': sheet_ids['Recipes'],
-                        'startRowIndex': 0,
-                        'endRowIndex': 1
-                    },
-                    'cell': {
-                        'userEnteredFormat': {
-                            'backgroundColor': {
-                                'red': 0.8,
-                                'green': 0.8,
-                                'blue': 0.8
-                            },
-                            'textFormat': {
-                                'bold': True
-                            }
-                        }
-                    },
-                    'fields': 'userEnteredFormat(backgroundColor,textFormat)'
-                }
-            })
-        
-        if requests:
+        # ヘッダーが違うシートだけ書き込み、書式を設定する
+        tables = [table for table in SHEET_HEADERS if table in sheet_ids]
+        if not tables:
+            return
+        current = batch_read_sheet(spreadsheet_id, [f"{table}!A1:G1" for table in tables])
+        missing = [
+            table for table, values in zip(tables, current)
+            if not values or values[0] != SHEET_HEADERS[table]
+        ]
+        if missing:
+            batch_update_sheet(spreadsheet_id, [
+                (f"{table}!A1", [SHEET_HEADERS[table]]) for table in missing
+            ])
             sheet.batchUpdate(
                 spreadsheetId=spreadsheet_id,
-                body={'requests': requests}
+                body={'requests': [_header_format_request(sheet_ids[table]) for table in missing]}
             ).execute()
+            logger.info("ヘッダー行を設定しました: %s", ", ".join(missing))
         
-        print("スプレッドシートの初期化が完了しました。")
+        logger.info("スプレッドシートの初期化が完了しました。")
     
-    except Exception as e:
-        print(f"スプレッドシートの初期化中にエラーが発生しました: {str(e)}")
+    except Exception:
+        logger.exception("スプレッドシートの初期化中にエラーが発生しました")
         raise
 
+# 同じ範囲の同時の読み込みをまとめる
+_reads = SingleFlight("sheets_read")
+
+def _read_version(ranges: list) -> tuple:
+    """範囲のシートのデータバージョン（書き込みの後に始めた読み込みを、それより前の読み込みとまとめない）"""
+    return tuple(data_version.current(data_version.table_of(range_name)) for range_name in ranges)
+
+@_instrumented
 def read_sheet(spreadsheet_id: str, range_name: str):
-    """スプレッドシートからデータを読み取る"""
-    service = get_google_sheets_service()
-    sheet = service.spreadsheets()
-    result = sheet.values().get(
-        spreadsheetId=spreadsheet_id,
-        range=range_name
-    ).execute()
-    return result.get('values', [])
+    """スプレッドシートからデータを読み取る（同じ範囲の同時の読み込みは1回にまとめる）"""
+    def read():
+        service = get_google_sheets_service()
+        sheet = service.spreadsheets()
+        result = sheet.values().get(
+            spreadsheetId=spreadsheet_id,
+            range=range_name
+        ).execute()
+        return result.get('values', [])
+
+    key = ("get", spreadsheet_id, range_name, _read_version([range_name]))
+    return _reads.do(key, read)
+
+@_instrumented
+def batch_read_sheet(spreadsheet_id: str, ranges: list) -> list:
+    """複数の範囲のデータを1回のリクエストでまとめて読み取る"""
+    def read():
+        service = get_google_sheets_service()
+        sheet = service.spreadsheets()
+        result = sheet.values().batchGet(
+            spreadsheetId=spreadsheet_id,
+            ranges=ranges
+        ).execute()
+        return [value_range.get('values', []) for value_range in result.get('valueRanges', [])]
+
+    key = ("batchGet", spreadsheet_id, tuple(ranges), _read_version(ranges))
+    return _reads.do(key, read)
 
+@_instrumented
 def write_sheet(spreadsheet_id: str, range_name: str, values: list):
     """スプレッドシートにデータを書き込む"""
     try:
@@ -180,13 +444,15 @@ def write_sheet(spreadsheet_id: str, range_name: str, values: list):
             body=body
         ).execute()
         
-        print(f"データの書き込みが完了しました: {result}")
+        data_version.bump(data_version.table_of(range_name))
+        logger.debug("データの書き込みが完了しました", extra={"range": range_name, "updated_cells": result.get("updatedCells")})
         return result
     
-    except Exception as e:
-        print(f"データの書き込み中にエラーが発生しました: {str(e)}")
+    except Exception:
+        logger.exception("データの書き込み中にエラーが発生しました", extra={"range": range_name})
         raise
 
+@_instrumented
 def update_sheet(spreadsheet_id: str, range_name: str, values: list):
     """スプレッドシートのデータを更新する"""
     service = get_google_sheets_service()
@@ -200,14 +466,17 @@ def update_sheet(spreadsheet_id: str, range_name: str, values: list):
         valueInputOption='RAW',
         body=body
     ).execute()
+    data_version.bump(data_version.table_of(range_name))
     return result
 
+@_instrumented
 def delete_sheet(spreadsheet_id: str, range_name: str):
     """スプレッドシートのデータを削除する"""
     service = get_google_sheets_service()
     sheet = service.spreadsheets()
     
     # 行を削除するリクエストを作成
+    sheet_id = get_sheet_id(spreadsheet_id, range_name.split('!')[0])
     start_row = int(range_name.split('!')[1].split(':')[0][1:]) - 1  # 0-based index
     end_row = int(range_name.split('!')[1].split(':')[1][1:])  # 1-based index
     
@@ -215,7 +484,7 @@ def delete_sheet(spreadsheet_id: str, range_name: str):
         'requests': [{
             'deleteDimension': {
                 'range': {
-                    'sheetId': 0,  # Ingredientsシート
+                    'sheetId': sheet_id,
                     'dimension': 'ROWS',
                     'startIndex': start_row,
                     'endIndex': end_row
@@ -229,5 +498,82 @@ def delete_sheet(spreadsheet_id: str, range_name: str):
         spreadsheetId=spreadsheet_id,
         body=request
     ).execute()
+    data_version.bump(data_version.table_of(range_name))
     
-    return result 
\ No newline at end of file
+    return result 
+
+@_instrumented
+def batch_update_sheet(spreadsheet_id: str, data: list):
+    """複数の範囲のデータを1回のリクエストでまとめて更新する"""
+    service = get_google_sheets_service()
+    sheet = service.spreadsheets()
+    body = {
+        'valueInputOption': 'RAW',
+        'data': [
+            {'range': range_name, 'values': values}
+            for range_name, values in data
+        ]
+    }
+    result = sheet.values().batchUpdate(
+        spreadsheetId=spreadsheet_id,
+        body=body
+    ).execute()
+    for table in {data_version.table_of(range_name) for range_name, _ in data}:
+        data_version.bump(table)
+    return result
+
+def _cell_data(value) -> dict:
+    """RAWでの書き込みと同じ扱いになるようにセルの値を変換する"""
+    if value is None or value == '':
+        return {}
+    if isinstance(value, bool):
+        return {'userEnteredValue': {'boolValue': value}}
+    if isinstance(value, (int, float)):
+        return {'userEnteredValue': {'numberValue': value}}
+    return {'userEnteredValue': {'stringValue': str(value)}}
+
+def update_cells_request(sheet_id: int, start_row: int, values: list, start_column: int = 0) -> dict:
+    """指定した行（1始まり）から値を書き込むupdateCellsリクエストを作る"""
+    return {
+        'updateCells': {
+            'start': {
+                'sheetId': sheet_id,
+                'rowIndex': start_row - 1,
+                'columnIndex': start_column
+            },
+            'rows': [
+                {'values': [_cell_data(value) for value in row]}
+                for row in values
+            ],
+            'fields': 'userEnteredValue'
+        }
+    }
+
+def delete_row_request(sheet_id: int, row: int) -> dict:
+    """指定した行（1始まり）を削除するdeleteDimensionリクエストを作る"""
+    return {
+        'deleteDimension': {
+            'range': {
+                'sheetId': sheet_id,
+                'dimension': 'ROWS',
+                'startIndex': row - 1,
+                'endIndex': row
+            }
+        }
+    }
+
+@_instrumented
+def batch_mutate_sheet(spreadsheet_id: str, requests: list, tables: list):
+    """書き込み・行削除のリクエストを1回のbatchUpdateでまとめて実行する
+
+    spreadsheets.batchUpdateはすべてのリクエストが成功した場合だけ反映されるため、
+    途中で失敗しても一部だけ書き込まれた状態にはならない。
+    """
+    service = get_google_sheets_service()
+    result = service.spreadsheets().batchUpdate(
+        spreadsheetId=spreadsheet_id,
+        body={'requests': requests}
+    ).execute()
+    for table in set(tables):
+        data_version.bump(table)
+    return result
@@ -0,0 +1,84 @@
+import copy
+import threading
+from typing import Callable, Dict, Hashable, Tuple, TypeVar
+
+from .metrics import SINGLE_FLIGHT_CALLS
+from .resilience import CircuitOpenError, DeadlineExceeded, remaining
+
+T = TypeVar("T")
+
+# 実行した呼び出し元だけの事情による失敗（締め切り・ブレーカー）。待っていた呼び出しには共有せず、改めて実行する
+_LEADER_ONLY_ERRORS = (DeadlineExceeded, CircuitOpenError)
+
+def _copy_error(error: BaseException) -> BaseException:
+    """呼び出し元ごとに送出する例外（同じオブジェクトを複数のスレッドで送出しない）"""
+    try:
+        return copy.copy(error)
+    except Exception:
+        return error
+
+class _Call:
+    """実行中の呼び出し（結果か例外と、結果を待っている呼び出しの数）"""
+
+    __slots__ = ("done", "result", "error", "waiters")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+class SingleFlight:
+    """同じキーの同時の呼び出しを1回の実行にまとめる
+
+    実行中のキーで呼び出すと、新たに実行せずに実行中の呼び出しの終了を待ち、
+    その結果（または例外）を受け取る。結果を複数の呼び出し元で受け取る場合は
+    それぞれにコピーを返すため、呼び出し元が結果を書き換えても互いに影響しない。
+    例外は呼び出し元ごとに複製し、実行した呼び出しの例外を原因として連結する。
+    実行した呼び出し元の締め切りやブレーカーによる失敗の場合は、待っていた呼び出しが改めて実行する。
+    終了した呼び出しの結果は保持しない（キャッシュではない）。
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._calls: Dict[Hashable, _Call] = {}
+        self._lock = threading.Lock()
+
+    def _join(self, key: Hashable) -> Tuple[_Call, bool]:
+        """実行中の呼び出しに加わる（なければ新しい呼び出しを登録し、自分が実行する）"""
+        with self._lock:
+            call = self._calls.get(key)
+            if call is None:
+                call = self._calls[key] = _Call()
+                return call, True
+            call.waiters += 1
+            return call, False
+
+    def do(self, key: Hashable, function: Callable[[], T]) -> T:
+        while True:
+            call, leader = self._join(key)
+            if leader:
+                break
+            SINGLE_FLIGHT_CALLS.inc(group=self.name, result="shared")
+            if not call.done.wait(remaining()):
+                raise DeadlineExceeded("リクエストの締め切りを過ぎました")
+            error = call.error
+            if error is None:
+                return copy.deepcopy(call.result)
+            if isinstance(error, _LEADER_ONLY_ERRORS) or not isinstance(error, Exception):
+                continue
+            raise _copy_error(error) from error
+
+        SINGLE_FLIGHT_CALLS.inc(group=self.name, result="leader")
+        try:
+            call.result = function()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            # 削除した後は誰も待ち始めないため、ここで待っている数が確定する
+            with self._lock:
+                del self._calls[key]
+                shared = call.waiters > 0
+            call.done.set()
+        return copy.deepcopy(call.result) if shared else call.result
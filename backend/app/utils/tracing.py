@@ -0,0 +1,250 @@
+import atexit
+import contextvars
+import json
+import os
+import queue
+import random
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Tuple
+
+# 記録中のスパン（リクエストやタスクごとに引き継がれる）
+_current_span: contextvars.ContextVar[Optional["Span"]] = contextvars.ContextVar("current_span", default=None)
+
+SERVICE_NAME = os.getenv("OTEL_SERVICE_NAME", "home-chef-ai")
+
+# OTLPのスパンの種類と状態のコード
+SPAN_KINDS = {"INTERNAL": 1, "SERVER": 2, "CLIENT": 3}
+STATUS_CODES = {"UNSET": 0, "OK": 1, "ERROR": 2}
+
+class Span:
+    """OpenTelemetryと同じ形式のID・時刻・属性を持つスパン"""
+
+    __slots__ = (
+        "trace_id", "span_id", "parent_span_id", "name", "kind", "sampled",
+        "start_ns", "end_ns", "attributes", "events", "status", "status_message"
+    )
+
+    def __init__(self, name: str, kind: str = "INTERNAL", parent: Optional["Span"] = None,
+                 trace_id: Optional[str] = None, parent_span_id: Optional[str] = None,
+                 sampled: Optional[bool] = None):
+        self.trace_id = parent.trace_id if parent else (trace_id or f"{random.getrandbits(128):032x}")
+        self.span_id = f"{random.getrandbits(64):016x}"
+        self.parent_span_id = parent.span_id if parent else parent_span_id
+        if sampled is None:
+            sampled = parent.sampled if parent else random.random() < tracer.sample_ratio
+        self.sampled = sampled
+        self.name = name
+        self.kind = kind
+        self.start_ns = time.time_ns()
+        self.end_ns: Optional[int] = None
+        self.attributes: Dict[str, object] = {}
+        self.events: List[Dict] = []
+        self.status = "UNSET"
+        self.status_message = ""
+
+    def set_attribute(self, key: str, value):
+        if value is not None:
+            self.attributes[key] = value
+
+    def record_exception(self, error: BaseException):
+        self.status = "ERROR"
+        self.status_message = str(error)
+        self.events.append({
+            "name": "exception",
+            "timeUnixNano": str(time.time_ns()),
+            "attributes": _attributes({
+                "exception.type": type(error).__name__,
+                "exception.message": str(error)
+            })
+        })
+
+    @property
+    def traceparent(self) -> str:
+        """W3C Trace Contextのtraceparentヘッダーの値"""
+        return f"00-{self.trace_id}-{self.span_id}-{'01' if self.sampled else '00'}"
+
+    def to_otlp(self) -> Dict:
+        span = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": SPAN_KINDS.get(self.kind, 1),
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns or time.time_ns()),
+            "attributes": _attributes(self.attributes),
+            "status": {"code": STATUS_CODES[self.status]}
+        }
+        if self.parent_span_id:
+            span["parentSpanId"] = self.parent_span_id
+        if self.events:
+            span["events"] = self.events
+        if self.status_message:
+            span["status"]["message"] = self.status_message
+        return span
+
+def _attribute_value(value) -> Dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+def _attributes(attributes: Dict) -> List[Dict]:
+    return [{"key": key, "value": _attribute_value(value)} for key, value in attributes.items()]
+
+def parse_traceparent(header: Optional[str]) -> Optional[Tuple[str, str, bool]]:
+    """traceparentヘッダーから (trace_id, 親のspan_id, サンプリング有無) を取り出す"""
+    if not header:
+        return None
+    parts = header.strip().split("-")
+    if len(parts) < 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None
+    try:
+        flags = int(parts[3][:2], 16)
+        int(parts[1], 16)
+        int(parts[2], 16)
+    except ValueError:
+        return None
+    if parts[1] == "0" * 32 or parts[2] == "0" * 16:
+        return None
+    return parts[1], parts[2], bool(flags & 1)
+
+class JsonlSpanExporter:
+    """スパンをOTLP/JSON形式（1行1バッチ）でファイルに書き出すエクスポーター
+
+    OpenTelemetry Collectorのotlpjsonfileレシーバーでそのまま読み込めるため、
+    Collectorがない環境でも記録しておき、あとから取り込める。
+    ファイルがmax_bytesを超えたら「.1」に退避して書き直す。
+    """
+
+    def __init__(self, path: str, max_bytes: int = 10 * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+
+    def export(self, spans: List[Span]):
+        line = json.dumps({
+            "resourceSpans": [{
+                "resource": {"attributes": _attributes({"service.name": SERVICE_NAME})},
+                "scopeSpans": [{
+                    "scope": {"name": "home-chef-ai"},
+                    "spans": [span.to_otlp() for span in spans]
+                }]
+            }]
+        }, ensure_ascii=False)
+        if self.max_bytes and os.path.exists(self.path) and os.path.getsize(self.path) > self.max_bytes:
+            os.replace(self.path, f"{self.path}.1")
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(line + "\n")
+
+class Tracer:
+    """終了したスパンをキューに入れ、バックグラウンドのスレッドでまとめて書き出す
+
+    リクエストの処理中はキューに入れるだけなので、ファイルへの書き込みを待たない。
+    キューがあふれた場合はスパンを捨て、dropped_spansに数える。
+    """
+
+    def __init__(self, exporter: Optional[JsonlSpanExporter], sample_ratio: float = 1.0,
+                 batch_size: int = 512, flush_interval: float = 1.0, max_queue: int = 8192):
+        self.exporter = exporter
+        self.sample_ratio = sample_ratio
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.dropped_spans = 0
+        self._queue: queue.Queue = queue.Queue(maxsize=max_queue)
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def on_end(self, span: Span):
+        if self.exporter is None or not span.sampled:
+            return
+        try:
+            self._queue.put_nowait(span)
+        except queue.Full:
+            self.dropped_spans += 1
+            return
+        if self._thread is None:
+            self._start()
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="span-exporter", daemon=True)
+                self._thread.start()
+                atexit.register(self.flush)
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get(timeout=max(deadline - time.monotonic(), 0)))
+                except queue.Empty:
+                    break
+            self._export(batch)
+
+    def _export(self, batch: List[Span]):
+        try:
+            self.exporter.export(batch)
+        except Exception:
+            self.dropped_spans += len(batch)
+
+    def _after_fork(self):
+        # fork後の子プロセスには書き出し用のスレッドが引き継がれないため作り直す
+        self._queue = queue.Queue(maxsize=self._queue.maxsize)
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def flush(self):
+        """キューに残っているスパンを書き出す"""
+        batch = []
+        while True:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        if batch and self.exporter is not None:
+            self._export(batch)
+
+def _create_tracer() -> Tracer:
+    # 書き出し先を指定した場合だけ既定で有効にする（カレントディレクトリに勝手にファイルを作らない）
+    path = os.getenv("TRACE_EXPORT_PATH")
+    enabled = os.getenv("TRACING_ENABLED", "true" if path else "false").lower() not in ("0", "false", "no")
+    exporter = JsonlSpanExporter(
+        path or "traces.jsonl",
+        int(os.getenv("TRACE_EXPORT_MAX_BYTES", str(10 * 1024 * 1024)))
+    ) if enabled else None
+    return Tracer(exporter, sample_ratio=float(os.getenv("TRACE_SAMPLE_RATIO", "1.0")))
+
+tracer = _create_tracer()
+os.register_at_fork(after_in_child=tracer._after_fork)
+
+def current_span() -> Optional[Span]:
+    """現在記録中のスパンを返す"""
+    return _current_span.get()
+
+@contextmanager
+def span(name: str, kind: str = "INTERNAL", traceparent: Optional[str] = None, **attributes) -> Iterator[Span]:
+    """処理の区間をスパンとして記録する（例外は記録してそのまま送出する）"""
+    parent = _current_span.get()
+    remote = parse_traceparent(traceparent) if parent is None else None
+    if remote:
+        current = Span(name, kind, trace_id=remote[0], parent_span_id=remote[1], sampled=remote[2])
+    else:
+        current = Span(name, kind, parent=parent)
+    for key, value in attributes.items():
+        current.set_attribute(key, value)
+    token = _current_span.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.record_exception(e)
+        raise
+    finally:
+        current.end_ns = time.time_ns()
+        _current_span.reset(token)
+        tracer.on_end(current)
@@ -0,0 +1,180 @@
+import re
+import unicodedata
+from typing import Dict, Optional, Sequence, Tuple
+
+import numpy as np
+
+# 次元ごとの基準単位
+MASS_UNIT = "g"
+VOLUME_UNIT = "ml"
+COUNT_UNIT = "個"
+
+# 単位の表記ゆれ -> (基準単位, 基準単位への換算係数)
+UNIT_TABLE: Dict[str, Tuple[str, float]] = {
+    # 重さ
+    "g": (MASS_UNIT, 1.0),
+    "グラム": (MASS_UNIT, 1.0),
+    "kg": (MASS_UNIT, 1000.0),
+    "キロ": (MASS_UNIT, 1000.0),
+    "キログラム": (MASS_UNIT, 1000.0),
+    "mg": (MASS_UNIT, 0.001),
+
+    # 体積
+    "ml": (VOLUME_UNIT, 1.0),
+    "cc": (VOLUME_UNIT, 1.0),
+    "ミリリットル": (VOLUME_UNIT, 1.0),
+    "dl": (VOLUME_UNIT, 100.0),
+    "l": (VOLUME_UNIT, 1000.0),
+    "リットル": (VOLUME_UNIT, 1000.0),
+    "大さじ": (VOLUME_UNIT, 15.0),
+    "大匙": (VOLUME_UNIT, 15.0),
+    "tbsp": (VOLUME_UNIT, 15.0),
+    "小さじ": (VOLUME_UNIT, 5.0),
+    "小匙": (VOLUME_UNIT, 5.0),
+    "tsp": (VOLUME_UNIT, 5.0),
+    "カップ": (VOLUME_UNIT, 200.0),
+    "cup": (VOLUME_UNIT, 200.0),
+    "合": (VOLUME_UNIT, 180.0),
+
+    # 個数（「個」「玉」などは同じものとして数える）
+    "個": (COUNT_UNIT, 1.0),
+    "コ": (COUNT_UNIT, 1.0),
+    "こ": (COUNT_UNIT, 1.0),
+    "ヶ": (COUNT_UNIT, 1.0),
+    "ケ": (COUNT_UNIT, 1.0),
+    "つ": (COUNT_UNIT, 1.0),
+    "玉": (COUNT_UNIT, 1.0),
+}
+
+# 個数系でも互いに換算できない単位（それぞれが基準単位になる）
+COUNTER_UNITS = ["本", "枚", "片", "かけ", "束", "袋", "パック", "丁", "缶", "株", "尾", "切れ", "房", "杯"]
+for _counter in COUNTER_UNITS:
+    UNIT_TABLE[_counter] = (_counter, 1.0)
+
+# 体積から重さへの換算に使う密度（g/ml）
+DENSITY: Dict[str, float] = {
+    "水": 1.0,
+    "酒": 1.0,
+    "料理酒": 1.0,
+    "酢": 1.0,
+    "牛乳": 1.03,
+    "醤油": 1.2,
+    "しょうゆ": 1.2,
+    "みりん": 1.2,
+    "味噌": 1.2,
+    "みそ": 1.2,
+    "塩": 1.2,
+    "砂糖": 0.6,
+    "小麦粉": 0.55,
+    "薄力粉": 0.55,
+    "片栗粉": 0.6,
+    "サラダ油": 0.9,
+    "ごま油": 0.9,
+    "オリーブオイル": 0.9,
+    "油": 0.9,
+    "マヨネーズ": 0.95,
+    "ケチャップ": 1.2,
+    "米": 0.85,
+}
+
+_AMOUNT_PATTERN = re.compile(r"(\d+(?:\.\d+)?)(?:/(\d+))?")
+_RANGE_PATTERN = re.compile(r"[~〜]")
+
+def normalize_unit(unit: str) -> str:
+    """単位の表記を正規化する（全角・大文字小文字・表記ゆれの吸収）"""
+    if not unit:
+        return ""
+    text = unicodedata.normalize("NFKC", unit).strip()
+    lowered = text.lower()
+    if lowered in UNIT_TABLE:
+        return lowered
+    return text
+
+def canonical_unit(unit: str) -> Tuple[str, float]:
+    """単位に対応する基準単位と換算係数を返す（未知の単位はそのまま）"""
+    normalized = normalize_unit(unit)
+    return UNIT_TABLE.get(normalized, (normalized, 1.0))
+
+def parse_amount(text: str) -> Tuple[float, str]:
+    """「大さじ1/2」「200g」「1と1/2カップ」のような分量表記を数量と単位に分ける"""
+    if not text:
+        return 0.0, ""
+    text = unicodedata.normalize("NFKC", text).strip()
+    # 「2〜3個」のような範囲表記は下限を採用する
+    head = _RANGE_PATTERN.split(text, 1)[0]
+    quantity = 0.0
+    for whole, denominator in _AMOUNT_PATTERN.findall(head):
+        quantity += float(whole) / float(denominator) if denominator else float(whole)
+    unit = _RANGE_PATTERN.sub("", _AMOUNT_PATTERN.sub("", text)).replace("と", "").strip()
+    return quantity, normalize_unit(unit)
+
+def parse_quantity(value, unit: str = "") -> Tuple[Optional[float], str]:
+    """シートやレシピの数量を数値と単位にする
+
+    数値でない表記（「1/2」「大さじ1」など）はparse_amountで読み取り、単位の指定がなければ
+    表記に含まれる単位を使う。数字を含まない表記（「少々」など）は数量をNoneで返す。
+    """
+    unit = str(unit or "")
+    try:
+        return float(value or 0), unit
+    except (TypeError, ValueError):
+        pass
+    if not _AMOUNT_PATTERN.search(unicodedata.normalize("NFKC", str(value))):
+        return None, unit
+    quantity, parsed_unit = parse_amount(str(value))
+    return quantity, unit or parsed_unit
+
+def _unique_inverse(values: Sequence) -> Tuple[np.ndarray, np.ndarray]:
+    """文字列の列を重複なしの値と各行の位置に分解する"""
+    array = np.asarray(values, dtype=object).astype(str)
+    return np.unique(array, return_inverse=True)
+
+def to_canonical(
+    quantities: Sequence[float],
+    units: Sequence[str],
+    names: Optional[Sequence[str]] = None
+) -> Tuple[np.ndarray, np.ndarray]:
+    """数量と単位の列を一括で基準単位に変換する
+
+    単位の解決は重複を除いた単位ごとに一度だけ行い、行ごとの計算は
+    配列演算で済ませる。namesを渡した場合、密度が分かる材料は体積を重さ(g)に揃える。
+    """
+    values = np.asarray(quantities, dtype=np.float64)
+    if values.size == 0:
+        return values, np.asarray([], dtype=object)
+
+    unit_values, unit_inverse = _unique_inverse(units)
+    resolved = [canonical_unit(unit) for unit in unit_values]
+    factors = np.array([factor for _, factor in resolved], dtype=np.float64)[unit_inverse]
+    canonical = np.array([unit for unit, _ in resolved], dtype=object)[unit_inverse]
+    values = values * factors
+
+    if names is not None:
+        name_values, name_inverse = _unique_inverse(names)
+        density = np.array(
+            [DENSITY.get(unicodedata.normalize("NFKC", name).strip(), np.nan) for name in name_values],
+            dtype=np.float64
+        )[name_inverse]
+        convert = (canonical == VOLUME_UNIT) & ~np.isnan(density)
+        values = np.where(convert, values * np.nan_to_num(density), values)
+        canonical = np.where(convert, MASS_UNIT, canonical)
+
+    return values, canonical
+
+def aggregate_quantities(
+    keys: Sequence[str],
+    quantities: Sequence[float],
+    units: Sequence[str],
+    names: Optional[Sequence[str]] = None
+) -> Dict[Tuple[str, str], float]:
+    """キーと基準単位の組ごとに数量を合計する"""
+    values, canonical = to_canonical(quantities, units, names=names)
+    if values.size == 0:
+        return {}
+    groups = np.char.add(np.char.add(np.asarray(keys, dtype=str), "\t"), canonical.astype(str))
+    group_values, group_inverse = np.unique(groups, return_inverse=True)
+    totals = np.bincount(group_inverse, weights=values, minlength=len(group_values))
+    return {
+        tuple(group.split("\t", 1)): float(total)
+        for group, total in zip(group_values, totals)
+    }
@@ -0,0 +1,132 @@
+"""同時リクエストのベンチマーク
+
+Sheetsの読み込みを一定の遅延で応答する偽のサービスに差し替えてサーバーを起動し、
+同じAPIへ同時にリクエストを送って全体の所要時間を測る。あわせて/healthzへの応答時間を測り、
+Sheetsの読み込み中にイベントループが止まっていないかを確かめる。
+
+  cd backend
+  python benchmarks/concurrency.py --requests 32 --latency 0.2
+
+--mode inlineはI/Oプールを使わずにハンドラー内でそのまま呼び出す（変更前の動作）。
+--no-coalesceは同じ範囲の読み込みを1回にまとめる処理を無効にし、プールの並列度だけを測る。
+"""
+import argparse
+import os
+import socket
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+os.environ.setdefault("GOOGLE_SHEETS_ID", "benchmark")
+os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+os.environ.setdefault("TRACING_ENABLED", "false")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+os.environ.setdefault("SNAPSHOT_DIR", tempfile.mkdtemp(prefix="snapshots-"))
+
+RECIPE_ROWS = [
+    [str(i), f"レシピ{i}", "[{'name': 'じゃがいも', 'quantity': 2, 'unit': '個'}]", "2", "", "主菜", ""]
+    for i in range(1, 201)
+]
+
+class _Request:
+    def __init__(self, latency: float, calls: list):
+        self.latency = latency
+        self.calls = calls
+
+    def execute(self):
+        self.calls.append(time.perf_counter())
+        time.sleep(self.latency)
+        return {"values": RECIPE_ROWS}
+
+class FakeSheetsService:
+    """values().get()だけに応答する、遅延つきの偽のSheetsサービス"""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.calls = []
+
+    def spreadsheets(self):
+        return self
+
+    def values(self):
+        return self
+
+    def get(self, **kwargs):
+        return _Request(self.latency, self.calls)
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def _get(url: str) -> float:
+    started = time.perf_counter()
+    with urllib.request.urlopen(url, timeout=60) as response:
+        response.read()
+    return time.perf_counter() - started
+
+def run(mode: str, requests: int, latency: float, coalesce: bool):
+    import uvicorn
+    from app import main
+    from app.api import endpoints
+    from app.utils import sheets
+
+    service = FakeSheetsService(latency)
+    sheets.get_google_sheets_service = lambda: service
+    if not coalesce:
+        sheets._reads.do = lambda key, function: function()
+    if mode == "inline":
+        async def run_inline(function, *args, **kwargs):
+            return function(*args, **kwargs)
+        endpoints.run_io = run_inline
+
+    port = _free_port()
+    server = uvicorn.Server(uvicorn.Config(main.app, host="127.0.0.1", port=port, lifespan="off", log_level="warning"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.01)
+
+    base = f"http://127.0.0.1:{port}"
+    probes = []
+    stop = threading.Event()
+
+    def probe():
+        while not stop.is_set():
+            probes.append(_get(f"{base}/healthz"))
+            time.sleep(0.01)
+
+    prober = threading.Thread(target=probe)
+    with ThreadPoolExecutor(max_workers=requests) as clients:
+        prober.start()
+        started = time.perf_counter()
+        latencies = list(clients.map(_get, [f"{base}/api/v1/recipes/search"] * requests))
+        elapsed = time.perf_counter() - started
+    stop.set()
+    prober.join()
+    server.should_exit = True
+    thread.join()
+
+    print(f"mode={mode} coalesce={coalesce} requests={requests} sheets_latency={latency:.3f}s")
+    print(f"  wall time          {elapsed:.3f}s (serialized would be {requests * latency:.3f}s)")
+    print(f"  sheets calls       {len(service.calls)}")
+    print(f"  request latency    p50={statistics.median(latencies):.3f}s max={max(latencies):.3f}s")
+    print(f"  /healthz latency   p50={statistics.median(probes):.3f}s max={max(probes):.3f}s")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mode", choices=["pool", "inline"], default="pool")
+    parser.add_argument("--requests", type=int, default=32)
+    parser.add_argument("--latency", type=float, default=0.2)
+    parser.add_argument("--no-coalesce", action="store_true")
+    args = parser.parse_args()
+    run(args.mode, args.requests, args.latency, not args.no_coalesce)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+"""材料・レシピを保持するメモリ量のベンチマーク
+
+同じシートの行を次の3つの形で保持したときのメモリ量（tracemallocで計測）と、
+一覧の1ページ分を応答用の辞書にする時間を比べる。
+
+  rows     シートから読んだ文字列のリストのリスト
+  models   行ごとのpydanticモデル（Ingredient・Recipe）
+  columns  列ごとの配列（app.services.record_storeのIngredientTable・RecipeTable）
+
+  cd backend
+  python benchmarks/memory.py --recipes 20000 --ingredients 5000
+"""
+import argparse
+import gc
+import os
+import random
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from app.models.models import Ingredient, Recipe, RecipeIngredient
+from app.services.recipe_matcher import parse_recipe_ingredients
+from app.services.record_store import IngredientTable, RecipeTable
+
+CATEGORIES = ["野菜類", "肉類", "魚介類", "果物類", "乳製品", "調味料", "その他"]
+UNITS = ["g", "ml", "個", "本", "枚", "大さじ", "小さじ"]
+
+def _copy(value: str) -> str:
+    # シートから読んだ行と同じく、同じ値でも行ごとに別の文字列にする
+    return "".join(list(value))
+
+def ingredient_rows(count: int, rng: random.Random) -> list:
+    start = datetime(2024, 1, 1)
+    return [
+        [
+            str(i),
+            f"材料{rng.randrange(count)}",
+            str(rng.randrange(1, 1000)),
+            _copy(rng.choice(UNITS)),
+            (start + timedelta(days=rng.randrange(365))).date().isoformat(),
+            (start + timedelta(seconds=rng.randrange(10 ** 7))).isoformat(),
+            _copy(rng.choice(CATEGORIES))
+        ]
+        for i in range(1, count + 1)
+    ]
+
+def recipe_rows(count: int, rng: random.Random, vocabulary: int = 500) -> list:
+    rows = []
+    for i in range(1, count + 1):
+        ingredients = [
+            {"name": f"材料{rng.randrange(vocabulary)}", "quantity": rng.randrange(1, 500), "unit": rng.choice(UNITS)}
+            for _ in range(rng.randrange(3, 12))
+        ]
+        rows.append([
+            str(i),
+            f"レシピ{i}",
+            str(ingredients),
+            str(rng.randrange(1, 5)),
+            f"https://example.com/recipes/{i}",
+            _copy(rng.choice(CATEGORIES)),
+            ""
+        ])
+    return rows
+
+def to_models(ingredients: list, recipes: list) -> tuple:
+    return (
+        [
+            Ingredient(
+                id=int(row[0]), name=row[1], quantity=float(row[2]), unit=row[3],
+                expiry_date=datetime.fromisoformat(row[4]), updated_at=datetime.fromisoformat(row[5]), category=row[6]
+            )
+            for row in ingredients
+        ],
+        [
+            Recipe(
+                id=int(row[0]), name=row[1],
+                ingredients=[RecipeIngredient(**ing) for ing in parse_recipe_ingredients(row[2])],
+                servings=int(row[3]), url=row[4], category=row[5]
+            )
+            for row in recipes
+        ]
+    )
+
+def to_columns(ingredients: list, recipes: list) -> tuple:
+    return IngredientTable(ingredients), RecipeTable(recipes)
+
+def measure(build, *args):
+    """buildが返した値が保持しているメモリ量（バイト）と構築時間（秒）"""
+    # 計測中は遅くなるため、時間は計測せずに構築したときのものを使う
+    gc.collect()
+    started = time.perf_counter()
+    build(*args)
+    elapsed = time.perf_counter() - started
+    gc.collect()
+    tracemalloc.start()
+    value = build(*args)
+    gc.collect()
+    retained, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return value, retained, elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--recipes", type=int, default=20000)
+    parser.add_argument("--ingredients", type=int, default=5000)
+    parser.add_argument("--page", type=int, default=100)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    rows, rows_bytes, _ = measure(lambda: (ingredient_rows(args.ingredients, rng), recipe_rows(args.recipes, rng)))
+    models, models_bytes, models_seconds = measure(to_models, *rows)
+    columns, columns_bytes, columns_seconds = measure(to_columns, *rows)
+
+    print(f"ingredients={args.ingredients} recipes={args.recipes}")
+    print(f"  rows     {rows_bytes / 2 ** 20:8.1f} MiB")
+    print(f"  models   {models_bytes / 2 ** 20:8.1f} MiB  build {models_seconds:.2f}s")
+    print(f"  columns  {columns_bytes / 2 ** 20:8.1f} MiB  build {columns_seconds:.2f}s")
+
+    recipe_models, recipe_table = models[1], columns[1]
+    started = time.perf_counter()
+    [model.model_dump() for model in recipe_models[:args.page]]
+    dump_seconds = time.perf_counter() - started
+    started = time.perf_counter()
+    recipe_table.records(range(args.page))
+    records_seconds = time.perf_counter() - started
+    print(f"  page of {args.page} recipes: model_dump {dump_seconds * 1000:.2f}ms  records {records_seconds * 1000:.2f}ms")
+
+if __name__ == "__main__":
+    main()
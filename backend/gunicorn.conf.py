@@ -0,0 +1,45 @@
+# 複数ワーカーでの起動設定（gunicorn -c gunicorn.conf.py app.main:app）
+import os
+import tempfile
+
+from dotenv import load_dotenv
+
+load_dotenv(os.path.join(os.path.dirname(__file__), ".env"))
+
+bind = os.getenv("BIND", "0.0.0.0:8000")
+workers = int(os.getenv("WEB_CONCURRENCY", "2"))
+worker_class = "uvicorn.workers.UvicornWorker"
+graceful_timeout = 30
+keepalive = 5
+
+# ワーカー間で共有するストア（キャッシュ・データバージョン・レート制限・ロック）
+# ワーカーは環境変数を引き継ぐため、ここで決めたパスを全ワーカーが使う
+os.environ.setdefault(
+    "SHARED_STORE_PATH",
+    os.path.join(tempfile.gettempdir(), "home-chef-ai-store.sqlite3")
+)
+# チャットの会話の保存先（どのワーカーがリクエストを受けても会話を続けられるようにする）
+os.environ.setdefault(
+    "CHAT_SESSION_DIR",
+    os.path.join(tempfile.gettempdir(), "home-chef-ai-sessions")
+)
+
+def on_starting(server):
+    """ワーカーを起動する前にマスターで1回だけ行う初期化"""
+    # 前回の起動時のキャッシュやバージョンを引き継がない（停止中のシートの編集を反映する）
+    path = os.environ["SHARED_STORE_PATH"]
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+    from app.utils.log import configure_logging
+    from app.utils.sheets import initialize_sheets
+
+    configure_logging()
+    try:
+        initialize_sheets(os.getenv("GOOGLE_SHEETS_ID"))
+    except Exception:
+        # 失敗した場合は各ワーカーがバックグラウンドで再試行する
+        return
+    # 各ワーカーの起動時にはヘッダーの確認やMetaシートの作成を行わない
+    os.environ["SHEETS_INITIALIZED"] = "1"
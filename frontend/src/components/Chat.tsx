@@ -2,16 +2,30 @@ import React, { useState, useRef, useEffect } from 'react';
 import { Box, TextField, IconButton, Paper, Typography, List, ListItem, ListItemText, Divider } from '@mui/material';
 import SendIcon from '@mui/icons-material/Send';
 
+const API_BASE = 'http://localhost:8000/api/v1';
+
+interface Ingredient {
+  id?: number;
+  name: string;
+  quantity: number;
+  unit: string;
+  expiry_date?: string;
+  category: string;
+}
+
+// サーバーの変更フィードから届く差分
+interface Change {
+  version: number;
+  table: string;
+  op: 'upsert' | 'delete';
+  id: number;
+  record: Ingredient | null;
+}
+
 interface Message {
   role: 'user' | 'assistant';
   content: string;
-  ingredients?: Array<{
-    name: string;
-    quantity: number;
-    unit: string;
-    expiry_date?: string;
-    category: string;
-  }>;
+  ingredients?: Ingredient[];
   recipes?: Array<{
     id: string;
     name: string;
@@ -34,6 +48,60 @@ const Chat: React.FC = () => {
   const [messages, setMessages] = useState<Message[]>([]);
   const [input, setInput] = useState('');
   const messagesEndRef = useRef<null | HTMLDivElement>(null);
+  // 材料の在庫（ID -> 材料）と最後に適用した変更のバージョン
+  const inventoryRef = useRef<Record<number, Ingredient>>({});
+  const versionRef = useRef(0);
+  // サーバーが会話を保持するセッションのID（最初の応答で受け取る）
+  const sessionIdRef = useRef<string | null>(null);
+
+  // 順番が来るまで適用を待っている変更（バージョン -> 変更）
+  const pendingRef = useRef<Map<number, Change>>(new Map());
+
+  const applyChanges = (changes: Change[]) => {
+    const next = { ...inventoryRef.current };
+    const pending = pendingRef.current;
+    for (const change of changes) {
+      // SSEとチャットの応答で同じ変更が届くことがあるので、適用済みのバージョンは飛ばす
+      if (change.version > versionRef.current) pending.set(change.version, change);
+    }
+    // バージョンの順に適用する（先のバージョンだけが届いた場合は、間の変更が届くまで待つ）
+    for (let change = pending.get(versionRef.current + 1); change; change = pending.get(versionRef.current + 1)) {
+      pending.delete(change.version);
+      versionRef.current = change.version;
+      if (change.table !== 'Ingredients') continue;
+      if (change.op === 'delete') {
+        delete next[change.id];
+      } else if (change.record) {
+        next[change.id] = change.record;
+      }
+    }
+    inventoryRef.current = next;
+    return Object.values(next);
+  };
+
+  useEffect(() => {
+    // スプレッドシートや他のユーザーによる変更も差分で受け取る
+    const source = new EventSource(`${API_BASE}/changes/stream`);
+    source.addEventListener('snapshot', (event) => {
+      const data = JSON.parse((event as MessageEvent).data);
+      const next: Record<number, Ingredient> = {};
+      for (const ingredient of data.ingredients as Ingredient[]) {
+        if (ingredient.id !== undefined) next[ingredient.id] = ingredient;
+      }
+      inventoryRef.current = next;
+      versionRef.current = data.version;
+      // スナップショットより前の変更は捨て、続きの変更があれば適用する
+      pendingRef.current.forEach((_, version) => {
+        if (version <= data.version) pendingRef.current.delete(version);
+      });
+      applyChanges([]);
+    });
+    source.addEventListener('change', (event) => {
+      applyChanges([JSON.parse((event as MessageEvent).data)]);
+    });
+    // resetの後はサーバーが接続を閉じ、EventSourceが最後のバージョンから再接続する
+    return () => source.close();
+  }, []);
 
   const scrollToBottom = () => {
     messagesEndRef.current?.scrollIntoView({ behavior: "smooth" });
@@ -127,21 +195,30 @@ const Chat: React.FC = () => {
     setInput('');
 
     try {
-      const response = await fetch('http://localhost:8000/api/v1/chat', {
+      const response = await fetch(`${API_BASE}/chat`, {
         method: 'POST',
         headers: {
           'Content-Type': 'application/json',
         },
+        // それまでの会話はサーバーが保持しているので、新しいメッセージだけを送る
         body: JSON.stringify({
-          messages: [...messages, newMessage],
+          session_id: sessionIdRef.current,
+          message: newMessage.content,
         }),
       });
 
       const data = await response.json();
+      if (data.session_id) sessionIdRef.current = data.session_id;
+      // 材料の追加などは一覧全体ではなく差分が返るので、手元の在庫に適用して表示する
+      const changes: Change[] = data.changes ?? [];
+      const inventory = applyChanges(changes);
+      const changedIngredients = changes.some(change => change.table === 'Ingredients');
       setMessages(prev => [...prev, { 
         role: 'assistant', 
-        content: data.message,
-        ingredients: data.ingredients,
+        content: data.stale
+          ? `${data.message}\n（スプレッドシートに接続できないため、${new Date(data.snapshot_at).toLocaleString()}時点のデータを表示しています）`
+          : data.message,
+        ingredients: data.ingredients ?? (changedIngredients ? inventory : undefined),
         recipes: data.recipes
       }]);
     } catch (error) {